@@ -28,9 +28,9 @@ def graf_rot():
         dd = np.concatenate((dd,log[data]['rotulos']))
         
     # Rótulos
-    mm = visao.MegaMan(yaml.load(open("megaman.yaml", "r").read()))
+    banco = visao.BancoSprites(yaml.load(open("megaman.yaml", "r").read()))
     rr,qq = np.unique(dd, return_counts=True)
-    cc = ["("+str(int(i))+") "+mm.classes[int(i)] for i in rr]
+    cc = ["("+str(int(i))+") "+banco.classes[int(i)] for i in rr]
     
     plt.figure(figsize=(12,12))
     wedges, texts, autotexts = plt.pie(qq, autopct='%1.1f%%')
@@ -1,11 +1,95 @@
 socket = require("socket.core")
 json = require("json")
 
+-- "binario": envia os pixels de cada frame pelo socket (protocolo em
+-- megaman_ai/protocolo.py). "memoria": escreve os pixels no anel em
+-- /dev/shm (megaman_ai/anel.py) e envia só o seq do frame.
+-- "arquivo": salva um PNG e envia "Pronto".
+transporte = os.getenv("MEGAMAN_TRANSPORTE") or "binario"
+porta = tonumber(os.getenv("MEGAMAN_PORTA") or "4321")
+caminhoAnel = os.getenv("MEGAMAN_ANEL") or ("/dev/shm/megamanAI." .. porta .. ".anel")
+
+-- inteiro sem sinal big-endian em `bytes` bytes
+function inteiro(valor, bytes)
+    local partes = {}
+    for i = bytes, 1, -1 do
+        partes[i] = string.char(valor % 256)
+        valor = math.floor(valor / 256)
+    end
+    return table.concat(partes)
+end
+
+-- lê um inteiro sem sinal big-endian a partir da posição `inicio`
+function lerInteiro(dados, inicio, bytes)
+    local valor = 0
+    for i = inicio, inicio + bytes - 1 do
+        valor = valor * 256 + string.byte(dados, i)
+    end
+    return valor
+end
+
+-- envia tudo, continuando de onde parou em envios parciais
+function enviarTudo(dados)
+    local i = 1
+    while i <= #dados do
+        local ultimo, err, parcial = client:send(dados, i)
+        if ultimo then
+            i = ultimo + 1
+        elseif err == "timeout" then
+            i = parcial + 1
+        else
+            return nil, err
+        end
+    end
+    return true
+end
+
+-- envia o frame atual: cabeçalho "MMFB", seq, largura, altura,
+-- formato (0 = ARGB) e tamanho, seguido dos pixels do gd sem o
+-- cabeçalho de 11 bytes
+function enviarFrame(seq)
+    local gd = gui.gdscreenshot()
+    local largura = string.byte(gd, 3) * 256 + string.byte(gd, 4)
+    local altura = string.byte(gd, 5) * 256 + string.byte(gd, 6)
+    local pixels = string.sub(gd, 12)
+    enviarTudo("MMFB" .. inteiro(seq, 4) .. inteiro(largura, 2) .. inteiro(altura, 2)
+        .. inteiro(0, 1) .. inteiro(#pixels, 4) .. pixels)
+end
+
+-- abre o anel criado pelo jogo e lê quantos slots ele tem
+function abrirAnel(caminho)
+    local arquivo = assert(io.open(caminho, "r+b"))
+    arquivo:setvbuf("no")
+    local cabecalho = arquivo:read(16)
+    return {arquivo = arquivo, slots = lerInteiro(cabecalho, 5, 4),
+        capacidade = lerInteiro(cabecalho, 9, 4)}
+end
+
+-- escreve o frame atual no slot `seq % slots` do anel e avisa o jogo
+function escreverAnel(anel, seq)
+    local gd = gui.gdscreenshot()
+    local largura = string.byte(gd, 3) * 256 + string.byte(gd, 4)
+    local altura = string.byte(gd, 5) * 256 + string.byte(gd, 6)
+    local pixels = string.sub(gd, 12)
+    local inicio = 16 + (seq % anel.slots) * (16 + anel.capacidade)
+
+    -- o slot deixa de estar pronto enquanto os pixels são escritos
+    anel.arquivo:seek("set", inicio + 4)
+    anel.arquivo:write(inteiro(0, 1))
+    anel.arquivo:seek("set", inicio + 16)
+    anel.arquivo:write(pixels)
+    anel.arquivo:seek("set", inicio)
+    anel.arquivo:write(inteiro(seq, 4) .. inteiro(1, 1) .. inteiro(0, 1) .. inteiro(largura, 2)
+        .. inteiro(altura, 2) .. inteiro(0, 2) .. inteiro(#pixels, 4))
+
+    enviarTudo(inteiro(seq, 4))
+end
+
 sock, err = socket.tcp()
 
 if sock then
     sock:setoption("reuseaddr", true)
-    e, a = sock:bind("127.0.0.1", 4321)
+    e, a = sock:bind("127.0.0.1", porta)
     if a then 
         print(e, a)
         os.exit() 
@@ -25,15 +109,31 @@ ss = savestate.create(1)
 savestate.load(ss)
 
 proximo = true
+seq = 0
+
+if transporte == "memoria" then
+    anel = abrirAnel(caminhoAnel)
+end
 
 while true do
     if proximo then
-        -- Tira screenshot do frame
-        gui.savescreenshotas("/tmp/.megamanAI.screen")
-        
-        -- Envia confirmação de pronto para recebimento
-        -- de comandos
-        client:send("Pronto")
+        if transporte == "binario" then
+            -- Envia os pixels do frame, que também servem
+            -- de confirmação de pronto
+            enviarFrame(seq)
+            seq = seq + 1
+        elseif transporte == "memoria" then
+            -- Escreve o frame no anel e avisa pelo socket
+            escreverAnel(anel, seq)
+            seq = seq + 1
+        else
+            -- Tira screenshot do frame
+            gui.savescreenshotas("/tmp/.megamanAI.screen")
+            
+            -- Envia confirmação de pronto para recebimento
+            -- de comandos
+            client:send("Pronto")
+        end
         
         -- trava
         proximo = false
@@ -1 +1,12 @@
-from . import parametros, inteligencia, treinamento, visao, jogo
\ No newline at end of file
+"""Os submódulos são importados no primeiro acesso, para que o
+`python3 -m megaman_ai --ajuda` e os utilitários que não usam a rede
+não carreguem o tensorflow."""
+
+import importlib
+
+__all__ = ["parametros", "inteligencia", "treinamento", "visao", "jogo"]
+
+def __getattr__(nome):
+    if nome in __all__:
+        return importlib.import_module("." + nome, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, nome))
@@ -1,13 +1,17 @@
 from os import environ, kill, getpid
 import signal
 
-from . import parametros, inteligencia, treinamento, jogo
-from tensorflow.python.util import deprecation
+from . import parametros, perfil
 
 # disable warning messages
-deprecation._PRINT_DEPRECATION_WARNINGS = False
 environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
+def _silenciarTensorflow():
+    """Desliga os avisos de depreciação. O tensorflow só é importado
+    pelos modos que usam o modelo keras, depois da validação."""
+    from tensorflow.python.util import deprecation
+    deprecation._PRINT_DEPRECATION_WARNINGS = False
+
 def uso():
     print("Megaman AI")
     print("")
@@ -42,6 +46,9 @@ def uso():
     print("  --fps=<int>:")
     print("       Numero de fps usados para treinamento e jogo. Os valores aceitos")
     print("       são 30, 15, 10 ou 5.")
+    print("  --motor=<opencv|correlacao>:")
+    print("       Motor de casamento dos sprites. Sobrepõe a chave 'motor'")
+    print("       do arquivo de sprites. Padrão: opencv.")
     print("")
     print("Opções modo Treinamento:")
     print("  --epochs=<int>:")
@@ -51,6 +58,34 @@ def uso():
     print("  --nthreads=<int>:")
     print("       Quantidade de threads para a classificação do video.")
     print("       Por padrão é 4.")
+    print("  --processos=<int>:")
+    print("       Classifica o video em um pool de processos, cada um com seu")
+    print("       próprio leitor de video. Se 0 usa as threads. Padrão: 0.")
+    print("  --trabalhadores=<int>:")
+    print("       Treina com paralelismo de dados em N processos locais, com os")
+    print("       gradientes sincronizados a cada passo. Se 0 treina em um")
+    print("       único processo. Padrão: 0.")
+    print("  --duplicatas=<arquivo>:")
+    print("       Índice (.npz) de janelas já treinadas. Janelas quase iguais a")
+    print("       uma do índice, com o mesmo rótulo, são removidas do batch.")
+    print("       O índice continua entre os videos e os treinamentos.")
+    print("  --limiar_duplicatas=<int>:")
+    print("       Bits de diferença aceitos no hash de cada frame. Padrão: 3.")
+    print("  --peso_duplicatas=<float>:")
+    print("       Peso das janelas quase repetidas; 0 as remove. Padrão: 0.")
+    print("  --cache=<pasta>:")
+    print("       Pasta do cache de rótulos. Vazio desativa o cache. Padrão: cache.")
+    print("  --armazem=<pasta>:")
+    print("       Pasta do armazém de frames pré-processados. Os frames são")
+    print("       guardados na primeira leitura e reaproveitados nas próximas.")
+    print("  --sobrepor:")
+    print("       Classifica o próximo lote enquanto o atual é treinado.")
+    print("  --profundidade=<int>:")
+    print("       Lotes prontos esperando o treinamento com --sobrepor. Padrão: 1.")
+    print("  --retomar:")
+    print("       Continua cada video do ponto salvo em modelos/<nome>.progresso.yaml.")
+    print("  --semente=<int>:")
+    print("       Semente aleatória do treinamento. Se 0 é sorteada. Padrão: 0.")
     print("  --suffle:")
     print("       Se deve misturar as imagens que são passadas para o treinamento.")
     print("       Por padrão é verdadeiro.")
@@ -67,6 +102,47 @@ def uso():
     print("       Caminho para o executavél do emulador fceux. Padrão: /usr/games/fceux")
     print("  --fceux_script=<caminho>:")
     print("       Caminho para o script lua 'servidor'. Padrão: ./server.lua")
+    print("  --transporte=<binario|memoria|arquivo>:")
+    print("       Como os frames chegam do emulador: pixels pelo socket (binario),")
+    print("       anel em /dev/shm (memoria) ou um PNG em /tmp (arquivo).")
+    print("       Padrão: binario.")
+    print("  --inferencia=<janela|estado|keras>:")
+    print("       janela: numpy, igual ao predict sobre os últimos time_steps frames.")
+    print("       estado: numpy, mantém o estado da LSTM e roda só o frame novo.")
+    print("       keras: predict do keras a cada decisão. Padrão: janela.")
+    print("  --pipeline:")
+    print("       Aquisição, pré-processamento, inferência e envio em threads")
+    print("       separadas; o emulador não espera a rede.")
+    print("  --orcamento_ms=<float>:")
+    print("       Com --pipeline, tempo máximo de espera pela decisão de um frame")
+    print("       antes de repetir o último comando. Padrão: 50.")
+    print("  --porta=<int>:")
+    print("       Porta do servidor do emulador. Padrão: 4321.")
+    print("  --sem_emulador:")
+    print("       Não inicia o fceux; conecta em um servidor já em execução na")
+    print("       porta, como o python3 -m megaman_ai.servidor.")
+    print("  --sem_tela:")
+    print("       Não mostra a tela do jogo.")
+    print("  --verboso:")
+    print("       Mostra a classe escolhida e sua probabilidade a cada decisão.")
+    print("  --instancias=<int>:")
+    print("       Joga em N emuladores, nas portas a partir de --porta, com uma")
+    print("       única chamada da rede por passo para todos. Padrão: 1.")
+    print("  --artefato=<caminho>:")
+    print("       Joga com um artefato do python3 -m megaman_ai.exportar em vez")
+    print("       do modelo keras. Usa o modo janela ou estado.")
+    print("  --servico:")
+    print("       Usa o modelo já carregado no python3 -m megaman_ai.servico,")
+    print("       sem importar o tensorflow. Com --inferencia=keras cada")
+    print("       decisão é pedida ao serviço.")
+    print("")
+    print("Perfil:")
+    print("  --perfil=<arquivo>:")
+    print("       Grava em JSON os tempos (com histogramas) de cada etapa do")
+    print("       treinamento ou do jogo e os contadores, periodicamente e no fim.")
+    print("  --perfil_intervalo=<float>:")
+    print("       Segundos entre as gravações do perfil; 0 grava só no fim.")
+    print("       Padrão: 60.")
     print("")
     exit(3)
 
@@ -78,8 +154,15 @@ def treinar(params):
     if not params.validarTreinamento():
         exit(3)
     
-    # carrega a inteligência
-    inteligencia.carregar(params.nome)
+    if len(params.perfil) > 0:
+        perfil.gravarEm(params.perfil, params.perfil_intervalo)
+
+    _silenciarTensorflow()
+    from . import inteligencia, treinamento
+
+    # carrega a inteligência; com trabalhadores cada um carrega a sua
+    if params.trabalhadores == 0:
+        inteligencia.carregar(params.nome)
     
     treino = treinamento.Treinamento(
         videos=params.videos,
@@ -91,7 +174,18 @@ def treinar(params):
         time_steps=params.time_steps,
         suffle=params.suffle,
         frames=params.frames,
-        fps=params.fps)
+        fps=params.fps,
+        processos=params.processos,
+        trabalhadores=params.trabalhadores,
+        duplicatas=params.duplicatas,
+        limiar_duplicatas=params.limiar_duplicatas,
+        peso_duplicatas=params.peso_duplicatas,
+        cache=params.cache,
+        armazem=params.armazem,
+        sobrepor=params.sobrepor,
+        profundidade=params.profundidade,
+        retomar=params.retomar,
+        semente=params.semente)
     
     treino.iniciar()
 
@@ -102,16 +196,39 @@ def jogar(params):
     if not params.validarJogar():
         exit(3)
     
-    # carrega a inteligência
-    inteligencia.carregar(params.nome)
+    if len(params.perfil) > 0:
+        perfil.gravarEm(params.perfil, params.perfil_intervalo)
+
+    from . import jogo
+
+    # carrega a inteligência, que o artefato e o serviço dispensam
+    if len(params.artefato) == 0 and not params.servico:
+        _silenciarTensorflow()
+        from . import inteligencia
+        inteligencia.carregar(params.nome)
+
+    if params.instancias > 1:
+        classe = lambda **kwargs: jogo.JogoMultiplo(params.instancias, **kwargs)
+    else:
+        classe = jogo.Jogo
 
-    jogar = jogo.Jogo(
+    jogar = classe(
         room = params.room,
         sprites = params.sprites,
         fceux=params.fceux,
         time_steps=params.time_steps,
         fceux_script=params.fceux_script,
-        fps=params.fps)
+        fps=params.fps,
+        transporte=params.transporte,
+        inferencia=params.inferencia,
+        pipeline=params.pipeline,
+        orcamento_ms=params.orcamento_ms,
+        porta=params.porta,
+        artefato=params.artefato,
+        servico=params.nome if params.servico else "",
+        emulador=not params.sem_emulador,
+        tela=not params.sem_tela,
+        verboso=params.verboso)
     
     jogar.iniciar()
 
@@ -135,4 +252,6 @@ if __name__ == "__main__":
     else:
         jogar(params)
 
+    # o SIGKILL não deixa os tratadores de saída executarem
+    perfil.finalizar()
     kill(getpid(), signal.SIGKILL)
\ No newline at end of file
@@ -0,0 +1,121 @@
+"""
+anel.py
+
+Anel de frames em memória compartilhada entre o emulador e o `Jogo`.
+
+O anel é um arquivo em `/dev/shm`, um por porta do emulador, mapeado
+em memória pelos dois lados. O emulador (`lua/server.lua` ou
+`servidor.py`) escreve cada frame no slot `seq % slots` e avisa pelo
+socket só com o número do frame; o `Jogo` lê o frame mais recente
+direto do mapeamento, sem cópia, e o socket fica só com os comandos do
+joypad e os avisos.
+
+Layout (inteiros big-endian):
+
+    cabeçalho do anel, 16 bytes: "MMAN", slots (uint32), capacidade (uint32)
+    cada slot: cabeçalho de 16 bytes seguido de `capacidade` bytes de pixels
+        seq (uint32), pronto (uint8), formato (uint8), largura (uint16),
+        altura (uint16), 2 bytes livres, tamanho (uint32)
+
+O escritor zera `pronto` antes de escrever os pixels e grava o cabeçalho
+do slot com `pronto` = 1 por último.
+"""
+
+import mmap
+import os
+import struct
+import numpy
+
+from .protocolo import FORMATO_ARGB, FORMATO_BGR, CANAIS
+
+CAMINHO = "/dev/shm/megamanAI.{}.anel"
+MAGIA = b"MMAN"
+CABECALHO = struct.Struct("!4sII4x")
+SLOT = struct.Struct("!IBBHH2xI")
+# tela do NES em ARGB, o maior frame que o fceux envia
+CAPACIDADE = 256 * 240 * 4
+
+def caminho(porta):
+    """Arquivo do anel do emulador que atende em `porta`"""
+    return CAMINHO.format(porta)
+
+class AnelFrames:
+    """Anel aberto por um dos lados. Use `criar` para criar o arquivo
+    e `AnelFrames(caminho)` para abrir um anel existente."""
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._arquivo = open(caminho, "r+b")
+        self._mapa = mmap.mmap(self._arquivo.fileno(), 0)
+        magia, self.slots, self.capacidade = CABECALHO.unpack_from(self._mapa, 0)
+        if magia != MAGIA:
+            raise ValueError("{} não é um anel de frames".format(caminho))
+        # última amostra entregue por `maisRecente` e frames pulados
+        self.ultimo = -1
+        self.pulados = 0
+
+    @staticmethod
+    def criar(caminho, slots=4, capacidade=CAPACIDADE):
+        """Cria (ou recria) o arquivo do anel com todos os slots vazios"""
+        with open(caminho, "wb") as arquivo:
+            arquivo.write(CABECALHO.pack(MAGIA, slots, capacidade))
+            arquivo.truncate(CABECALHO.size + slots * (SLOT.size + capacidade))
+        return AnelFrames(caminho)
+
+    def _inicio(self, slot):
+        return CABECALHO.size + slot * (SLOT.size + self.capacidade)
+
+    def escrever(self, seq, frame, formato=FORMATO_BGR):
+        """Lado do emulador: escreve um frame BGR no slot de `seq`"""
+        altura, largura = frame.shape[:2]
+        tamanho = altura * largura * CANAIS[formato]
+        if tamanho > self.capacidade:
+            raise ValueError("Frame {}x{} não cabe no anel".format(largura, altura))
+
+        inicio = self._inicio(seq % self.slots)
+        self._mapa[inicio+4] = 0
+        pixels = numpy.ndarray((altura, largura, CANAIS[formato]), numpy.uint8,
+            self._mapa, inicio + SLOT.size)
+        if formato == FORMATO_ARGB:
+            pixels[:, :, 3:0:-1] = frame
+        else:
+            pixels[:] = frame
+        del pixels
+        SLOT.pack_into(self._mapa, inicio, seq, 1, formato, largura, altura, tamanho)
+
+    def maisRecente(self):
+        """Lado do jogo: retorna o número e uma view BGR, sem cópia, do
+        frame pronto mais recente, ou None se nenhum frame novo chegou.
+        Os frames mais antigos que não foram lidos são pulados. A view
+        vale até o emulador dar a volta no anel; como ele espera o
+        comando de cada frame, isso não acontece antes da resposta."""
+        melhor = None
+        for slot in range(self.slots):
+            inicio = self._inicio(slot)
+            seq, pronto, formato, largura, altura, tamanho = SLOT.unpack_from(self._mapa, inicio)
+            if pronto and seq > self.ultimo and (melhor is None or seq > melhor[0]):
+                melhor = (seq, inicio, formato, largura, altura)
+        if melhor is None:
+            return None
+
+        seq, inicio, formato, largura, altura = melhor
+        if self.ultimo >= 0:
+            self.pulados += seq - self.ultimo - 1
+        self.ultimo = seq
+
+        imagem = numpy.ndarray((altura, largura, CANAIS[formato]), numpy.uint8,
+            self._mapa, inicio + SLOT.size)
+        if formato == FORMATO_ARGB:
+            # A R G B -> B G R, ainda sem cópia
+            imagem = imagem[:, :, 3:0:-1]
+        return seq, imagem
+
+    def fechar(self, remover=False):
+        try:
+            self._mapa.close()
+        except BufferError:
+            # ainda existem views do anel em uso; o mapa fecha com elas
+            pass
+        self._arquivo.close()
+        if remover and os.path.isfile(self.caminho):
+            os.remove(self.caminho)
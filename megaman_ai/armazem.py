@@ -0,0 +1,168 @@
+"""
+armazem.py
+
+Conjunto de dados de treinamento em disco.
+
+Os frames já pré-processados (2016 bytes cada, saída de `preprocessar`) e
+seus rótulos são acrescentados em shards binários uint8, abertos com
+`numpy.memmap`. Um índice guarda, para cada video (hash do conteúdo,
+hash da busca que gerou os rótulos e fps), quais intervalos de amostras estão em qual shard, para que o
+treinamento leia qualquer intervalo sem copiar para a memória.
+
+Uso:
+    python3 -m megaman_ai.armazem listar [pasta]
+        Lista os videos e intervalos guardados.
+"""
+
+from sys import argv
+import os
+import numpy
+import yaml
+
+from .cache import hashArquivo, hashBanco, LIMIAR
+from .comuns import sttinf, lerYaml, gravarAtomico
+
+TAMANHO_FRAME = 2016
+
+class Armazem:
+    """Shards `frames_NNNNN.u8` (N x 2016) e `rotulos_NNNNN.u8` (N) e um
+    índice `indice.yaml`. O rótulo de cada frame é o do frame seguinte,
+    como no conjunto de dados do treinamento."""
+
+    # frames por shard (~200 MB)
+    tamanhoShard = 100000
+
+    def __init__(self, pasta):
+        self.pasta = pasta
+        os.makedirs(pasta, exist_ok=True)
+        self._arquivoIndice = os.path.join(pasta, "indice.yaml")
+        self.indice = lerYaml(self._arquivoIndice) or {"shards": [], "videos": {}}
+
+    def chave(self, video, fps, banco, tabela=None, limiar=LIMIAR):
+        """Identifica um video pelo conteúdo, pela busca que rotula os
+        frames (como a chave do cache de rótulos) e pelo fps da amostragem"""
+        return "{}-{}-{}".format(hashArquivo(video, self.pasta)[:20],
+            hashBanco(banco, tabela, limiar)[:12], fps)
+
+    def _caminho(self, tipo, shard):
+        return os.path.join(self.pasta, "{}_{:05}.u8".format(tipo, shard))
+
+    def _acrescentar(self, frames, rotulos):
+        """Escreve no fim do shard atual (criando outro se estiver cheio)
+        e retorna o shard e o deslocamento onde os dados começam"""
+        shards = self.indice["shards"]
+        if len(shards) == 0 or shards[-1] + len(frames) > self.tamanhoShard:
+            shards.append(0)
+        shard = len(shards) - 1
+        deslocamento = shards[shard]
+
+        # escreve a partir do fim conhecido pelo índice, descartando
+        # restos de uma escrita interrompida
+        for tipo, dados, largura in (("frames", frames, TAMANHO_FRAME), ("rotulos", rotulos, 1)):
+            caminho = self._caminho(tipo, shard)
+            with open(caminho, "r+b" if os.path.isfile(caminho) else "wb") as arquivo:
+                arquivo.seek(deslocamento * largura)
+                arquivo.write(numpy.ascontiguousarray(dados, numpy.uint8).tobytes())
+                arquivo.truncate()
+
+        shards[shard] += len(frames)
+        return shard, deslocamento
+
+    def adicionar(self, chave, inicio, frames, rotulos):
+        """Acrescenta os frames das amostras [inicio, inicio+N) do video.
+        Amostras já guardadas não são repetidas."""
+        registros = self.indice["videos"].setdefault(chave, [])
+        fim = inicio + len(frames)
+
+        # intervalos de [inicio, fim) que nenhum registro cobre
+        faltando = []
+        comeco = inicio
+        for registro in sorted(registros, key=lambda r: r["inicio"]):
+            if comeco >= fim:
+                break
+            if registro["inicio"] > comeco:
+                faltando.append((comeco, min(fim, registro["inicio"])))
+            comeco = max(comeco, registro["inicio"] + registro["quantidade"])
+        if comeco < fim:
+            faltando.append((comeco, fim))
+        if len(faltando) == 0:
+            return
+
+        for a, b in faltando:
+            self._registrar(registros, a, frames[a-inicio:b-inicio], rotulos[a-inicio:b-inicio])
+
+        registros.sort(key=lambda r: r["inicio"])
+        gravarAtomico(self._arquivoIndice, lambda a: a.write(yaml.safe_dump(self.indice).encode()))
+
+    def _registrar(self, registros, inicio, frames, rotulos):
+        """Escreve as amostras [inicio, inicio+N) e as registra"""
+        while len(frames) > 0:
+            parte = min(len(frames), self.tamanhoShard)
+            shard, deslocamento = self._acrescentar(frames[:parte], rotulos[:parte])
+
+            # junta com o registro anterior se continuar no mesmo lugar do shard
+            anterior = next((r for r in registros if r["shard"] == shard and
+                r["inicio"] + r["quantidade"] == inicio and
+                r["deslocamento"] + r["quantidade"] == deslocamento), None)
+            if anterior is not None:
+                anterior["quantidade"] += parte
+            else:
+                registros.append({"inicio": inicio, "quantidade": parte,
+                    "shard": shard, "deslocamento": deslocamento})
+
+            frames, rotulos = frames[parte:], rotulos[parte:]
+            inicio += parte
+
+    def _partes(self, chave, inicio, fim):
+        """Registros que cobrem [inicio, fim), ou None se faltar algo"""
+        partes = []
+        for registro in self.indice["videos"].get(chave, []):
+            comeco = registro["inicio"]
+            termino = comeco + registro["quantidade"]
+            if comeco <= inicio < termino:
+                ate = min(fim, termino)
+                partes.append((registro, inicio - comeco, ate - inicio))
+                inicio = ate
+            if inicio >= fim:
+                return partes
+        return None
+
+    def contem(self, chave, inicio, fim):
+        return self._partes(chave, inicio, fim) is not None
+
+    def ler(self, chave, inicio, fim):
+        """Frames (N x 2016) e rótulos (N) das amostras [inicio, fim).
+        Se o intervalo está em um único registro, os arrays são
+        `numpy.memmap` somente leitura, sem cópia."""
+        partes = self._partes(chave, inicio, fim)
+        if partes is None:
+            raise KeyError("Intervalo {}-{} não está no armazém".format(inicio, fim))
+
+        frames, rotulos = [], []
+        for registro, desde, quantidade in partes:
+            deslocamento = registro["deslocamento"] + desde
+            frames.append(numpy.memmap(self._caminho("frames", registro["shard"]), numpy.uint8, "r",
+                offset=deslocamento*TAMANHO_FRAME, shape=(quantidade, TAMANHO_FRAME)))
+            rotulos.append(numpy.memmap(self._caminho("rotulos", registro["shard"]), numpy.uint8, "r",
+                offset=deslocamento, shape=(quantidade,)))
+
+        if len(partes) == 1:
+            return frames[0], rotulos[0]
+        return numpy.concatenate(frames), numpy.concatenate(rotulos)
+
+def listar(pasta="armazem"):
+    armazem = Armazem(pasta)
+    for chave, registros in armazem.indice["videos"].items():
+        total = sum(r["quantidade"] for r in registros)
+        intervalos = ", ".join("{}-{}".format(r["inicio"], r["inicio"]+r["quantidade"]) for r in registros)
+        print("[{}] {}: {} frames ({})".format(sttinf, chave, total, intervalos))
+
+COMANDOS = {
+    "listar": listar,
+}
+
+if __name__ == "__main__":
+    if len(argv) < 2 or not argv[1] in COMANDOS:
+        print(__doc__)
+        exit(3)
+    COMANDOS[argv[1]](*argv[2:])
@@ -0,0 +1,418 @@
+"""
+bancada.py
+
+Verificações de equivalência e medições de desempenho das partes
+mais pesadas do programa.
+
+Uso:
+    python3 -m megaman_ai.bancada motores <video> [frames] [sprites]
+        Confere se os motores de casamento "opencv" e "correlacao" encontram
+        a mesma posição para cada template e compara os tempos.
+
+    python3 -m megaman_ai.bancada decodificacao <video> [amostras]
+        Mede a vazão de leitura do video em cada fps aceito (30/15/10/5),
+        descartando frames com read() e com grab().
+
+    python3 -m megaman_ai.bancada preprocessamento <video> [frames]
+        Confere se `preprocessar` e `preprocessarLote` dão o mesmo resultado
+        que a implementação de referência (`mm_resize`) e compara os tempos.
+
+    python3 -m megaman_ai.bancada transporte [frames]
+        Mede a latência por frame entre o servidor simulado e um cliente,
+        com o PNG em /tmp ("arquivo"), com os pixels pelo socket ("binario")
+        e com o anel em /dev/shm ("memoria").
+
+    python3 -m megaman_ai.bancada inferencia <nome> [time_steps] [passos] [video]
+        Compara as probabilidades dos motores numpy ("janela" e "estado")
+        com o predict do keras sobre a mesma janela de frames e os tempos
+        por decisão. Sem video usa frames aleatórios.
+
+    python3 -m megaman_ai.bancada jogo <nome> <fonte> [time_steps] [transporte] [inferencia] [serial|pipeline] [frames]
+        Executa o `Jogo` de verdade, sem tela, contra o servidor simulado
+        servindo os frames de `fonte` (video, pasta ou número de frames
+        sintéticos) e mede decisões por segundo, latência da decisão e o
+        tempo de cada estágio.
+
+    python3 -m megaman_ai.bancada multijogo <nome> <fonte> [instancias] [time_steps] [transporte] [inferencia] [frames]
+        Executa o `JogoMultiplo` contra um servidor simulado por instância,
+        com 1 e com N instâncias, e compara a vazão somada.
+
+    python3 -m megaman_ai.bancada servico <nome> [time_steps] [passos]
+        Mede o tempo até a primeira decisão e por decisão usando o serviço
+        de modelos (iniciado aqui se não estiver em execução) em cada modo
+        de inferência, e o tempo até a primeira decisão carregando o
+        modelo neste processo, como uma execução sem o serviço.
+
+    python3 -m megaman_ai.bancada paralelo <nome> [trabalhadores] [frames] [epochs] [time_steps] [batch_size]
+        Treina uma cópia do modelo com `--trabalhadores` 1, 2, 4 e 8 (ou a
+        lista separada por vírgulas) sobre o mesmo lote de frames
+        sintéticos e mede janelas/s, aceleração e eficiência de cada um.
+"""
+
+from sys import argv, executable
+from threading import Thread
+from multiprocessing import get_context
+import contextlib
+import io
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import cv2
+import numpy
+import yaml
+
+from . import visao, protocolo, perfil
+from .servidor import ServidorSimulado, framesSinteticos, abrirFonte
+from .anel import AnelFrames
+from .inferencia import MotorInferencia, JanelaDeslizante
+from .comuns import sttinf, sttwrn, mm_resize, preprocessar, preprocessarLote
+from .video import LeitorAmostrado
+
+def lerFrames(video, quantidade):
+    """Lê até `quantidade` frames do video no formato usado na classificação"""
+    captura = cv2.VideoCapture(video)
+    frames = []
+    while len(frames) < quantidade:
+        ok, frame = captura.read()
+        if not ok:
+            break
+        frames.append(cv2.resize(frame, (256, 240))[:-16,:])
+    captura.release()
+    return frames
+
+def motores(video, quantidade=100, sprites="megaman.yaml"):
+    """Compara o argmin de cada template entre os motores de casamento"""
+    config = yaml.safe_load(open(sprites).read())
+    bancos = {}
+    for nome in visao.MOTORES:
+        bancos[nome] = visao.BancoSprites(dict(config, motor=nome))
+
+    frames = [visao.MegaMan.transformar(f) for f in lerFrames(video, int(quantidade))]
+    tempos = dict.fromkeys(bancos, 0.0)
+    casamentos = 0
+    divergentes = 0
+
+    for frame in frames:
+        resultados = {}
+        for nome, banco in bancos.items():
+            inicio = time.perf_counter()
+            preparada = banco.motor.preparar(frame)
+            resultados[nome] = [banco.motor.casar(preparada, i) for i in range(len(banco.modelos))]
+            tempos[nome] += time.perf_counter() - inicio
+
+        for referencia, correlacao in zip(resultados["opencv"], resultados["correlacao"]):
+            casamentos += 1
+            # empates exatos podem cair em posições diferentes, então só
+            # conta como divergência se a pontuação também for diferente
+            if referencia[1] != correlacao[1] and abs(referencia[0] - correlacao[0]) >= 255**2 / 2:
+                divergentes += 1
+
+    print("[{}] Frames: {} Casamentos: {} Divergentes: {}".format(
+        sttinf, len(frames), casamentos, divergentes))
+    for nome, tempo in tempos.items():
+        print("[{}] {:8}: {:8.2f} ms/frame".format(sttinf, nome, 1000*tempo/max(1, len(frames))))
+    if divergentes > 0:
+        print("[{}] Os motores não são equivalentes!".format(sttwrn))
+    return divergentes
+
+def decodificacao(video, amostras=300):
+    """Compara a leitura com descarte por read() (decodifica e converte
+    todos os frames) com a do `LeitorAmostrado` (grab() nos descartados)"""
+    amostras = int(amostras)
+    for fps in (30, 15, 10, 5):
+        leitor = LeitorAmostrado(video, fps)
+        lidas = 0
+        inicio = time.perf_counter()
+        while lidas < amostras:
+            for _ in range(leitor.taxa-1):
+                leitor.captura.read()
+            if not leitor.captura.read()[0]:
+                break
+            lidas += 1
+        porRead = lidas / (time.perf_counter() - inicio)
+
+        leitor.buscar(0)
+        lidas = 0
+        inicio = time.perf_counter()
+        while lidas < amostras and leitor.ler() is not None:
+            lidas += 1
+        porGrab = lidas / (time.perf_counter() - inicio)
+        leitor.fechar()
+
+        print("[{}] fps {:2} (taxa {} de {:.0f}): read() {:8.1f} amostras/s | grab() {:8.1f} amostras/s".format(
+            sttinf, fps, leitor.taxa, leitor.fpsOrigem, porRead, porGrab))
+
+def preprocessamento(video, quantidade=500):
+    """Equivalência e tempo do pré-processamento contra a referência"""
+    frames = lerFrames(video, int(quantidade))
+    if len(frames) == 0:
+        print("[{}] Nenhum frame lido de {}".format(sttwrn, video))
+        return
+
+    inicio = time.perf_counter()
+    referencia = numpy.array([mm_resize(cv2.cvtColor(f, cv2.COLOR_BGR2GRAY)).flatten() for f in frames])
+    tempoReferencia = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    unitario = numpy.array([preprocessar(f) for f in frames])
+    tempoUnitario = time.perf_counter() - inicio
+
+    pilha = numpy.array(frames)
+    inicio = time.perf_counter()
+    lote = preprocessarLote(pilha)
+    tempoLote = time.perf_counter() - inicio
+
+    for nome, resultado, tempo in (("referência", referencia, tempoReferencia),
+            ("preprocessar", unitario, tempoUnitario), ("lote", lote, tempoLote)):
+        diferentes = int((resultado != referencia).any(axis=1).sum())
+        print("[{}] {:12}: {:8.3f} ms/frame, {} frames diferentes da referência".format(
+            sttinf, nome, 1000*tempo/len(frames), diferentes))
+
+def transporte(quantidade=500):
+    """Latência de cada frame, do envio do comando até o frame seguinte
+    estar em memória, para cada transporte do servidor"""
+    quantidade = int(quantidade)
+    for nome in ("arquivo", "binario", "memoria"):
+        servidor = ServidorSimulado(framesSinteticos(quantidade), 0, nome)
+        anel = AnelFrames.criar(servidor.caminhoAnel) if nome == "memoria" else None
+        atendimento = Thread(target=servidor.atender)
+        atendimento.start()
+
+        conexao = socket.create_connection(("127.0.0.1", servidor.porta))
+        conexao.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        receptor = protocolo.ReceptorFrames(conexao)
+        tempos = []
+        for _ in range(quantidade):
+            inicio = time.perf_counter()
+            if nome == "binario":
+                frame = receptor.receber()
+            elif nome == "memoria":
+                protocolo.receberAviso(conexao)
+                seq, frame = anel.maisRecente()
+            else:
+                conexao.recv(4096)
+                frame = None
+                while frame is None:
+                    frame = cv2.imread(servidor.caminhoFrame)
+            tempos.append(time.perf_counter() - inicio)
+            conexao.sendall(b"{}\n")
+
+        conexao.close()
+        atendimento.join()
+        if anel is not None:
+            del frame
+            anel.fechar(remover=True)
+        tempos = 1000 * numpy.array(tempos)
+        print("[{}] {:8}: {:7.3f} ms/frame (p50 {:7.3f} | p99 {:7.3f}) {} comandos".format(
+            sttinf, nome, tempos.mean(), numpy.percentile(tempos, 50),
+            numpy.percentile(tempos, 99), servidor.comandos))
+
+def inferencia(nome, time_steps=15, passos=100, video=""):
+    """Diferença entre os motores de inferência numpy e o keras"""
+    from . import inteligencia
+    inteligencia.carregar(nome)
+    time_steps, passos = int(time_steps), int(passos)
+
+    if len(video) > 0:
+        frames = preprocessarLote(numpy.array(lerFrames(video, passos)))
+    else:
+        frames = numpy.random.RandomState(0).randint(0, 256, (passos, 2016)).astype(numpy.uint8)
+
+    janela = JanelaDeslizante(time_steps, 2016)
+    motores = {modo: MotorInferencia.doKeras(inteligencia.modelo, time_steps, modo)
+        for modo in ("janela", "estado")}
+    tempos = dict.fromkeys(["keras"] + list(motores), 0.0)
+    diferencas = dict.fromkeys(motores, 0.0)
+    iguais = dict.fromkeys(motores, 0)
+
+    for frame in frames:
+        inicio = time.perf_counter()
+        janela.acrescentar(frame / 255.0)
+        referencia = numpy.asarray(inteligencia.modelo.predict_on_batch(janela.janela()[numpy.newaxis]))[0]
+        tempos["keras"] += time.perf_counter() - inicio
+
+        for modo, motor in motores.items():
+            inicio = time.perf_counter()
+            saida = motor.passo(frame)
+            tempos[modo] += time.perf_counter() - inicio
+            diferencas[modo] = max(diferencas[modo], float(numpy.abs(saida - referencia).max()))
+            iguais[modo] += int(numpy.argmax(saida) == numpy.argmax(referencia))
+
+    print("[{}] {:7}: {:8.3f} ms/decisão".format(sttinf, "keras", 1000*tempos["keras"]/len(frames)))
+    for modo in motores:
+        print("[{}] {:7}: {:8.3f} ms/decisão | diferença máxima {:.2e} | mesma classe em {:6.2f}%".format(
+            sttinf, modo, 1000*tempos[modo]/len(frames), diferencas[modo], 100*iguais[modo]/len(frames)))
+    if diferencas["janela"] > 1e-4:
+        print("[{}] O motor \"janela\" não é equivalente ao keras!".format(sttwrn))
+
+def jogo(nome, fonte, time_steps=15, transporte="binario", inferencia="janela",
+        modo="serial", quantidade=1000, sprites="megaman.yaml"):
+    """Desempenho do laço do modo jogar de ponta a ponta"""
+    from . import inteligencia
+    from .jogo import Jogo
+    frames = abrirFonte(fonte, int(quantidade), carregar=True)
+
+    # o servidor roda em outro processo, como o emulador; o fork é feito
+    # antes de carregar o tensorflow
+    servidor = ServidorSimulado(frames, 0, transporte)
+    atendimento = get_context("fork").Process(target=servidor.atender)
+    atendimento.start()
+    inteligencia.carregar(nome)
+
+    perfil.reiniciar()
+    partida = Jogo("", yaml.safe_load(open(sprites).read()), int(time_steps),
+        porta=servidor.porta, emulador=False, tela=False, transporte=transporte,
+        inferencia=inferencia, pipeline=modo == "pipeline")
+    saida = io.StringIO()
+    with contextlib.redirect_stdout(saida):
+        partida.iniciar()
+    atendimento.join()
+
+    if partida.decisoes == 0:
+        print(saida.getvalue()[-2000:])
+        print("[{}] Nenhuma decisão foi tomada".format(sttwrn))
+        return
+
+    print("[{}] {} frames | {} decisões em {:.2f} s: {:.1f} decisões/s".format(sttinf, len(frames),
+        partida.decisoes, partida.duracao, partida.decisoes / partida.duracao))
+    if partida.tempos.quantidade("decisao") > 0:
+        n, media, p50, p99 = partida.tempos.resumo()["decisao"]
+        print("[{}] latência da decisão: p50 {:.3f} ms | p99 {:.3f} ms".format(sttinf, p50, p99))
+    partida.tempos.exibir()
+
+def multijogo(nome, fonte, instancias=4, time_steps=15, transporte="binario",
+        inferencia="janela", quantidade=500, sprites="megaman.yaml"):
+    """Vazão de várias instâncias com a rede em lote, comparada a uma"""
+    from . import inteligencia
+    from .jogo import JogoMultiplo
+    frames = abrirFonte(fonte, int(quantidade), carregar=True)
+    config = yaml.safe_load(open(sprites).read())
+    contexto = get_context("fork")
+    vazoes = {}
+
+    for n in sorted({1, int(instancias)}):
+        servidores = [ServidorSimulado(frames, 0, transporte) for _ in range(n)]
+        processos = [contexto.Process(target=servidor.atender) for servidor in servidores]
+        for processo in processos:
+            processo.start()
+        if inteligencia.modelo is None:
+            inteligencia.carregar(nome)
+
+        perfil.reiniciar()
+        multiplo = JogoMultiplo(n, "", config, int(time_steps), portas=[s.porta for s in servidores],
+            emulador=False, tela=False, transporte=transporte, inferencia=inferencia)
+        with contextlib.redirect_stdout(io.StringIO()):
+            multiplo.iniciar()
+        for processo in processos:
+            processo.join()
+
+        if multiplo.decisoes == 0:
+            print("[{}] Nenhuma decisão foi tomada com {} instâncias".format(sttwrn, n))
+            continue
+        vazoes[n] = multiplo.decisoes / multiplo.duracao
+        _, _, p50, p99 = multiplo.tempos.resumo()["decisao"]
+        print("[{}] {:2} instâncias: {:8.1f} decisões/s | passo p50 {:.3f} ms | p99 {:.3f} ms".format(
+            sttinf, n, vazoes[n], p50, p99))
+        multiplo.tempos.exibir()
+
+    if len(vazoes) == 2:
+        print("[{}] Vazão com {} instâncias: {:.2f}x a de uma".format(
+            sttinf, int(instancias), vazoes[int(instancias)] / vazoes[1]))
+
+def servico(nome, time_steps=15, passos=100):
+    """Tempo até a primeira decisão com e sem o serviço de modelos"""
+    from .servico import CAMINHO, preditorDoServico
+    from .inferencia import PreditorKeras
+    time_steps, passos = int(time_steps), int(passos)
+    frames = numpy.random.RandomState(0).randint(0, 256, (passos, 2016)).astype(numpy.uint8)
+
+    processo = None
+    if not os.path.exists(CAMINHO):
+        processo = subprocess.Popen([executable, "-m", "megaman_ai.servico", nome],
+            stdout=subprocess.DEVNULL)
+        while not os.path.exists(CAMINHO):
+            if processo.poll() is not None:
+                print("[{}] O serviço de modelos não iniciou".format(sttwrn))
+                return
+            time.sleep(0.1)
+
+    try:
+        # o primeiro pedido espera o serviço terminar de carregar o modelo
+        preditorDoServico(nome, time_steps).passo(frames[0])
+        saidas = {}
+        for modo in ("janela", "estado", "keras"):
+            inicio = time.perf_counter()
+            preditor = preditorDoServico(nome, time_steps, modo)
+            saidas[modo] = [preditor.passo(frames[0])]
+            primeira = time.perf_counter() - inicio
+            inicio = time.perf_counter()
+            saidas[modo] += [preditor.passo(frame) for frame in frames[1:]]
+            decisao = (time.perf_counter() - inicio) / max(1, len(frames) - 1)
+            print("[{}] servico {:7}: primeira decisão em {:8.1f} ms | {:8.3f} ms/decisão".format(
+                sttinf, modo, 1000*primeira, 1000*decisao))
+        print("[{}] diferença máxima entre \"janela\" e o predict do serviço: {:.2e}".format(sttinf,
+            numpy.abs(numpy.array(saidas["janela"]) - numpy.array(saidas["keras"])).max()))
+    finally:
+        if processo is not None:
+            processo.terminate()
+            processo.wait()
+
+    # como uma execução sem o serviço: importa o keras e carrega o modelo
+    inicio = time.perf_counter()
+    from . import inteligencia
+    inteligencia.carregar(nome)
+    PreditorKeras(inteligencia.modelo, time_steps).passo(frames[0])
+    print("[{}] sem serviço: primeira decisão em {:8.1f} ms".format(sttinf, 1000*(time.perf_counter() - inicio)))
+
+def paralelo(nome, trabalhadores="1,2,4,8", quantidade=4000, epochs=1, time_steps=15, batch_size=100):
+    """Escalabilidade do treinamento com paralelismo de dados"""
+    from .paralelo import TreinadorParalelo
+    quantidades = sorted(int(n) for n in str(trabalhadores).split(","))
+    quantidade, epochs, time_steps, batch_size = int(quantidade), int(epochs), int(time_steps), int(batch_size)
+    estado = numpy.random.RandomState(0)
+    frames = estado.randint(0, 256, (quantidade, 2016)).astype(numpy.uint8)
+    # a vazão não depende dos rótulos; a classe 0 existe em qualquer modelo
+    rotulos = numpy.zeros(quantidade, numpy.uint8)
+    janelas = (quantidade - time_steps) * epochs
+
+    # cada medição parte da mesma cópia, sem mexer no modelo de modelos/
+    pasta = tempfile.mkdtemp()
+    copia = os.path.join(pasta, nome + ".h5")
+    shutil.copy("modelos/{}.h5".format(nome), copia)
+    vazoes = {}
+    try:
+        for n in quantidades:
+            treinador = TreinadorParalelo(copia, n, time_steps, batch_size, epochs, verbose=0)
+            try:
+                # o primeiro fit inclui o traçado do grafo e a conexão do cluster
+                treinador.treinar(frames, rotulos, semente=0)
+                _, duracao = treinador.treinar(frames, rotulos, semente=1)
+            finally:
+                treinador.fechar()
+            vazoes[n] = janelas / duracao
+            aceleracao = vazoes[n] / vazoes[quantidades[0]] * quantidades[0]
+            print("[{}] {:2} trabalhadores: {:9.1f} janelas/s | aceleração {:5.2f}x | eficiência {:6.1f}%".format(
+                sttinf, n, vazoes[n], aceleracao, 100 * aceleracao / n))
+    finally:
+        shutil.rmtree(pasta, ignore_errors=True)
+
+COMANDOS = {
+    "motores": motores,
+    "decodificacao": decodificacao,
+    "preprocessamento": preprocessamento,
+    "transporte": transporte,
+    "inferencia": inferencia,
+    "jogo": jogo,
+    "multijogo": multijogo,
+    "servico": servico,
+    "paralelo": paralelo,
+}
+
+if __name__ == "__main__":
+    if len(argv) < 2 or not argv[1] in COMANDOS:
+        print(__doc__)
+        exit(3)
+    COMANDOS[argv[1]](*argv[2:])
@@ -0,0 +1,233 @@
+"""
+cache.py
+
+Cache persistente dos rótulos gerados por `visao.MegaMan`.
+
+Cada entrada guarda, para cada frame amostrado de um video, o rótulo,
+a posição do megaman e a pontuação do casamento. A chave é formada pelo
+hash do arquivo de video, pelo hash da busca (banco de sprites, motor,
+limiar e ordem da tabela de transições) e pelo fps, então a entrada só
+é reaproveitada se nada que mude os rótulos mudou.
+
+Uso:
+    python3 -m megaman_ai.cache listar [pasta]
+        Lista as entradas do cache.
+    python3 -m megaman_ai.cache podar <dias> [pasta]
+        Remove as entradas não usadas nos últimos <dias> dias e as
+        entradas de videos que não existem mais.
+    python3 -m megaman_ai.cache invalidar <video|chave|todos> [pasta]
+        Remove as entradas de um video, uma entrada ou todas.
+"""
+
+from sys import argv
+import hashlib
+import os
+import time
+import numpy
+import yaml
+
+from . import visao, perfil
+from .comuns import sttinf, sttwrn, lerYaml, gravarAtomico
+
+PASTA = "cache"
+# pontuação máxima de um casamento aceito
+LIMIAR = 20
+
+def hashArquivo(caminho, pasta=PASTA):
+    """Hash sha256 do conteúdo do arquivo. O resultado é memorizado
+    pelo tamanho e data de modificação para não reler videos grandes."""
+    info = os.stat(caminho)
+    arquivoMemoria = os.path.join(pasta, "hashes.yaml")
+    memoria = lerYaml(arquivoMemoria)
+    registro = memoria.get(os.path.abspath(caminho))
+
+    if registro and registro["tamanho"] == info.st_size and registro["modificado"] == info.st_mtime:
+        return registro["hash"]
+
+    soma = hashlib.sha256()
+    with open(caminho, "rb") as arquivo:
+        for bloco in iter(lambda: arquivo.read(1 << 20), b""):
+            soma.update(bloco)
+
+    memoria[os.path.abspath(caminho)] = {
+        "tamanho": info.st_size,
+        "modificado": info.st_mtime,
+        "hash": soma.hexdigest()}
+    os.makedirs(pasta, exist_ok=True)
+    gravarAtomico(arquivoMemoria, lambda a: a.write(yaml.safe_dump(memoria).encode()))
+    return soma.hexdigest()
+
+def hashBanco(banco, tabela=None, limiar=LIMIAR):
+    """Hash dos templates do banco e dos parâmetros de busca que
+    influenciam os rótulos: o motor, o limiar e, com uma tabela de
+    transições, a ordem de avaliação que ela dá depois de cada rótulo"""
+    soma = hashlib.sha256()
+    for modelo in banco.modelos:
+        soma.update("{}-{}".format(modelo.estado, modelo.direcao).encode())
+        for imagem in (modelo.sprite, modelo.mascara):
+            soma.update(str(imagem.shape).encode())
+            soma.update(imagem.tobytes())
+    parametros = (visao.MegaMan.sobra, visao.MegaMan.folga,
+        visao.Rastreador.minimo, visao.Rastreador.suavizacao, banco.nomeMotor, limiar)
+    soma.update(repr(parametros).encode())
+    if tabela is not None:
+        for rotulo in range(len(banco.classes)):
+            soma.update(repr(list(tabela.ordem(rotulo))).encode())
+    return soma.hexdigest()
+
+class TrechoRotulos:
+    """Rótulos, posições e pontuações de um trecho de amostras de um
+    video, a partir da amostra `inicio`. Rótulo -1 indica amostra ainda
+    não classificada. É pequeno o bastante para ir e voltar dos
+    processos de classificação."""
+
+    def __init__(self, inicio, rotulos, posicoes, pontuacoes, limiar=LIMIAR):
+        self.inicio = inicio
+        self.rotulos = rotulos
+        self.posicoes = posicoes
+        self.pontuacoes = pontuacoes
+        self.limiar = limiar
+        self.acertos = 0
+
+    @staticmethod
+    def vazio(tamanho):
+        """Arrays de rótulos, posições e pontuações sem nenhuma amostra"""
+        return (numpy.full(tamanho, -1, numpy.int16),
+                numpy.full((tamanho, 2), -1, numpy.int16),
+                numpy.full(tamanho, numpy.nan, numpy.float32))
+
+    def consultar(self, amostra):
+        """Retorna o rótulo da amostra ou None se não estiver no cache"""
+        i = amostra - self.inicio
+        if 0 <= i < len(self.rotulos) and self.rotulos[i] >= 0:
+            self.acertos += 1
+            perfil.contar("rotulos_do_cache")
+            return int(self.rotulos[i])
+        return None
+
+    def registrar(self, amostra, rotulo, posicao, pontuacao):
+        i = amostra - self.inicio
+        if 0 <= i < len(self.rotulos):
+            self.rotulos[i] = rotulo
+            self.posicoes[i] = posicao if posicao is not None else (-1, -1)
+            self.pontuacoes[i] = pontuacao
+
+    def rotular(self, vis, amostra, frame):
+        """Rótulo da amostra: vem do cache quando existe, senão é
+        calculado por `vis` a partir do frame e registrado. Quando vem do
+        cache, `vis` recebe o rótulo e a posição guardados, para que o
+        rastreamento do próximo frame seja o mesmo de uma classificação
+        sem cache."""
+        rotulo = self.consultar(amostra)
+        if rotulo is None:
+            pontuacao = vis.atualizar(vis.transformar(frame), self.limiar)
+            rotulo = vis.rotulo
+            self.registrar(amostra, rotulo, vis.posicao, pontuacao)
+        else:
+            x, y = self.posicoes[amostra - self.inicio]
+            vis.restaurar(rotulo, None if x < 0 else (int(x), int(y)))
+        return rotulo
+
+class CacheRotulos(TrechoRotulos):
+    """Entrada do cache para um video inteiro, gravada em `pasta`.
+    `tabela` é a `visao.TabelaTransicoes` das instâncias que classificam
+    os frames (None para a busca exaustiva)."""
+
+    def __init__(self, video, banco, fps, total, pasta=PASTA, tabela=None, limiar=LIMIAR):
+        os.makedirs(pasta, exist_ok=True)
+        hashVideo = hashArquivo(video, pasta)
+        self.chave = hashlib.sha256("{}:{}:{}".format(
+            hashVideo, hashBanco(banco, tabela, limiar), fps).encode()).hexdigest()[:20]
+        self._arquivo = os.path.join(pasta, self.chave + ".npz")
+        self._info = os.path.join(pasta, self.chave + ".yaml")
+
+        rotulos, posicoes, pontuacoes = TrechoRotulos.vazio(total)
+
+        if os.path.isfile(self._arquivo):
+            with numpy.load(self._arquivo) as salvo:
+                n = min(total, len(salvo["rotulos"]))
+                rotulos[:n] = salvo["rotulos"][:n]
+                posicoes[:n] = salvo["posicoes"][:n]
+                pontuacoes[:n] = salvo["pontuacoes"][:n]
+
+        super().__init__(0, rotulos, posicoes, pontuacoes, limiar)
+        self.info = lerYaml(self._info) or {
+            "video": os.path.abspath(video),
+            "hash_video": hashVideo,
+            "fps": fps,
+            "criado": time.time()}
+
+    def trecho(self, inicio, fim):
+        """Cópia independente das amostras [inicio, fim)"""
+        parte = slice(inicio, fim)
+        return TrechoRotulos(inicio, self.rotulos[parte].copy(),
+            self.posicoes[parte].copy(), self.pontuacoes[parte].copy(), self.limiar)
+
+    def mesclar(self, trecho):
+        """Copia para o cache as amostras classificadas de um trecho"""
+        parte = slice(trecho.inicio, trecho.inicio + len(trecho.rotulos))
+        self.rotulos[parte] = trecho.rotulos
+        self.posicoes[parte] = trecho.posicoes
+        self.pontuacoes[parte] = trecho.pontuacoes
+        self.acertos += trecho.acertos
+
+    def salvar(self):
+        gravarAtomico(self._arquivo, lambda a: numpy.savez(a,
+            rotulos=self.rotulos, posicoes=self.posicoes, pontuacoes=self.pontuacoes))
+        self.info["acessado"] = time.time()
+        self.info["total"] = len(self.rotulos)
+        self.info["classificados"] = int((self.rotulos >= 0).sum())
+        gravarAtomico(self._info, lambda a: a.write(yaml.safe_dump(self.info).encode()))
+
+def _entradas(pasta):
+    """Chave e informações de cada entrada do cache"""
+    if not os.path.isdir(pasta):
+        return []
+    chaves = [a[:-5] for a in sorted(os.listdir(pasta)) if a.endswith(".npz")]
+    return [(chave, lerYaml(os.path.join(pasta, chave + ".yaml"))) for chave in chaves]
+
+def _remover(pasta, chave):
+    for extensao in (".npz", ".yaml"):
+        caminho = os.path.join(pasta, chave + extensao)
+        if os.path.isfile(caminho):
+            os.remove(caminho)
+
+def listar(pasta=PASTA):
+    for chave, info in _entradas(pasta):
+        tamanho = os.path.getsize(os.path.join(pasta, chave + ".npz"))
+        acessado = time.strftime("%Y-%m-%d %H:%M", time.localtime(info.get("acessado", 0)))
+        print("{} {:>6}/{:<6} fps {:2} {:8.1f} KB {} {}".format(chave,
+            info.get("classificados", "?"), info.get("total", "?"), info.get("fps", "?"),
+            tamanho/1024, acessado, info.get("video", "?")))
+
+def podar(dias, pasta=PASTA):
+    limite = time.time() - float(dias)*24*60*60
+    removidas = 0
+    for chave, info in _entradas(pasta):
+        if info.get("acessado", 0) < limite or not os.path.isfile(info.get("video", "")):
+            _remover(pasta, chave)
+            removidas += 1
+    print("[{}] {} entradas removidas".format(sttinf, removidas))
+
+def invalidar(alvo, pasta=PASTA):
+    removidas = 0
+    for chave, info in _entradas(pasta):
+        if alvo in ("todos", chave) or info.get("video") == os.path.abspath(alvo):
+            _remover(pasta, chave)
+            removidas += 1
+    if removidas == 0:
+        print("[{}] Nenhuma entrada encontrada para {}".format(sttwrn, alvo))
+    else:
+        print("[{}] {} entradas removidas".format(sttinf, removidas))
+
+COMANDOS = {
+    "listar": listar,
+    "podar": podar,
+    "invalidar": invalidar,
+}
+
+if __name__ == "__main__":
+    if len(argv) < 2 or not argv[1] in COMANDOS:
+        print(__doc__)
+        exit(3)
+    COMANDOS[argv[1]](*argv[2:])
@@ -1,10 +1,70 @@
 import cv2
+import numpy
+import os
+import yaml
 
 sttinf = "\033[;1m\033[1;31m*\033[0;0m"
 sttwrn = "\033[;1m\033[1;93m!\033[0;0m"
 
+# tamanho da tela do NES sem as 16 linhas de baixo, usado pela rede
+ALTURA_TELA = 224
+# tamanho do frame reduzido por `mm_resize` (2016 bytes)
+ALTURA_REDUZIDA = 42
+LARGURA_REDUZIDA = 48
+
 def mm_resize(frame):
+    """Implementação de referência da redução de um frame em cinza.
+    `preprocessar` e `preprocessarLote` devem dar o mesmo resultado."""
     for s in (0.5, 0.5, 0.75):
         frame = cv2.resize(frame, None, fx=s, fy=s, interpolation=cv2.INTER_BITS)
     frame[frame <= 40] = 0
-    return frame
\ No newline at end of file
+    return frame
+
+def _reduzir(frame, saida):
+    """Recorta, converte para cinza e faz os três passos de `mm_resize`
+    (sem o corte dos pixels escuros) de um frame, escrevendo em `saida`
+    (42 x 48)"""
+    frame = frame[:ALTURA_TELA]
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    for s in (0.5, 0.5):
+        frame = cv2.resize(frame, None, fx=s, fy=s, interpolation=cv2.INTER_BITS)
+    cv2.resize(frame, (LARGURA_REDUZIDA, ALTURA_REDUZIDA), saida, 0.75, 0.75, interpolation=cv2.INTER_BITS)
+
+def preprocessar(frame):
+    """Recorta, converte para cinza, reduz e zera os pixels escuros de um
+    frame BGR (ou já em cinza), retornando o vetor de 2016 bytes usado
+    pela rede. O resultado é o mesmo de `mm_resize`."""
+    saida = numpy.empty((ALTURA_REDUZIDA, LARGURA_REDUZIDA), numpy.uint8)
+    _reduzir(frame, saida)
+    saida[saida <= 40] = 0
+    return saida.reshape(-1)
+
+def preprocessarLote(frames):
+    """Versão em lote de `preprocessar` para uma pilha N x H x W x 3 (BGR)
+    ou N x H x W (cinza). Retorna um array N x 2016 uint8.
+    Frames com 240 linhas perdem as 16 de baixo. Cada frame é reduzido
+    direto no array de saída e o corte dos pixels escuros é uma única
+    operação no lote. A redução é frame a frame porque o `cv2.resize` de
+    vários frames como canais de uma imagem não dá o mesmo resultado, e
+    converter a pilha inteira para cinza de uma vez é mais lento que
+    frame a frame, que fica no cache do processador."""
+    lote = numpy.empty((len(frames), ALTURA_REDUZIDA, LARGURA_REDUZIDA), numpy.uint8)
+    for frame, saida in zip(frames, lote):
+        _reduzir(frame, saida)
+    lote[lote <= 40] = 0
+    return lote.reshape(len(frames), -1)
+
+def lerYaml(caminho):
+    """Lê um arquivo yaml, retornando um dicionário vazio se não existir"""
+    if not os.path.isfile(caminho):
+        return {}
+    return yaml.safe_load(open(caminho, "r").read()) or {}
+
+def gravarAtomico(caminho, escrever):
+    """Escreve em um arquivo temporário e o move para `caminho`, para que
+    uma interrupção nunca deixe o arquivo pela metade"""
+    temporario = caminho + ".tmp"
+    with open(temporario, "wb") as arquivo:
+        escrever(arquivo)
+    os.replace(temporario, caminho)
@@ -0,0 +1,228 @@
+"""
+duplicatas.py
+
+Índice de janelas quase repetidas, dentro de um video e entre videos.
+
+Cada frame pré-processado (42 x 48, os 2016 bytes de `preprocessar`)
+recebe um hash perceptual de 64 bits (dHash): o frame é reduzido para
+9 x 8 pela média das áreas e cada bit diz se um pixel é mais claro que
+o vizinho da direita. Frames quase iguais (pausas, telas de chefe,
+personagem parado) ficam a poucos bits de distância.
+
+Uma janela de `time_steps` frames é descrita pelos hashes de todos os
+seus frames e pelo seu rótulo. Ela é quase repetida se o índice já tem
+uma janela com o mesmo rótulo e com cada hash a no máximo `limiar` bits
+do hash do frame correspondente dela; janelas que só começam e terminam
+iguais (um salto e a volta à mesma pose) não são repetidas, e janelas
+com rótulos diferentes nunca são. A busca é por LSH em bandas: o hash
+do último frame é dividido em `limiar + 1` bandas e, pelo princípio da
+casa dos pombos, duas janelas a até `limiar` bits de distância têm pelo
+menos uma banda igual. Só as janelas novas entram no índice, primeiro como pendentes:
+elas já contam como vistas, mas só são gravadas depois de `confirmar`,
+chamado quando o batch delas foi treinado. Um batch interrompido tem as
+suas janelas descartadas e, ao retomar, elas ainda são novas.
+
+O índice é gravado em um `.npz` e continua de um treinamento para o
+outro, então as salas que se repetem entre videos também são achadas.
+
+Uso:
+    python3 -m megaman_ai.duplicatas resumo <arquivo>
+        Mostra quantas janelas o índice tem, por rótulo.
+"""
+
+from sys import argv
+import os
+import cv2
+import numpy
+
+from .comuns import sttinf, gravarAtomico
+
+# quantidade de bits 1 de cada byte
+POPCOUNT = numpy.array([bin(i).count("1") for i in range(256)], numpy.uint8)
+# forma do frame pré-processado
+ALTURA = 42
+LARGURA = 48
+# valor de cada bit do dHash, o primeiro é o mais significativo
+VALORES_BITS = numpy.uint64(1) << numpy.arange(63, -1, -1, dtype=numpy.uint64)
+
+def hashPerceptual(frames):
+    """dHash de 64 bits (uint64) de cada frame de uma pilha N x 2016"""
+    frames = numpy.asarray(frames, numpy.uint8).reshape(-1, ALTURA, LARGURA)
+    if len(frames) == 0:
+        return numpy.zeros(0, numpy.uint64)
+
+    # frame a frame: 42 x 48 para 9 x 8 não é uma redução inteira e o
+    # opencv não a faz em imagens com mais de 4 canais
+    reduzidos = numpy.empty((len(frames), 8, 9), numpy.uint8)
+    for frame, saida in zip(frames, reduzidos):
+        cv2.resize(frame, (9, 8), saida, interpolation=cv2.INTER_AREA)
+    reduzidos = reduzidos.astype(numpy.int16)
+
+    bits = reduzidos[:, :, 1:] > reduzidos[:, :, :-1]
+    return bits.reshape(len(frames), 64).astype(numpy.uint64) @ VALORES_BITS
+
+def distancia(a, b):
+    """Quantidade de bits diferentes entre hashes (ou arrays de hashes)"""
+    diferentes = numpy.atleast_1d(numpy.bitwise_xor(numpy.asarray(a, numpy.uint64), numpy.asarray(b, numpy.uint64)))
+    return POPCOUNT[diferentes.view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+
+class IndiceDuplicatas:
+    """Janelas de `time_steps` frames já vistas. Com `caminho` o índice é
+    lido de lá, se existir, e gravado lá por `salvar`; sem `time_steps`
+    vale o do arquivo. As janelas de `adicionar` ficam pendentes até
+    `confirmar` ou `descartar`."""
+
+    def __init__(self, caminho="", limiar=3, time_steps=None):
+        self.caminho = caminho
+        self.limiar = limiar
+        # pelo menos duas bandas, para que a chave caiba em 64 bits
+        self.bandas = max(2, limiar + 1)
+        largura = 64 // self.bandas
+        self._bandas = [(i * largura, largura if i < self.bandas - 1 else 64 - i * largura)
+            for i in range(self.bandas)]
+        # janelas confirmadas e, depois delas nos arrays, as pendentes
+        self.quantidade = 0
+        self.pendentes = 0
+        self.rotulos = numpy.zeros(1024, numpy.uint8)
+        # por banda: chaves ordenadas das janelas consolidadas e os seus
+        # ids, e as janelas novas desde a última consolidação
+        self._chaves = [numpy.zeros(0, numpy.uint64) for _ in self._bandas]
+        self._ids = [numpy.zeros(0, numpy.int64) for _ in self._bandas]
+        self._recentes = [{} for _ in self._bandas]
+
+        if len(caminho) > 0 and os.path.isfile(caminho):
+            with numpy.load(caminho) as dados:
+                if not "hashes" in dados:
+                    raise ValueError("{} não tem os hashes de todos os frames das janelas, "
+                        "apague-o para criar um novo".format(caminho))
+                self.hashes = dados["hashes"].copy()
+                self.rotulos = dados["rotulos"].copy()
+            if time_steps is not None and self.hashes.shape[1] != time_steps:
+                raise ValueError("{} tem janelas de {} frames, não de {}".format(
+                    caminho, self.hashes.shape[1], time_steps))
+            self.quantidade = len(self.rotulos)
+            self._ordenar()
+        elif time_steps is None:
+            raise ValueError("Um índice novo precisa de time_steps")
+        else:
+            self.hashes = numpy.zeros((1024, time_steps), numpy.uint64)
+        self.time_steps = self.hashes.shape[1]
+
+    def _chavesBandas(self, ultimos, rotulos):
+        """Chave de cada banda (bandas x N): valor da banda e rótulo"""
+        ultimos = numpy.asarray(ultimos, numpy.uint64)
+        rotulos = numpy.asarray(rotulos, numpy.uint64)
+        return numpy.array([((ultimos >> numpy.uint64(inicio)) & numpy.uint64((1 << largura) - 1))
+            << numpy.uint64(8) | rotulos for inicio, largura in self._bandas])
+
+    def _ordenar(self):
+        """Consolida as janelas confirmadas nas chaves ordenadas de cada
+        banda; as pendentes continuam nas recentes"""
+        chaves = self._chavesBandas(self.hashes[:self.quantidade, -1], self.rotulos[:self.quantidade])
+        for banda in range(self.bandas):
+            ordem = numpy.argsort(chaves[banda], kind="stable")
+            self._chaves[banda] = chaves[banda][ordem]
+            self._ids[banda] = ordem.astype(numpy.int64)
+            self._recentes[banda] = {}
+        for i in range(self.quantidade, self.quantidade + self.pendentes):
+            self._lembrar(i)
+
+    def _lembrar(self, i):
+        """Coloca a janela `i` nas recentes de cada banda"""
+        for banda, chave in enumerate(self._chavesBandas([self.hashes[i, -1]], [self.rotulos[i]])[:, 0]):
+            self._recentes[banda].setdefault(int(chave), []).append(i)
+
+    def repetida(self, hashes, rotulo):
+        """Se o índice já tem uma janela quase igual, frame a frame, à dos
+        `hashes` com o mesmo rótulo"""
+        candidatos = []
+        for banda, chave in enumerate(self._chavesBandas([hashes[-1]], [rotulo])[:, 0]):
+            inicio = numpy.searchsorted(self._chaves[banda], chave, "left")
+            fim = numpy.searchsorted(self._chaves[banda], chave, "right")
+            candidatos.extend(self._ids[banda][inicio:fim])
+            candidatos.extend(self._recentes[banda].get(int(chave), ()))
+        if len(candidatos) == 0:
+            return False
+        candidatos = numpy.unique(candidatos)
+        perto = distancia(self.hashes[candidatos], hashes).reshape(len(candidatos), -1) <= self.limiar
+        return bool(perto.all(axis=1).any())
+
+    def adicionar(self, hashes, rotulo):
+        """Acrescenta uma janela pendente"""
+        if self.quantidade + self.pendentes == len(self.rotulos):
+            for nome in ("hashes", "rotulos"):
+                atual = getattr(self, nome)
+                extra = numpy.zeros((max(1024, len(atual)),) + atual.shape[1:], atual.dtype)
+                setattr(self, nome, numpy.concatenate([atual, extra]))
+        i = self.quantidade + self.pendentes
+        self.hashes[i], self.rotulos[i] = hashes, rotulo
+        self.pendentes += 1
+        self._lembrar(i)
+
+    def confirmar(self):
+        """As janelas pendentes passam a ser gravadas por `salvar`"""
+        self.quantidade += self.pendentes
+        self.pendentes = 0
+
+    def descartar(self):
+        """Esquece as janelas pendentes"""
+        if self.pendentes == 0:
+            return
+        self.pendentes = 0
+        for recentes in self._recentes:
+            for chave in list(recentes):
+                recentes[chave] = [i for i in recentes[chave] if i < self.quantidade]
+                if len(recentes[chave]) == 0:
+                    del recentes[chave]
+
+    def salvar(self):
+        """Grava as janelas confirmadas"""
+        self._ordenar()
+        if len(self.caminho) == 0:
+            return
+        n = self.quantidade
+        gravarAtomico(self.caminho, lambda arquivo: numpy.savez(arquivo,
+            hashes=self.hashes[:n], rotulos=self.rotulos[:n]))
+
+def pesosJanelas(indice, frames, rotulos, time_steps, peso=0.0):
+    """Peso de cada janela de um batch (a janela j são os frames
+    [j, j+time_steps) e o seu rótulo é o do frame j+time_steps, como em
+    `treinamento.montarJanelas`): 1 para as janelas novas, que entram no
+    índice como pendentes, e `peso` para as quase repetidas (0 as remove). Se todas as
+    janelas de um rótulo do batch forem repetidas, a primeira é mantida,
+    para o batch não perder a cobertura daquele rótulo."""
+    quantidade = max(0, len(frames) - time_steps)
+    hashes = hashPerceptual(frames)
+    rotulos = numpy.asarray(rotulos)
+    pesos = numpy.ones(quantidade, numpy.float32)
+
+    for j in range(quantidade):
+        janela, rotulo = hashes[j:j + time_steps], int(rotulos[j + time_steps])
+        if indice.repetida(janela, rotulo):
+            pesos[j] = peso
+        else:
+            indice.adicionar(janela, rotulo)
+
+    rotulosJanelas = rotulos[time_steps:time_steps + quantidade]
+    for rotulo in numpy.unique(rotulosJanelas):
+        janelas = numpy.flatnonzero(rotulosJanelas == rotulo)
+        if (pesos[janelas] < 1).all():
+            pesos[janelas[0]] = 1
+    return pesos
+
+def resumo(caminho):
+    indice = IndiceDuplicatas(caminho)
+    print("[{}] {}: {} janelas de {} frames".format(sttinf, caminho, indice.quantidade, indice.time_steps))
+    rotulos, quantidades = numpy.unique(indice.rotulos[:indice.quantidade], return_counts=True)
+    for rotulo, quantidade in zip(rotulos, quantidades):
+        print("[{}] rótulo {:3}: {} janelas".format(sttinf, rotulo, quantidade))
+
+COMANDOS = {
+    "resumo": resumo,
+}
+
+if __name__ == "__main__":
+    if len(argv) < 2 or not argv[1] in COMANDOS:
+        print(__doc__)
+        exit(3)
+    COMANDOS[argv[1]](*argv[2:])
@@ -0,0 +1,103 @@
+"""
+exportar.py
+
+Exporta um modelo de `modelos/` para o artefato de inferência em numpy
+usado pelo modo jogar com `--artefato`, que não precisa do keras nem do
+tensorflow. Os kernels podem ser gravados em float32, float16 ou int8.
+
+Uso:
+    python3 -m megaman_ai.exportar <nome> [float32|float16|int8] [video] [amostras] [fps] [sprites] [time_steps]
+        Grava modelos/<nome>.<precisao>.npz (padrão int8). Com um video,
+        rotula até `amostras` frames (padrão 500, usando o cache de
+        rótulos) e compara a acurácia e as decisões do artefato com as
+        do modelo original nas mesmas janelas de `time_steps` frames
+        (padrão o mesmo do modo jogar, 10), o valor gravado no artefato.
+"""
+
+from sys import argv
+import os
+import cv2
+import numpy
+import yaml
+
+from . import visao, inteligencia
+from .cache import CacheRotulos
+from .comuns import sttinf, sttwrn, preprocessar
+from .inferencia import camadasDoKeras, salvarArtefato, MotorInferencia, PRECISOES
+from .parametros import Parametros
+from .video import LeitorAmostrado
+
+def amostraRotulada(video, quantidade, fps, sprites):
+    """Frames pré-processados e rótulos das primeiras `quantidade`
+    amostras do video. Como no treinamento, o frame i recebe o rótulo
+    do frame i+1."""
+    banco = visao.BancoSprites(yaml.safe_load(open(sprites).read()))
+    leitor = LeitorAmostrado(video, fps)
+    cache = CacheRotulos(video, banco, fps, leitor.total)
+    vis = visao.MegaMan(banco)
+    frames, rotulos = [], []
+    anterior = None
+
+    while len(frames) < quantidade:
+        amostra = leitor.amostra
+        frame = leitor.ler()
+        if frame is None:
+            break
+        frame = cv2.resize(frame, (256, 240))[:-16,:]
+        rotulo = cache.rotular(vis, amostra, frame)
+        if anterior is not None:
+            frames.append(anterior)
+            rotulos.append(rotulo)
+        anterior = preprocessar(frame)
+
+    leitor.fechar()
+    cache.salvar()
+    return numpy.array(frames), numpy.array(rotulos)
+
+def desvio(caminho, frames, rotulos, time_steps):
+    """Compara o artefato com o modelo carregado nas janelas que o modo
+    jogar veria, começando com frames zerados"""
+    completos = numpy.concatenate([numpy.zeros((time_steps-1, frames.shape[1]), numpy.float32), frames / 255.0])
+    janelas = completos[numpy.arange(len(frames))[:, numpy.newaxis] + numpy.arange(time_steps)]
+    original = inteligencia.modelo.predict(janelas, batch_size=256)
+
+    motor = MotorInferencia.doArtefato(caminho, time_steps)
+    artefato = numpy.array([motor.passo(frame) for frame in frames])
+
+    classesOriginal = original.argmax(axis=1)
+    classesArtefato = artefato.argmax(axis=1)
+    print("[{}] Amostras rotuladas: {}".format(sttinf, len(frames)))
+    print("[{}] Acurácia original: {:6.2f}% | artefato: {:6.2f}%".format(sttinf,
+        100*(classesOriginal == rotulos).mean(), 100*(classesArtefato == rotulos).mean()))
+    print("[{}] Mesma decisão em {:6.2f}% | diferença máxima de probabilidade {:.2e}".format(sttinf,
+        100*(classesOriginal == classesArtefato).mean(), numpy.abs(original - artefato).max()))
+
+def exportar(nome, precisao="int8", video="", amostras=500, fps=30, sprites="megaman.yaml",
+        time_steps=Parametros.time_steps):
+    if not precisao in PRECISOES:
+        print("[{}] Precisão {} inválida, use {}".format(sttwrn, precisao, "|".join(PRECISOES)))
+        exit(3)
+
+    inteligencia.carregar(nome)
+    time_steps = int(time_steps)
+    # um modelo com a dimensão do tempo fixa só aceita as suas janelas
+    fixo = inteligencia.modelo.input_shape[1]
+    if fixo is not None and fixo != time_steps:
+        print("[{}] O modelo usa janelas de {} frames, não {}".format(sttwrn, fixo, time_steps))
+        time_steps = fixo
+    caminho = "modelos/{}.{}.npz".format(nome, precisao)
+    salvarArtefato(camadasDoKeras(inteligencia.modelo), caminho, precisao,
+        {"nome": nome, "time_steps": time_steps})
+    print("[{}] {} ({:.1f} MB) -> {} ({:.1f} MB)".format(sttinf,
+        inteligencia._caminho, os.path.getsize(inteligencia._caminho) / 2**20,
+        caminho, os.path.getsize(caminho) / 2**20))
+
+    if len(video) > 0:
+        frames, rotulos = amostraRotulada(video, int(amostras), int(fps), sprites)
+        desvio(caminho, frames, rotulos, time_steps)
+
+if __name__ == "__main__":
+    if len(argv) < 2:
+        print(__doc__)
+        exit(3)
+    exportar(*argv[1:])
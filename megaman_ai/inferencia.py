@@ -0,0 +1,312 @@
+"""
+inferencia.py
+
+Inferência em numpy, para o modo jogar, dos modelos Sequential de
+LSTM, Dense e Dropout (como os de `exemplo.py` e `nova.py`), a partir
+dos mesmos pesos do `.h5`.
+
+A cada decisão só o frame novo entra no motor:
+    "janela": resultado igual ao `predict` sobre os últimos `time_steps`
+        frames. A projeção da entrada da primeira LSTM (a parte mais cara,
+        2016 x 4*unidades) é calculada uma vez por frame e guardada em uma
+        janela pré-alocada; só a recorrência é refeita sobre a janela.
+    "estado": mantém o estado (h, c) de cada LSTM entre as decisões e faz
+        um único passo por frame. É o mais rápido, mas a rede vê o histórico
+        inteiro em vez de janelas de `time_steps`, como no treinamento.
+
+Com `instancias` o motor acompanha vários jogos ao mesmo tempo: recebe um
+frame de cada jogo por passo e calcula todas as decisões em lote.
+
+Os pesos também podem vir de um artefato `.npz` gerado por `exportar.py`,
+com as matrizes em float32, float16 ou int8 (com uma escala por coluna),
+sem precisar do keras nem do tensorflow.
+"""
+
+import json
+import numpy
+
+def _sigmoid(x):
+    return 1 / (1 + numpy.exp(-x))
+
+def _softmax(x):
+    e = numpy.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+ATIVACOES = {
+    "linear": lambda x: x,
+    "tanh": numpy.tanh,
+    "sigmoid": _sigmoid,
+    "hard_sigmoid": lambda x: numpy.clip(0.2*x + 0.5, 0, 1),
+    "relu": lambda x: numpy.maximum(x, 0),
+    "softmax": _softmax,
+}
+
+def _ativacao(nome):
+    # o keras 3 serializa a ativação como dicionário
+    if isinstance(nome, dict):
+        nome = nome.get("config", {}).get("name", nome.get("class_name"))
+    if not nome in ATIVACOES:
+        raise ValueError("Ativação {} não suportada".format(nome))
+    return nome
+
+class JanelaDeslizante:
+    """Últimas `tamanho` linhas no formato `forma` (um número de valores
+    ou uma tupla) em um buffer pré-alocado. Cada linha é escrita em duas
+    posições, então a janela, da mais antiga para a mais nova, é sempre
+    uma view contígua."""
+
+    def __init__(self, tamanho, forma, inicial=None):
+        self.tamanho = tamanho
+        if isinstance(forma, int):
+            forma = (forma,)
+        self._dados = numpy.zeros((2*tamanho,) + tuple(forma), numpy.float32)
+        if inicial is not None:
+            self._dados[:] = inicial
+        self._posicao = 0
+
+    def acrescentar(self, linha):
+        self._dados[self._posicao] = linha
+        self._dados[self._posicao + self.tamanho] = linha
+        self._posicao = (self._posicao + 1) % self.tamanho
+
+    def janela(self):
+        return self._dados[self._posicao:self._posicao + self.tamanho]
+
+class CamadaLSTM:
+    """LSTM do keras: portas na ordem i, f, c, o"""
+
+    def __init__(self, kernel, recorrente, bias, ativacao="tanh",
+            ativacaoRecorrente="sigmoid", sequencias=False):
+        self.kernel = numpy.asarray(kernel, numpy.float32)
+        self.recorrente = numpy.asarray(recorrente, numpy.float32)
+        self.bias = numpy.asarray(bias, numpy.float32)
+        self.unidades = self.recorrente.shape[0]
+        self.ativacao = _ativacao(ativacao)
+        self.ativacaoRecorrente = _ativacao(ativacaoRecorrente)
+        self.sequencias = sequencias
+
+    def projetar(self, x):
+        """Parte da pré-ativação que só depende da entrada"""
+        return x @ self.kernel + self.bias
+
+    def estadoInicial(self, lote=()):
+        forma = tuple(lote) + (self.unidades,)
+        return numpy.zeros(forma, numpy.float32), numpy.zeros(forma, numpy.float32)
+
+    def passo(self, projecao, h, c):
+        u = self.unidades
+        ativacao = ATIVACOES[self.ativacao]
+        recorrente = ATIVACOES[self.ativacaoRecorrente]
+        z = projecao + h @ self.recorrente
+        i = recorrente(z[..., :u])
+        f = recorrente(z[..., u:2*u])
+        o = recorrente(z[..., 3*u:])
+        c = f * c + i * ativacao(z[..., 2*u:3*u])
+        return o * ativacao(c), c
+
+    def sequencia(self, projecoes):
+        """Roda a camada a partir do estado zero sobre uma sequência de
+        projeções (tempo no primeiro eixo); retorna todas as saídas ou
+        só a última"""
+        h, c = self.estadoInicial(projecoes.shape[1:-1])
+        saidas = []
+        for projecao in projecoes:
+            h, c = self.passo(projecao, h, c)
+            saidas.append(h)
+        return numpy.array(saidas) if self.sequencias else h
+
+class CamadaDensa:
+
+    def __init__(self, kernel, bias, ativacao="linear"):
+        self.kernel = numpy.asarray(kernel, numpy.float32)
+        self.bias = numpy.asarray(bias, numpy.float32)
+        self.ativacao = _ativacao(ativacao)
+
+    def aplicar(self, x):
+        return ATIVACOES[self.ativacao](x @ self.kernel + self.bias)
+
+def camadasDoKeras(modelo):
+    """Camadas do motor com os pesos de um modelo keras carregado"""
+    camadas = []
+    for camada in modelo.layers:
+        tipo = type(camada).__name__
+        config = camada.get_config()
+        pesos = camada.get_weights()
+        if tipo == "Dropout":
+            continue
+        elif tipo == "LSTM":
+            if config.get("go_backwards") or config.get("stateful"):
+                raise ValueError("LSTM {} não suportada".format(camada.name))
+            bias = pesos[2] if config.get("use_bias", True) else numpy.zeros(pesos[0].shape[1])
+            camadas.append(CamadaLSTM(pesos[0], pesos[1], bias, config["activation"],
+                config["recurrent_activation"], config["return_sequences"]))
+        elif tipo == "Dense":
+            bias = pesos[1] if config.get("use_bias", True) else numpy.zeros(pesos[0].shape[1])
+            camadas.append(CamadaDensa(pesos[0], bias, config["activation"]))
+        else:
+            raise ValueError("Camada {} ({}) não suportada".format(camada.name, tipo))
+    return camadas
+
+PRECISOES = ("float32", "float16", "int8")
+
+def quantizar(matriz, precisao):
+    """Matriz na precisão do artefato e a escala de cada coluna (int8)"""
+    matriz = numpy.asarray(matriz, numpy.float32)
+    if precisao == "int8":
+        escala = numpy.abs(matriz).max(axis=0) / 127
+        escala[escala == 0] = 1
+        return numpy.round(matriz / escala).clip(-127, 127).astype(numpy.int8), escala.astype(numpy.float32)
+    return matriz.astype(precisao), None
+
+def dequantizar(matriz, escala=None):
+    if escala is not None:
+        return matriz.astype(numpy.float32) * escala
+    return matriz.astype(numpy.float32)
+
+def salvarArtefato(camadas, caminho, precisao="float32", informacoes={}):
+    """Grava as camadas em um `.npz`, em `caminho` ou em um arquivo já
+    aberto. Os kernels vão na `precisao` escolhida e os bias sempre em
+    float32."""
+    if not precisao in PRECISOES:
+        raise ValueError("Precisão {} inválida".format(precisao))
+    arrays = {}
+    descricao = []
+    for i, camada in enumerate(camadas):
+        if isinstance(camada, CamadaLSTM):
+            descricao.append({"tipo": "lstm", "ativacao": camada.ativacao,
+                "ativacaoRecorrente": camada.ativacaoRecorrente, "sequencias": bool(camada.sequencias)})
+            matrizes = {"kernel": camada.kernel, "recorrente": camada.recorrente}
+        else:
+            descricao.append({"tipo": "densa", "ativacao": camada.ativacao})
+            matrizes = {"kernel": camada.kernel}
+        for nome, matriz in matrizes.items():
+            arrays["{}_{}".format(i, nome)], escala = quantizar(matriz, precisao)
+            if escala is not None:
+                arrays["{}_{}_escala".format(i, nome)] = escala
+        arrays["{}_bias".format(i)] = camada.bias
+    meta = dict(informacoes, precisao=precisao, camadas=descricao)
+    if hasattr(caminho, "write"):
+        numpy.savez_compressed(caminho, meta=numpy.array(json.dumps(meta)), **arrays)
+        return
+    with open(caminho, "wb") as arquivo:
+        numpy.savez_compressed(arquivo, meta=numpy.array(json.dumps(meta)), **arrays)
+
+def carregarArtefato(caminho):
+    """Camadas em float32 a partir de um artefato de `salvarArtefato`
+    (caminho ou arquivo aberto)"""
+    camadas = []
+    with numpy.load(caminho) as artefato:
+        meta = json.loads(str(artefato["meta"]))
+        def matriz(i, nome):
+            chave = "{}_{}".format(i, nome)
+            escala = artefato[chave + "_escala"] if chave + "_escala" in artefato.files else None
+            return dequantizar(artefato[chave], escala)
+
+        for i, descricao in enumerate(meta["camadas"]):
+            bias = artefato["{}_bias".format(i)]
+            if descricao["tipo"] == "lstm":
+                camadas.append(CamadaLSTM(matriz(i, "kernel"), matriz(i, "recorrente"), bias,
+                    descricao["ativacao"], descricao["ativacaoRecorrente"], descricao["sequencias"]))
+            else:
+                camadas.append(CamadaDensa(matriz(i, "kernel"), bias, descricao["ativacao"]))
+    return camadas
+
+class MotorInferencia:
+    """Executa as camadas frame a frame no `modo` "janela" ou "estado".
+    Com `instancias` cada passo recebe N frames (N x 2016), um por jogo,
+    e retorna N x classes."""
+
+    def __init__(self, camadas, time_steps, modo="janela", instancias=None):
+        if len(camadas) == 0 or not isinstance(camadas[0], CamadaLSTM):
+            raise ValueError("A primeira camada do modelo deve ser uma LSTM")
+        if not modo in ("janela", "estado"):
+            raise ValueError("Modo de inferência {} inválido".format(modo))
+        self.camadas = camadas
+        self.time_steps = time_steps
+        self.modo = modo
+        self._lote = () if instancias is None else (instancias,)
+        self.reiniciar()
+
+    @staticmethod
+    def doKeras(modelo, time_steps, modo="janela", instancias=None):
+        """Monta o motor com os pesos de um modelo keras carregado"""
+        return MotorInferencia(camadasDoKeras(modelo), time_steps, modo, instancias)
+
+    @staticmethod
+    def doArtefato(caminho, time_steps, modo="janela", instancias=None):
+        """Monta o motor com os pesos de um artefato de `exportar.py`"""
+        return MotorInferencia(carregarArtefato(caminho), time_steps, modo, instancias)
+
+    def reiniciar(self):
+        """Volta ao começo do jogo: janela de frames zerados, como a
+        memória inicial do `Jogo`, e estados zerados"""
+        primeira = self.camadas[0]
+        # a projeção de um frame zerado é o próprio bias
+        self._projecoes = JanelaDeslizante(self.time_steps,
+            self._lote + (4*primeira.unidades,), primeira.bias)
+        self._estados = [c.estadoInicial(self._lote) if isinstance(c, CamadaLSTM) else None
+            for c in self.camadas]
+        self._saida = None
+
+    def acrescentar(self, frame):
+        """Recebe o frame novo (2016 bytes, saída de `preprocessar`).
+        Frames acrescentados sem `decidir` entre eles continuam no histórico."""
+        x = (frame / 255.0).astype(numpy.float32)
+        saida = self.camadas[0].projetar(x)
+
+        if self.modo == "janela":
+            self._projecoes.acrescentar(saida)
+            return
+
+        for i, camada in enumerate(self.camadas):
+            if isinstance(camada, CamadaLSTM):
+                if i > 0:
+                    saida = camada.projetar(saida)
+                h, c = camada.passo(saida, *self._estados[i])
+                self._estados[i] = (h, c)
+                saida = h
+            else:
+                saida = camada.aplicar(saida)
+        self._saida = saida
+
+    def passo(self, frame):
+        """Acrescenta o frame e retorna as probabilidades de cada classe"""
+        self.acrescentar(frame)
+        return self.decidir()
+
+    def decidir(self):
+        """Probabilidades de cada classe para os frames acrescentados até agora"""
+        if self.modo == "estado":
+            return self._saida
+
+        saida = self.camadas[0].sequencia(self._projecoes.janela())
+        for camada in self.camadas[1:]:
+            if isinstance(camada, CamadaLSTM):
+                saida = camada.sequencia(camada.projetar(saida))
+            else:
+                saida = camada.aplicar(saida)
+        return saida
+
+class PreditorKeras:
+    """Mesma interface do `MotorInferencia` usando o `predict` do keras
+    sobre a janela dos últimos `time_steps` frames. Com `instancias` as
+    janelas de todos os jogos vão em uma única chamada do `predict`."""
+
+    def __init__(self, modelo, time_steps, instancias=None):
+        self.modelo = modelo
+        self.instancias = instancias
+        # começa com frames zerados, como a memória inicial do `Jogo`
+        self._janela = JanelaDeslizante(time_steps, 2016 if instancias is None else (instancias, 2016))
+
+    def acrescentar(self, frame):
+        self._janela.acrescentar(frame / 255.0)
+
+    def decidir(self):
+        if self.instancias is None:
+            return self.modelo.predict(self._janela.janela()[numpy.newaxis])[0]
+        # tempo x jogos x 2016 -> jogos x tempo x 2016
+        return self.modelo.predict(self._janela.janela().transpose(1, 0, 2))
+
+    def passo(self, frame):
+        self.acrescentar(frame)
+        return self.decidir()
@@ -1,7 +1,8 @@
 from os import path
+import os
 
-import tensorflow as tf
-import keras
+# o keras (e o tensorflow) só é importado em `carregar`, quando um modelo
+# é realmente usado
 
 # Variáveis globais
 _caminho = "modelos/" # caminho do arquivo modelo
@@ -11,11 +12,25 @@ def carregar(nome):
     """Carrega o modelo em caminho e atualiza o modelo carregado. Se o arquivo
      existe: Carrega o modele. Se não existe existe: Cria um novo modelo"""
     global modelo, _caminho
+    import keras
     _caminho += nome+".h5"
     modelo = keras.models.load_model(_caminho)
 
 def salvar():
-    """Salva o modelo carregado atualmente em aquivo"""
+    """Salva o modelo carregado atualmente em aquivo. O modelo é escrito
+    em um arquivo temporário e depois movido, para que uma interrupção
+    não corrompa o modelo salvo"""
     global modelo, _caminho
     
-    modelo.save(_caminho)
+    temporario = _caminho[:-3] + ".tmp.h5"
+    modelo.save(temporario)
+    os.replace(temporario, _caminho)
+
+def estadoOtimizador():
+    """Resumo do estado do otimizador salvo junto com o modelo"""
+    global modelo
+    try:
+        iteracoes = int(modelo.optimizer.iterations.numpy())
+    except AttributeError:
+        iteracoes = None
+    return {"nome": type(modelo.optimizer).__name__, "iteracoes": iteracoes}
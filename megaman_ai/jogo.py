@@ -1,4 +1,6 @@
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import subprocess
 import shlex
 import time
@@ -8,8 +10,14 @@ import os
 import cv2
 import numpy
 import yaml
-from .comuns import sttinf, sttwrn, mm_resize
-from . import inteligencia, visao
+from .comuns import sttinf, sttwrn, preprocessar, preprocessarLote
+from . import inteligencia, visao, protocolo
+from . import anel
+from .anel import AnelFrames
+from .inferencia import MotorInferencia, PreditorKeras
+from .servico import preditorDoServico
+from .pipeline import PipelineJogo
+from . import perfil
 
 class Jogo:
 
@@ -22,7 +30,29 @@ class Jogo:
         script_lua = kwargs.get("fceux_script", "lua/server.lua")
         self.fceux_script = os.path.abspath(script_lua)
         self.time_steps = time_steps
-        self._emulador = Thread(target=self._iniciarEmulador)
+        self.transporte = kwargs.get("transporte", "binario")
+        self.inferencia = kwargs.get("inferencia", "janela")
+        # artefato do `exportar.py`, usado no lugar do modelo keras
+        self.artefato = kwargs.get("artefato", "")
+        # nome do modelo no `servico.py`, usado no lugar do carregado aqui
+        self.servico = kwargs.get("servico", "")
+        self.pipeline = kwargs.get("pipeline", False)
+        self.orcamento = kwargs.get("orcamento_ms", 50)
+        self.porta = kwargs.get("porta", 4321)
+        # sem emulador o jogo conecta em um servidor já em execução
+        # (como o `servidor.py`) e sem tela não abre janelas
+        self.tela = kwargs.get("tela", True)
+        # mostra cada decisão; o print sai do laço principal, fora dos
+        # estágios cronometrados
+        self.verboso = kwargs.get("verboso", False)
+        self.ultimaDecisao = None
+        # tempos de cada estágio, no perfil do processo
+        self.tempos = perfil.atual
+        self.decisoes = 0
+        self.duracao = 0
+        self._receptor = None
+        self._anel = None
+        self._emulador = Thread(target=self._iniciarEmulador) if kwargs.get("emulador", True) else None
         self._conexao = None
         self._conectado = False
         self._caminhoFrame = "/tmp/.megamanAI.screen"
@@ -33,114 +63,234 @@ class Jogo:
         self.repeticoesB = 0
 
     def iniciar(self):
-        # inicia o emulador
-        self._emulador.start()
-        print("[{}] Emulador iniciado".format(sttinf))
-
-        # conecta ao emulador
-        self._conectar()
-        
-        if not self._conectado:
-            print("[{}] Não foi possivel conectar com o emulador!".format(sttwrn))
+        if not self._preparar():
             return
         
         print("[{}] Iniciando modo jogar".format(sttinf))
+        inicio = time.perf_counter()
         
         try:
             # executa a função jogar
-            self._jogar()
+            if self.pipeline:
+                self._jogarPipeline()
+            else:
+                self._jogar()
         except Exception as erro:
             print("[{}] Execução finalizada ({})!".format(sttwrn, erro))
+
+        self.duracao = time.perf_counter() - inicio
+        self._finalizar()
+
+    def _preparar(self):
+        """Cria o anel, inicia o emulador e conecta. Retorna se conectou."""
+        # o anel precisa existir antes do script lua abri-lo
+        if self.transporte == "memoria":
+            self._anel = AnelFrames.criar(anel.caminho(self.porta))
+
+        # inicia o emulador
+        if self._emulador is not None:
+            self._emulador.start()
+            print("[{}] Emulador iniciado".format(sttinf))
+
+        # conecta ao emulador
+        self._conectar()
         
+        if not self._conectado:
+            print("[{}] Não foi possivel conectar com o emulador!".format(sttwrn))
+        return self._conectado
+
+    def _finalizar(self):
         # verifica se o emulador continua ativo (caso tenha dado algum erro com o servidor)
-        if self._emulador.isAlive():
+        if self._emulador is not None and self._emulador.is_alive():
             print("[{}] Emulador continua ativo! main-(join)->emulador".format(sttwrn))
             # join no emulador
             self._emulador.join()
 
+        if self._anel is not None:
+            print("[{}] Frames pulados no anel: {}".format(sttinf, self._anel.pulados))
+            self._anel.fechar(remover=True)
+
         print("[{}] Fim modo jogo".format(sttwrn))
 
     def obterFrame(self):
         """Obtém o frame atual do emulador"""
-        
-        # Descarta frames desnecessários
-        for i in range(self._taxa_coleta):
-            self._conexao.recv(4096)
-            self._enviarComando(self._ultimo_comando)
-        
-        print("."*self._taxa_coleta)
-        
         try:
-            # Recebe uma mensagem de 'pode ler a tela'
-            self._conexao.recv(4096)
+            # Descarta frames desnecessários
+            for i in range(self._taxa_coleta):
+                self._receberFrame(descartar=True)
+                self._enviarComando(self._ultimo_comando)
             
-            # entra em loop tentando ler o arquivo de frame
-            frame = None
+            print("."*self._taxa_coleta)
             
-            while frame is None:
-                frame = cv2.imread(self._caminhoFrame)
-            
-            return frame
+            return self._receberFrame()
 
         except ConnectionResetError:
             print("[{}] Conexão fechada pelo servidor".format(sttwrn))
             self._conectado = False
 
+    def _receberFrame(self, descartar=False):
+        """Recebe o próximo frame pelo transporte configurado. Com
+        `descartar` o frame é consumido sem ser convertido ou lido."""
+        if self.transporte == "binario":
+            return self._receptor.receber(converter=not descartar)
+
+        if self.transporte == "memoria":
+            # o socket só traz o aviso; o frame é lido do anel sem cópia
+            protocolo.receberAviso(self._conexao)
+            if descartar:
+                return None
+            recente = self._anel.maisRecente()
+            return None if recente is None else recente[1]
+
+        # Recebe uma mensagem de 'pode ler a tela'
+        if len(self._conexao.recv(4096)) == 0:
+            raise ConnectionResetError("Conexão fechada")
+        if descartar:
+            return None
+        
+        # entra em loop tentando ler o arquivo de frame
+        frame = None
+        
+        while frame is None:
+            frame = cv2.imread(self._caminhoFrame)
+        
+        return frame
+
+    def _preditor(self):
+        """Recebe os frames novos pré-processados e retorna as
+        probabilidades de cada classe, segundo o modo de inferência"""
+        if len(self.artefato) > 0:
+            return MotorInferencia.doArtefato(self.artefato, self.time_steps, self.inferencia)
+        if len(self.servico) > 0:
+            return preditorDoServico(self.servico, self.time_steps, self.inferencia)
+        if self.inferencia != "keras":
+            return MotorInferencia.doKeras(inteligencia.modelo, self.time_steps, self.inferencia)
+        return PreditorKeras(inteligencia.modelo, self.time_steps)
+
+    def _emuladorAtivo(self):
+        """Sem emulador o jogo segue enquanto estiver conectado"""
+        return self._emulador is None or self._emulador.is_alive()
+
+    def _encerrar(self):
+        """Tecla 'q': fecha a tela e espera o emulador terminar"""
+        cv2.destroyAllWindows()
+        if self._emulador is None:
+            self._conectado = False
+        else:
+            self._emulador.join()
+
+    def _exibir(self, frame):
+        if not self.tela:
+            return
+        cv2.imshow("Jogo", cv2.resize(numpy.ascontiguousarray(frame), None, fx=2, fy=2, interpolation=cv2.INTER_NEAREST))
+
     def _jogar(self):
         """ Joga o game"""
-        mem = [numpy.zeros(2016) for _ in range(self.time_steps-1)]
+        preditor = self._preditor()
 
         # enquanto o emulador estiver ativo E conectado
-        while self._emulador.isAlive() and self._conectado:
+        while self._emuladorAtivo() and self._conectado:
 
-            while len(mem) < self.time_steps:
-                frame = self.obterFrame()
-                
-                cv2.imshow("Jogo", cv2.resize(frame, None, fx=2, fy=2, interpolation=cv2.INTER_NEAREST))
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            inicio = time.perf_counter()
+            frame = self.obterFrame()
+            chegada = time.perf_counter()
 
-                if not frame is None:
-                    mem.append(mm_resize(frame).flatten())
-            
-            acao = inteligencia.modelo.predict(numpy.array([mem])/255.0)
-            classe = numpy.argmax(acao[0])
-            
-            print("=> {:20.20}: {:06.2f}%".format(self.classes[classe], acao[0][classe]*100))
-            
-            comando = self.comandos[classe].copy()
-            
-            # trata o problema do 'A' pressionado infinitamente
-            if "A" in comando:
-                self.repeticoesA += 1    
-                if self.repeticoesA > 20:
-                    del comando["A"]
-                    self.repeticoesA = 0
-            else:
-                self.repeticoesA = 0
-            
-            # trata o problema do 'A' pressionado infinitamente
-            if "B" in comando:
-                self.repeticoesB += 1    
-                if self.repeticoesB > 5:
-                    del comando["B"]
-                    self.repeticoesB = 0
-            else:
-                self.repeticoesB = 0
+            if frame is None:
+                continue
+
+            self.tempos.registrar("aquisicao", chegada - inicio)
+            self._exibir(frame)
             
+            inicio = time.perf_counter()
+            frame = preprocessar(frame)
+            self.tempos.registrar("preprocessamento", time.perf_counter() - inicio)
+
+            inicio = time.perf_counter()
+            acao = preditor.passo(frame)
+            self.tempos.registrar("inferencia", time.perf_counter() - inicio)
+
+            comando = self._comandoDaAcao(acao)
             
             # envia o comando para o emulador
+            inicio = time.perf_counter()
             self._enviarComando(comando)
+            self.tempos.registrar("envio", time.perf_counter() - inicio)
+            self.tempos.registrar("decisao", time.perf_counter() - chegada)
+            self.tempos.contar("decisoes")
+            self.decisoes += 1
+            self._mostrarDecisao()
             
-            if (cv2.waitKey(1) & 0xFF) == ord('q'):
-                cv2.destroyAllWindows() 
-                self._emulador.join()
-            
-            del mem[0]
+            if self.tela and (cv2.waitKey(1) & 0xFF) == ord('q'):
+                self._encerrar()
+
+    def _jogarPipeline(self):
+        """Joga o game com os estágios em threads (veja `pipeline.py`).
+        Esta thread só mostra a tela e os tempos de tempos em tempos."""
+        pipeline = PipelineJogo(self, self._preditor(), self.orcamento)
+        pipeline.iniciar()
+        ultimoRelatorio = time.time()
+
+        try:
+            while self._emuladorAtivo() and self._conectado:
+                if pipeline.ultimoFrame is not None:
+                    self._exibir(pipeline.ultimoFrame)
+                self._mostrarDecisao()
+
+                if not self.tela:
+                    time.sleep(0.03)
+                elif (cv2.waitKey(30) & 0xFF) == ord('q'):
+                    self._encerrar()
+
+                if time.time() - ultimoRelatorio > 10:
+                    pipeline.exibir()
+                    ultimoRelatorio = time.time()
+        finally:
+            pipeline.parar()
+            pipeline.exibir()
+
+    def _comandoDaAcao(self, acao):
+        """Comando do joypad para as probabilidades de cada classe"""
+        classe = numpy.argmax(acao)
+        self.ultimaDecisao = (classe, acao[classe])
+        
+        comando = self.comandos[classe].copy()
+
+        # trata o problema do 'A' pressionado infinitamente
+        if "A" in comando:
+            self.repeticoesA += 1    
+            if self.repeticoesA > 20:
+                del comando["A"]
+                self.repeticoesA = 0
+        else:
+            self.repeticoesA = 0
+        
+        # trata o problema do 'A' pressionado infinitamente
+        if "B" in comando:
+            self.repeticoesB += 1    
+            if self.repeticoesB > 5:
+                del comando["B"]
+                self.repeticoesB = 0
+        else:
+            self.repeticoesB = 0
+
+        return comando
+
+    def _mostrarDecisao(self):
+        """Mostra a última decisão, se ainda não mostrada e em modo verboso"""
+        decisao, self.ultimaDecisao = self.ultimaDecisao, None
+        if self.verboso and decisao is not None:
+            classe, probabilidade = decisao
+            print("=> {:20.20}: {:06.2f}%".format(self.classes[classe], probabilidade*100))
 
     def _iniciarEmulador(self):
         """Inicia a thread do emulador com os parâmetros passados"""
 
         # define o comando
+        # o script lua escolhe o transporte e a porta pelas variáveis de ambiente
+        ambiente = dict(os.environ, MEGAMAN_TRANSPORTE=self.transporte, MEGAMAN_PORTA=str(self.porta))
+        if self._anel is not None:
+            ambiente["MEGAMAN_ANEL"] = self._anel.caminho
+
         comando = shlex.split("{fceux} --nogui {room} --xscale {escala} --yscale {escala} --loadlua {fceux_script}".format(
             fceux=self.fceux,
             room=self.room,
@@ -150,6 +300,7 @@ class Jogo:
         # executa, essa chamada trava a thread até o fim da execução
         processo = subprocess.run(
             comando,
+            env=ambiente,
             stderr=subprocess.DEVNULL,
             stdout=subprocess.DEVNULL)
 
@@ -165,14 +316,12 @@ class Jogo:
 
         while tentativas > 0:
             try:
-        
-                # Espera um tempinho para dar tempo de começar a executar o servidor
-                time.sleep(2)
 
                 # tenta se conectar
                 self._conexao = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self._conexao.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                self._conexao.connect(("127.0.0.1", 4321))
+                self._conexao.connect(("127.0.0.1", self.porta))
+                self._receptor = protocolo.ReceptorFrames(self._conexao)
                 
                 self._conectado = True
                 print("[{}] Conectado ao emulador".format(sttinf), end="")
@@ -182,6 +331,9 @@ class Jogo:
                 tentativas -= 1
                 print(".", end="")
         
+                # Espera um tempinho para dar tempo de começar a executar o servidor
+                time.sleep(2)
+        
         print("")
         
         if tentativas == 0:
@@ -224,4 +376,116 @@ class Jogo:
                 comandos.append(dict().fromkeys(comando, True))
             else:
                 comandos.append(dict().fromkeys(comando, True))
-        return comandos
\ No newline at end of file
+        return comandos
+
+class JogoMultiplo:
+    """Vários jogos, cada um com seu emulador (ou servidor) em uma porta,
+    jogados pela mesma rede. A cada passo um frame de cada jogo é lido,
+    os frames são pré-processados juntos e as decisões de todos saem de
+    uma única chamada da rede."""
+
+    def __init__(self, instancias, room, sprites, time_steps, **kwargs):
+        porta = kwargs.pop("porta", 4321)
+        portas = kwargs.pop("portas", None) or [porta + i for i in range(instancias)]
+        tela = kwargs.pop("tela", True)
+        kwargs.pop("pipeline", None)
+        self.time_steps = time_steps
+        self.inferencia = kwargs.get("inferencia", "janela")
+        self.artefato = kwargs.get("artefato", "")
+        self.servico = kwargs.get("servico", "")
+        # só o primeiro jogo mostra a tela
+        self.jogos = [Jogo(room, copy.deepcopy(sprites), time_steps, porta=p, tela=tela and i == 0, **kwargs)
+            for i, p in enumerate(portas)]
+        self.tempos = perfil.atual
+        self.decisoes = 0
+        self.duracao = 0
+
+    def iniciar(self):
+        conectados = [jogo._preparar() for jogo in self.jogos]
+        if not any(conectados):
+            print("[{}] Nenhum emulador conectado!".format(sttwrn))
+            return
+
+        print("[{}] Iniciando modo jogar com {} instâncias".format(sttinf, sum(conectados)))
+        inicio = time.perf_counter()
+
+        try:
+            self._jogar()
+        except Exception as erro:
+            print("[{}] Execução finalizada ({})!".format(sttwrn, erro))
+
+        self.duracao = time.perf_counter() - inicio
+        for jogo in self.jogos:
+            jogo._finalizar()
+        self.exibir()
+
+    def _preditor(self):
+        instancias = len(self.jogos)
+        if len(self.artefato) > 0:
+            return MotorInferencia.doArtefato(self.artefato, self.time_steps, self.inferencia, instancias)
+        if len(self.servico) > 0:
+            return preditorDoServico(self.servico, self.time_steps, self.inferencia, instancias)
+        if self.inferencia != "keras":
+            return MotorInferencia.doKeras(inteligencia.modelo, self.time_steps, self.inferencia, instancias)
+        return PreditorKeras(inteligencia.modelo, self.time_steps, instancias)
+
+    def _jogar(self):
+        preditor = self._preditor()
+        # a espera pelos sockets libera o GIL, então os frames dos jogos
+        # são lidos ao mesmo tempo
+        leitura = ThreadPoolExecutor(len(self.jogos))
+
+        while True:
+            ativos = [jogo._conectado and jogo._emuladorAtivo() for jogo in self.jogos]
+            if not any(ativos):
+                break
+
+            inicio = time.perf_counter()
+            frames = list(leitura.map(lambda jogo, ativo: jogo.obterFrame() if ativo else None,
+                self.jogos, ativos))
+            chegada = time.perf_counter()
+            lidos = [frame is not None for frame in frames]
+            if not any(lidos):
+                continue
+            self.tempos.registrar("aquisicao", chegada - inicio)
+
+            # jogos que pararam continuam no lote com uma tela preta
+            referencia = frames[lidos.index(True)]
+            frames = [frame if frame is not None else numpy.zeros_like(referencia) for frame in frames]
+
+            inicio = time.perf_counter()
+            lote = preprocessarLote(numpy.array(frames))
+            self.tempos.registrar("preprocessamento", time.perf_counter() - inicio)
+
+            inicio = time.perf_counter()
+            acoes = preditor.passo(lote)
+            self.tempos.registrar("inferencia", time.perf_counter() - inicio)
+
+            inicio = time.perf_counter()
+            for jogo, acao, lido in zip(self.jogos, acoes, lidos):
+                if lido:
+                    jogo._enviarComando(jogo._comandoDaAcao(acao))
+                    self.decisoes += 1
+                    self.tempos.contar("decisoes")
+            self.tempos.registrar("envio", time.perf_counter() - inicio)
+            self.tempos.registrar("decisao", time.perf_counter() - chegada)
+            for jogo in self.jogos:
+                jogo._mostrarDecisao()
+
+            principal = self.jogos[0]
+            if lidos[0]:
+                principal._exibir(frames[0])
+            if principal.tela and (cv2.waitKey(1) & 0xFF) == ord('q'):
+                for jogo in self.jogos:
+                    jogo._encerrar()
+
+        leitura.shutdown()
+
+    def exibir(self):
+        """Vazão somando todos os jogos e tempos de cada estágio"""
+        if self.duracao > 0:
+            passos = self.tempos.quantidade("inferencia")
+            print("[{}] {} instâncias | {} decisões em {:.2f} s: {:.1f} decisões/s ({:.1f} passos/s)".format(
+                sttinf, len(self.jogos), self.decisoes, self.duracao,
+                self.decisoes / self.duracao, passos / self.duracao))
+        self.tempos.exibir()
@@ -0,0 +1,213 @@
+"""
+paralelo.py
+
+Treinamento com paralelismo de dados em vários processos da mesma
+máquina.
+
+Cada trabalhador é um processo que carrega o modelo dentro de uma
+`tf.distribute.MultiWorkerMirroredStrategy`, com um cluster em localhost
+descrito pelo TF_CONFIG. Os frames rotulados de cada lote chegam por
+memória compartilhada; todos os trabalhadores montam as mesmas janelas,
+com a mesma semente de embaralhamento, e cada um calcula os gradientes
+de uma parte de cada batch. Os gradientes são somados entre eles a cada
+passo (all-reduce pelo gRPC em localhost), então os pesos continuam
+iguais em todos. O trabalhador 0 grava o `.h5` em `modelos/`, o mesmo
+arquivo do treinamento em um processo.
+
+O `batch_size` continua sendo o do batch inteiro, dividido entre os
+trabalhadores, então cada epoch faz o mesmo número de atualizações do
+treinamento em um processo. Os núcleos da máquina são divididos entre
+os trabalhadores.
+
+Este módulo não importa o tensorflow: o TF_CONFIG precisa estar no
+ambiente de cada trabalhador antes da importação.
+"""
+
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import json
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import traceback
+import numpy
+
+TAMANHO_FRAME = 2016
+
+def portasLivres(quantidade):
+    """Portas livres em localhost, escolhidas pelo sistema"""
+    sockets = []
+    for _ in range(quantidade):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        sockets.append(sock)
+    portas = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return portas
+
+def _trabalhador(indice, enderecos, caminho, conexao, opcoes):
+    """Processo trabalhador: carrega o modelo e atende os pedidos do
+    `TreinadorParalelo` até receber "fechar". Cada resposta leva o nome
+    do pedido, para que o treinador reconheça as respostas atrasadas."""
+    os.environ["TF_CONFIG"] = json.dumps({"cluster": {"worker": enderecos},
+        "task": {"type": "worker", "index": indice}})
+    os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+    # a interrupção pelo teclado é tratada pelo processo principal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pasta = None
+    pedido = "iniciar"
+
+    try:
+        import tensorflow as tf
+        import keras
+        from . import inteligencia
+        from .treinamento import montarJanelas
+
+        tf.config.threading.set_intra_op_parallelism_threads(opcoes["threads"])
+        tf.config.threading.set_inter_op_parallelism_threads(2)
+        estrategia = tf.distribute.MultiWorkerMirroredStrategy()
+        with estrategia.scope():
+            inteligencia.modelo = keras.models.load_model(caminho)
+
+        # todos gravam, para acompanhar as operações coletivas, mas só o
+        # trabalhador 0 grava no arquivo do modelo
+        inteligencia._caminho = caminho
+        if indice > 0:
+            pasta = tempfile.mkdtemp()
+            inteligencia._caminho = os.path.join(pasta, "modelo.h5")
+        conexao.send(("ok", pedido, None))
+
+        fragmentacao = tf.data.Options()
+        fragmentacao.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+
+        while True:
+            pedido, argumentos = conexao.recv()
+            if pedido == "fechar":
+                return
+
+            if pedido == "treinar":
+                nomeFrames, nomeRotulos, quantidade, semente, pesos = argumentos
+                memFrames = SharedMemory(name=nomeFrames)
+                memRotulos = SharedMemory(name=nomeRotulos)
+                frames = numpy.ndarray((quantidade, TAMANHO_FRAME), numpy.uint8, buffer=memFrames.buf).copy()
+                rotulos = numpy.ndarray((quantidade,), numpy.uint8, buffer=memRotulos.buf).copy()
+                memFrames.close()
+                memRotulos.close()
+
+                dados = montarJanelas(frames, rotulos, opcoes["time_steps"], opcoes["batch_size"],
+                    opcoes["embaralhar"], opcoes["tamanhoEmbaralhamento"], semente, pesos)
+                inicio = time.perf_counter()
+                historico = inteligencia.modelo.fit(dados.with_options(fragmentacao),
+                    epochs=opcoes["epochs"], verbose=opcoes["verbose"] if indice == 0 else 0)
+                resposta = ({nome: list(map(float, valores)) for nome, valores in historico.history.items()},
+                    time.perf_counter() - inicio)
+
+            elif pedido == "salvar":
+                inteligencia.salvar()
+                resposta = inteligencia.estadoOtimizador()
+
+            else:
+                raise ValueError("Pedido {} desconhecido".format(pedido))
+
+            conexao.send(("ok", pedido, resposta))
+
+    except Exception:
+        conexao.send(("erro", pedido, traceback.format_exc()))
+    finally:
+        if pasta is not None:
+            shutil.rmtree(pasta, ignore_errors=True)
+
+class TreinadorParalelo:
+    """Grupo de `trabalhadores` processos que treinam juntos o modelo do
+    `.h5` em `caminho` e o gravam lá. Os processos ficam ativos
+    entre os lotes, então o tensorflow e o modelo são carregados uma vez."""
+
+    def __init__(self, caminho, trabalhadores, time_steps, batch_size, epochs,
+            embaralhar=True, tamanhoEmbaralhamento=10000, verbose=1):
+        if batch_size < trabalhadores:
+            raise ValueError("O batch_size deve ser pelo menos o número de trabalhadores")
+        self.trabalhadores = trabalhadores
+        enderecos = ["localhost:{}".format(porta) for porta in portasLivres(trabalhadores)]
+        opcoes = {"time_steps": time_steps, "batch_size": batch_size, "epochs": epochs,
+            "embaralhar": embaralhar, "tamanhoEmbaralhamento": tamanhoEmbaralhamento, "verbose": verbose,
+            "threads": max(1, (os.cpu_count() or 1) // trabalhadores)}
+
+        # o processo principal já pode ter importado o tensorflow, que não
+        # sobrevive a um fork
+        contexto = get_context("spawn")
+        self._conexoes = []
+        self._processos = []
+        for indice in range(trabalhadores):
+            nossa, deles = contexto.Pipe()
+            processo = contexto.Process(target=_trabalhador, daemon=True,
+                args=(indice, enderecos, caminho, deles, opcoes))
+            processo.start()
+            self._conexoes.append(nossa)
+            self._processos.append(processo)
+        self._respostas("iniciar")
+
+    def _respostas(self, pedido):
+        """Resposta de cada trabalhador para `pedido`. Respostas de um
+        pedido anterior (de um treino interrompido) são descartadas."""
+        respostas = []
+        for indice, conexao in enumerate(self._conexoes):
+            while True:
+                try:
+                    estado, respondido, resposta = conexao.recv()
+                except EOFError:
+                    self.fechar()
+                    raise RuntimeError("O trabalhador {} terminou inesperadamente".format(indice))
+                if estado == "erro":
+                    self.fechar()
+                    raise RuntimeError("Erro no trabalhador {}:\n{}".format(indice, resposta))
+                if respondido == pedido:
+                    break
+            respostas.append(resposta)
+        return respostas
+
+    def _pedir(self, pedido, argumentos=None):
+        for conexao in self._conexoes:
+            conexao.send((pedido, argumentos))
+        return self._respostas(pedido)
+
+    def treinar(self, frames, rotulos, semente=None, pesos=None):
+        """Treina as `epochs` sobre as janelas dos frames (N x 2016) e
+        rótulos, com os `pesos` de `montarJanelas`. Retorna o histórico do
+        trabalhador 0 e a duração do fit mais lento."""
+        frames = numpy.ascontiguousarray(frames, numpy.uint8)
+        rotulos = numpy.asarray(rotulos, numpy.uint8)
+        memFrames = SharedMemory(create=True, size=max(1, frames.nbytes))
+        memRotulos = SharedMemory(create=True, size=max(1, rotulos.nbytes))
+        try:
+            destino = numpy.ndarray(frames.shape, numpy.uint8, buffer=memFrames.buf)
+            destino[:] = frames
+            destinoRotulos = numpy.ndarray(rotulos.shape, numpy.uint8, buffer=memRotulos.buf)
+            destinoRotulos[:] = rotulos
+            del destino, destinoRotulos
+            respostas = self._pedir("treinar", (memFrames.name, memRotulos.name, len(frames), semente, pesos))
+        finally:
+            memFrames.close()
+            memFrames.unlink()
+            memRotulos.close()
+            memRotulos.unlink()
+        historico = respostas[0][0]
+        return historico, max(duracao for _, duracao in respostas)
+
+    def salvar(self):
+        """Grava o modelo em `modelos/` e retorna o estado do otimizador"""
+        return self._pedir("salvar")[0]
+
+    def fechar(self):
+        for conexao in self._conexoes:
+            try:
+                conexao.send(("fechar", None))
+            except (BrokenPipeError, OSError):
+                pass
+        for processo in self._processos:
+            processo.join(10)
+            if processo.is_alive():
+                processo.terminate()
@@ -11,6 +11,8 @@ from getopt import gnu_getopt
 import yaml
 import socket
 
+from .servico import CAMINHO as CAMINHO_SERVICO
+
 class Parametros:
     """ Armazena as opções recebidas pelo usuário via linha 
     de comando para a execução do programa.
@@ -32,6 +34,31 @@ class Parametros:
     config = ""
     time_steps = 10
     fps = 30
+    motor = ""
+    processos = 0
+    cache = "cache"
+    armazem = ""
+    sobrepor = False
+    profundidade = 1
+    retomar = False
+    semente = 0
+    transporte = "binario"
+    inferencia = "janela"
+    pipeline = False
+    orcamento_ms = 50
+    porta = 4321
+    sem_emulador = False
+    sem_tela = False
+    verboso = False
+    instancias = 1
+    trabalhadores = 0
+    duplicatas = ""
+    limiar_duplicatas = 3
+    peso_duplicatas = 0
+    artefato = ""
+    servico = False
+    perfil = ""
+    perfil_intervalo = 60
 
     def parse(self, opts):
         """Preenche o objeto com as opções recebidas"""
@@ -53,6 +80,16 @@ class Parametros:
         self.time_steps = int(self.time_steps)
         self.frames = int(self.frames)
         self.fps = int(self.fps)
+        self.processos = int(self.processos)
+        self.profundidade = int(self.profundidade)
+        self.semente = int(self.semente)
+        self.orcamento_ms = float(self.orcamento_ms)
+        self.porta = int(self.porta)
+        self.instancias = int(self.instancias)
+        self.trabalhadores = int(self.trabalhadores)
+        self.limiar_duplicatas = int(self.limiar_duplicatas)
+        self.peso_duplicatas = float(self.peso_duplicatas)
+        self.perfil_intervalo = float(self.perfil_intervalo)
 
     @staticmethod
     def getopts():
@@ -83,7 +120,8 @@ class Parametros:
             print("É necessário passar o nome da inteligencia.")
             tudoOk = False
 
-        if not path.isfile("modelos/"+self.nome+".h5"):
+        # com um artefato ou com o serviço o modelo não é carregado aqui
+        if len(self.artefato) == 0 and not self.servico and not path.isfile("modelos/"+self.nome+".h5"):
             print("A inteligência {} não existe em modelos.".format(self.nome))
             tudoOk = False
         
@@ -91,6 +129,14 @@ class Parametros:
             print("Valores para fps são inválidos!")
             tudoOk = False
 
+        # Verifica o arquivo do perfil
+        if len(self.perfil) > 0 and not path.isdir(path.dirname(path.abspath(self.perfil))):
+            print("A pasta do arquivo de perfil {} não existe.".format(self.perfil))
+            tudoOk = False
+        if self.perfil_intervalo < 0:
+            print("O intervalo de gravação do perfil não pode ser negativo.")
+            tudoOk = False
+
         # Verifica existência do arquivo de sprites
         if not path.isfile(self.sprites):
             print("Arquivo sprites {} não existe.".format(self.sprites))
@@ -104,6 +150,13 @@ class Parametros:
             print("Verifique se a sintaxe está correta.")
             tudoOk = False
         
+        # o motor de casamento da linha de comando sobrepõe o do arquivo
+        if len(self.motor) > 0:
+            self.sprites["motor"] = self.motor
+        if not self.sprites.get("motor", "opencv") in ("opencv", "correlacao"):
+            print("Motor de casamento {} inválido.".format(self.sprites["motor"]))
+            tudoOk = False
+
         # verifica se os caminhos dos sprites estão corretos
         pastaSprites = self.sprites["sprites"]
         pastaMascaras = self.sprites["mascaras"]
@@ -148,6 +201,35 @@ class Parametros:
             print("Número de threads inválido.")
             tudoOk = False
 
+        # Verifica o tamanho da fila de lotes
+        if self.profundidade < 1:
+            print("A profundidade da fila deve ser pelo menos 1.")
+            tudoOk = False
+
+        # Verifica a quantidade de processos
+        if self.processos < 0:
+            print("Número de processos inválido.")
+            tudoOk = False
+
+        # Verifica os trabalhadores do treinamento paralelo
+        if self.trabalhadores < 0:
+            print("Número de trabalhadores inválido.")
+            tudoOk = False
+        elif self.trabalhadores > self.batch_size:
+            print("O batch_size deve ser pelo menos o número de trabalhadores.")
+            tudoOk = False
+
+        # Verifica o índice de janelas quase repetidas
+        if len(self.duplicatas) > 0 and not path.isdir(path.dirname(path.abspath(self.duplicatas))):
+            print("A pasta do índice de duplicatas {} não existe.".format(self.duplicatas))
+            tudoOk = False
+        if self.limiar_duplicatas < 0 or self.limiar_duplicatas > 15:
+            print("O limiar de duplicatas deve estar entre 0 e 15 bits.")
+            tudoOk = False
+        if self.peso_duplicatas < 0 or self.peso_duplicatas >= 1:
+            print("O peso das duplicatas deve estar entre 0 e 1 (exclusivo).")
+            tudoOk = False
+
         return tudoOk
 
     def validarJogar(self):
@@ -155,6 +237,54 @@ class Parametros:
         para o modo jogar"""
 
         tudoOk = self._validarGeral()
+
+        # Verifica o transporte dos frames
+        if not self.transporte in ("binario", "memoria", "arquivo"):
+            print("Transporte {} inválido.".format(self.transporte))
+            tudoOk = False
+
+        # Verifica o modo de inferência
+        if not self.inferencia in ("keras", "janela", "estado"):
+            print("Modo de inferência {} inválido.".format(self.inferencia))
+            tudoOk = False
+
+        # Verifica o artefato exportado
+        if len(self.artefato) > 0:
+            if not path.isfile(self.artefato):
+                print("O artefato {} não existe.".format(self.artefato))
+                tudoOk = False
+            if self.inferencia == "keras":
+                print("O --artefato não pode ser usado com a inferência keras.")
+                tudoOk = False
+
+        # Verifica o serviço de modelos
+        if self.servico:
+            if len(self.artefato) > 0:
+                print("O --servico não pode ser usado com --artefato.")
+                tudoOk = False
+            if not path.exists(CAMINHO_SERVICO):
+                print("O serviço de modelos não está em execução em {}.".format(CAMINHO_SERVICO))
+                tudoOk = False
+
+        # Verifica o orçamento de latência
+        if self.orcamento_ms < 0:
+            print("O orçamento de latência não pode ser negativo.")
+            tudoOk = False
+
+        # Verifica as instâncias
+        if self.instancias < 1:
+            print("O número de instâncias deve ser pelo menos 1.")
+            tudoOk = False
+        elif self.instancias > 1 and self.transporte == "arquivo":
+            print("O transporte arquivo não pode ser usado com várias instâncias.")
+            tudoOk = False
+        elif self.instancias > 1 and self.pipeline:
+            print("O --pipeline não pode ser usado com várias instâncias.")
+            tudoOk = False
+
+        # sem emulador o servidor já deve estar em execução na porta
+        if self.sem_emulador:
+            return tudoOk
         
         # TODO: Verificar se o fceux está instalado
 
@@ -163,14 +293,15 @@ class Parametros:
             print("É necessário executar como administrador.")
             tudoOk = False
         
-        # testa se a porta 4321 está disponível
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.bind(("127.0.0.1", 4321))
-            sock.close()
-        except OSError:
-            print("Porta 4321 está ocupada.")
-            tudoOk = False
+        # testa se as portas estão disponíveis
+        for porta in range(self.porta, self.porta + self.instancias):
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.bind(("127.0.0.1", porta))
+                sock.close()
+            except OSError:
+                print("Porta {} está ocupada.".format(porta))
+                tudoOk = False
 
         # Verifica se existe a room recebida
         if not path.isfile(self.room):
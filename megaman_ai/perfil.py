@@ -0,0 +1,245 @@
+"""
+perfil.py
+
+Tempos e contadores das etapas do treinamento e do modo jogar.
+
+Cada etapa instrumentada registra a duração de cada execução no perfil
+do processo (`atual`): quantidade, total, mínimo, máximo, um histograma
+com as faixas de `LIMITES` e as últimas `AMOSTRAS` durações, de onde
+saem os percentis. Os contadores somam eventos (frames rotulados,
+rótulos vindos do cache, comandos repetidos...). Os processos de
+rotulagem devolvem o seu perfil junto com cada segmento e ele é somado
+ao do processo principal.
+
+Com `--perfil=<arquivo>` o perfil é gravado em JSON a cada
+`--perfil_intervalo` segundos e no fim da execução.
+
+Etapas:
+    decodificacao     leitura de uma amostra do video (`LeitorAmostrado.ler`)
+    rotulagem         classificação de um frame (`visao.MegaMan.atualizar`)
+    preprocessamento  `preprocessar` de um frame (de um lote com várias instâncias)
+    janelas           preparação do dataset de janelas de um batch; as
+                      janelas em si são montadas pelo tf.data durante o fit
+    duplicatas        busca das janelas quase repetidas de um batch
+    fit               `fit` de um batch, com todas as epochs
+    aquisicao         espera pelo frame do emulador
+    inferencia        decisão da rede
+    envio             envio do comando para o emulador
+    decisao           da chegada do frame ao envio do comando
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Event, Lock, Thread
+import atexit
+import bisect
+import functools
+import json
+import os
+import platform
+import time
+import numpy
+
+from .comuns import sttinf, gravarAtomico
+
+# limite superior, em ms, de cada faixa do histograma; a última faixa
+# (acima do último limite) é aberta
+LIMITES = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100,
+    200, 500, 1000, 2000, 5000, 10000, 30000, 60000]
+# durações mais recentes guardadas por etapa para os percentis
+AMOSTRAS = 100000
+
+class Medida:
+    """Durações, em segundos, das execuções de uma etapa"""
+
+    def __init__(self):
+        self.quantidade = 0
+        self.total = 0.0
+        self.minimo = float("inf")
+        self.maximo = 0.0
+        self.histograma = [0] * (len(LIMITES) + 1)
+        self.amostras = deque(maxlen=AMOSTRAS)
+
+    def registrar(self, segundos):
+        self.quantidade += 1
+        self.total += segundos
+        self.minimo = min(self.minimo, segundos)
+        self.maximo = max(self.maximo, segundos)
+        self.histograma[bisect.bisect_left(LIMITES, 1000*segundos)] += 1
+        self.amostras.append(segundos)
+
+    def mesclar(self, outra):
+        self.quantidade += outra.quantidade
+        self.total += outra.total
+        self.minimo = min(self.minimo, outra.minimo)
+        self.maximo = max(self.maximo, outra.maximo)
+        self.histograma = [a + b for a, b in zip(self.histograma, outra.histograma)]
+        self.amostras.extend(outra.amostras)
+
+    def percentis(self, *percentis):
+        """Percentis, em ms, das durações guardadas"""
+        if len(self.amostras) == 0:
+            return [0.0] * len(percentis)
+        ms = 1000 * numpy.array(self.amostras)
+        return [float(p) for p in numpy.percentile(ms, percentis)]
+
+    def paraDicionario(self):
+        p50, p90, p99 = self.percentis(50, 90, 99)
+        return {
+            "quantidade": self.quantidade,
+            "total_s": self.total,
+            "media_ms": 1000 * self.total / max(1, self.quantidade),
+            "min_ms": 1000 * self.minimo if self.quantidade > 0 else 0.0,
+            "max_ms": 1000 * self.maximo,
+            "p50_ms": p50,
+            "p90_ms": p90,
+            "p99_ms": p99,
+            "histograma": self.histograma,
+        }
+
+class Perfil:
+    """Medidas e contadores por nome, compartilhados entre threads"""
+
+    def __init__(self):
+        self.inicio = time.time()
+        self.medidas = {}
+        self.contadores = {}
+        self._trava = Lock()
+
+    def __getstate__(self):
+        # vai e volta dos processos de rotulagem sem a trava
+        estado = dict(self.__dict__)
+        del estado["_trava"]
+        return estado
+
+    def __setstate__(self, estado):
+        self.__dict__.update(estado)
+        self._trava = Lock()
+
+    def registrar(self, nome, segundos):
+        with self._trava:
+            medida = self.medidas.get(nome)
+            if medida is None:
+                medida = self.medidas[nome] = Medida()
+            medida.registrar(segundos)
+
+    @contextmanager
+    def medir(self, nome):
+        """Registra em `nome` a duração do bloco `with`"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrar(nome, time.perf_counter() - inicio)
+
+    def contar(self, nome, quantidade=1):
+        with self._trava:
+            self.contadores[nome] = self.contadores.get(nome, 0) + quantidade
+
+    def quantidade(self, nome):
+        """Quantas execuções da etapa foram registradas"""
+        medida = self.medidas.get(nome)
+        return 0 if medida is None else medida.quantidade
+
+    def mesclar(self, outro):
+        """Soma as medidas e contadores de outro perfil a este"""
+        with self._trava:
+            for nome, medida in outro.medidas.items():
+                self.medidas.setdefault(nome, Medida()).mesclar(medida)
+            for nome, quantidade in outro.contadores.items():
+                self.contadores[nome] = self.contadores.get(nome, 0) + quantidade
+
+    def resumo(self):
+        """Quantidade, média, p50 e p99 em milissegundos de cada etapa"""
+        with self._trava:
+            return {nome: (m.quantidade, 1000 * m.total / m.quantidade) + tuple(m.percentis(50, 99))
+                for nome, m in self.medidas.items()}
+
+    def exibir(self):
+        for nome, (n, media, p50, p99) in self.resumo().items():
+            print("[{}] {:18}: {:7} x {:8.3f} ms (p50 {:8.3f} | p99 {:8.3f})".format(
+                sttinf, nome, n, media, p50, p99))
+        for nome, quantidade in sorted(self.contadores.items()):
+            print("[{}] {:18}: {:7}".format(sttinf, nome, quantidade))
+
+    def paraDicionario(self):
+        with self._trava:
+            return {
+                "inicio": datetime.fromtimestamp(self.inicio).isoformat(),
+                "gravado": datetime.now().isoformat(),
+                "duracao_s": time.time() - self.inicio,
+                "maquina": {"sistema": platform.platform(), "processador": platform.processor(),
+                    "cpus": os.cpu_count(), "python": platform.python_version()},
+                "limites_histograma_ms": LIMITES,
+                "tempos": {nome: m.paraDicionario() for nome, m in self.medidas.items()},
+                "contadores": dict(self.contadores),
+            }
+
+    def salvar(self, caminho):
+        dados = json.dumps(self.paraDicionario(), indent=2).encode()
+        gravarAtomico(caminho, lambda arquivo: arquivo.write(dados))
+
+# Perfil do processo, usado pelas etapas instrumentadas
+atual = Perfil()
+
+# arquivo de `gravarEm` e controle da gravação periódica
+_caminho = None
+_parar = Event()
+_gravando = Lock()
+
+def reiniciar():
+    """Troca o perfil do processo por um vazio e o retorna"""
+    global atual
+    atual = Perfil()
+    return atual
+
+def registrar(nome, segundos):
+    atual.registrar(nome, segundos)
+
+def medir(nome):
+    return atual.medir(nome)
+
+def contar(nome, quantidade=1):
+    atual.contar(nome, quantidade)
+
+def cronometrado(nome):
+    """Decorador que registra em `nome` a duração de cada chamada"""
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def medida(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return funcao(*args, **kwargs)
+            finally:
+                atual.registrar(nome, time.perf_counter() - inicio)
+        return medida
+    return decorador
+
+def _gravar():
+    with _gravando:
+        if _caminho is not None:
+            atual.salvar(_caminho)
+
+def _gravarPeriodicamente(intervalo):
+    while not _parar.wait(intervalo):
+        _gravar()
+
+def gravarEm(caminho, intervalo=60):
+    """Grava o perfil em `caminho` a cada `intervalo` segundos (0 desliga)
+    e em `finalizar`, chamado também na saída do programa"""
+    global _caminho
+    _caminho = caminho
+    if intervalo > 0:
+        Thread(target=_gravarPeriodicamente, args=(intervalo,), daemon=True).start()
+    atexit.register(finalizar)
+
+def finalizar():
+    """Para a gravação periódica e grava o perfil uma última vez"""
+    global _caminho
+    if _caminho is None:
+        return
+    _parar.set()
+    _gravar()
+    print("[{}] Perfil gravado em {}".format(sttinf, _caminho))
+    _caminho = None
@@ -0,0 +1,178 @@
+"""
+pipeline.py
+
+Modo jogar em estágios concorrentes ligados por filas limitadas:
+
+    aquisição -> pré-processamento -> inferência -> envio
+
+A aquisição só recebe os frames do emulador. O envio responde cada frame
+com a decisão mais recente, esperando por ela no máximo o orçamento de
+latência; se a inferência está atrasada, o último comando é repetido e
+o emulador nunca fica parado esperando a rede. Os frames que chegam
+enquanto a inferência trabalha entram no histórico da rede, mas só o
+mais novo recebe uma decisão.
+"""
+
+from threading import Thread
+import queue
+import time
+import numpy
+
+from .comuns import sttinf, preprocessar
+
+class FilaRecente:
+    """Fila limitada que, cheia, descarta o item mais antigo em vez de
+    bloquear quem coloca"""
+
+    def __init__(self, tamanho=1):
+        self._fila = queue.Queue(tamanho)
+        self.descartados = 0
+
+    def colocar(self, item):
+        while True:
+            try:
+                self._fila.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._fila.get_nowait()
+                    self.descartados += 1
+                except queue.Empty:
+                    pass
+
+    def tirar(self, espera=None):
+        """Próximo item; levanta `queue.Empty` depois de `espera` segundos"""
+        return self._fila.get(timeout=espera)
+
+    def esvaziar(self):
+        """Todos os itens que já estão na fila"""
+        itens = []
+        while True:
+            try:
+                itens.append(self._fila.get_nowait())
+            except queue.Empty:
+                return itens
+
+class PipelineJogo:
+    """Executa o modo jogar de um `Jogo` já conectado. `preditor` tem a
+    interface de `inferencia.MotorInferencia` (acrescentar/decidir) e
+    `orcamento` é o tempo máximo, em ms, entre a chegada de um frame e
+    o envio do comando."""
+
+    def __init__(self, jogo, preditor, orcamento):
+        self.jogo = jogo
+        self.preditor = preditor
+        self.orcamento = orcamento / 1000
+        self.tempos = jogo.tempos
+        self.repeticoes = 0
+        self.atrasados = 0
+        self.ultimoFrame = None
+        self.ativo = False
+        self._frames = FilaRecente(jogo.time_steps)
+        self._preprocessados = FilaRecente(jogo.time_steps)
+        self._decisoes = FilaRecente(1)
+        # frames esperando resposta, na ordem em que chegaram
+        self._pendentes = queue.Queue()
+        self._estagios = [Thread(target=f, daemon=True) for f in
+            (self._aquisicao, self._preprocessamento, self._inferencia, self._envio)]
+
+    def iniciar(self):
+        self.ativo = True
+        for estagio in self._estagios:
+            estagio.start()
+
+    def parar(self):
+        self.ativo = False
+        for estagio in self._estagios:
+            estagio.join(1)
+
+    def _aquisicao(self):
+        frame = 0
+        try:
+            while self.ativo and self.jogo._conectado:
+                # só um a cada `_taxa_coleta + 1` frames é usado
+                amostrar = frame % (self.jogo._taxa_coleta + 1) == self.jogo._taxa_coleta
+                inicio = time.perf_counter()
+                imagem = self.jogo._receberFrame(descartar=not amostrar)
+                chegada = time.perf_counter()
+                self.tempos.registrar("aquisicao", chegada - inicio)
+
+                if amostrar and imagem is not None:
+                    if self.jogo.transporte == "memoria":
+                        # o emulador não espera a rede, então a view do
+                        # anel seria sobrescrita antes de ser usada
+                        imagem = numpy.array(imagem)
+                    self.ultimoFrame = imagem
+                    self._frames.colocar((chegada, imagem))
+                self._pendentes.put((chegada, amostrar))
+                frame += 1
+        except (ConnectionResetError, ValueError) as erro:
+            print("[{}] Aquisição finalizada ({})".format(sttinf, erro))
+            self.jogo._conectado = False
+
+    def _preprocessamento(self):
+        while self.ativo:
+            try:
+                chegada, imagem = self._frames.tirar(0.1)
+            except queue.Empty:
+                continue
+            inicio = time.perf_counter()
+            frame = preprocessar(imagem)
+            self.tempos.registrar("preprocessamento", time.perf_counter() - inicio)
+            self._preprocessados.colocar((chegada, frame))
+
+    def _inferencia(self):
+        while self.ativo:
+            try:
+                itens = [self._preprocessados.tirar(0.1)]
+            except queue.Empty:
+                continue
+            # os frames que chegaram enquanto a rede trabalhava entram no
+            # histórico, mas só o mais novo recebe uma decisão
+            itens += self._preprocessados.esvaziar()
+            self.atrasados += len(itens) - 1
+            self.tempos.contar("frames_sem_decisao", len(itens) - 1)
+
+            inicio = time.perf_counter()
+            for _, frame in itens:
+                self.preditor.acrescentar(frame)
+            acao = self.preditor.decidir()
+            self.tempos.registrar("inferencia", time.perf_counter() - inicio)
+
+            comando = self.jogo._comandoDaAcao(acao)
+            self.jogo.decisoes += 1
+            self.tempos.contar("decisoes")
+            self._decisoes.colocar((itens[-1][0], comando))
+
+    def _envio(self):
+        while self.ativo:
+            try:
+                chegada, amostrado = self._pendentes.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            # espera a decisão até o fim do orçamento do frame
+            espera = max(0, chegada + self.orcamento - time.perf_counter()) if amostrado else 0
+            try:
+                decisao = self._decisoes.tirar(espera)
+            except queue.Empty:
+                decisao = None
+
+            inicio = time.perf_counter()
+            if decisao is None:
+                comando = self.jogo._ultimo_comando
+                if amostrado:
+                    self.repeticoes += 1
+                    self.tempos.contar("comandos_repetidos")
+            else:
+                chegadaDecisao, comando = decisao
+                self.tempos.registrar("decisao", inicio - chegadaDecisao)
+            self.jogo._enviarComando(comando)
+            self.tempos.registrar("envio", time.perf_counter() - inicio)
+
+    def exibir(self):
+        """Tempos de cada estágio e contadores das quedas"""
+        self.tempos.exibir()
+        print("[{}] Decisões: {} | comandos repetidos: {} | frames sem decisão própria: {} | frames descartados: {}".format(
+            sttinf, self.jogo.decisoes, self.repeticoes, self.atrasados,
+            self._frames.descartados + self._preprocessados.descartados))
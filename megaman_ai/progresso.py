@@ -0,0 +1,78 @@
+"""
+progresso.py
+
+Manifesto de progresso do treinamento, para retomar um treinamento
+interrompido do ponto onde parou em cada video.
+"""
+
+import os
+import random
+import time
+import numpy
+import yaml
+
+from .comuns import lerYaml, gravarAtomico
+
+class Progresso:
+    """Manifesto `modelos/<nome>.progresso.yaml`. Guarda a identidade de
+    cada video, a próxima amostra a ser lida e quantos frames já foram
+    treinados, o estado do otimizador, a semente aleatória e o estado
+    dos geradores do `random` e do numpy no fim do último lote.
+    É gravado de forma atômica logo depois do modelo, a cada lote treinado,
+    então nunca aponta para um ponto que o modelo salvo ainda não viu."""
+
+    def __init__(self, nome, pasta="modelos/"):
+        self._arquivo = "{}{}.progresso.yaml".format(pasta, nome)
+        self.dados = lerYaml(self._arquivo) or {"nome": nome, "videos": {}}
+
+    @property
+    def semente(self):
+        return self.dados.get("semente")
+
+    @semente.setter
+    def semente(self, valor):
+        self.dados["semente"] = valor
+
+    @property
+    def aleatorio(self):
+        return self.dados.get("aleatorio")
+
+    @staticmethod
+    def _identidade(video, fps):
+        info = os.stat(video)
+        return {"tamanho": info.st_size, "modificado": info.st_mtime, "fps": fps}
+
+    def consultar(self, video, fps):
+        """Registro do video ou None se ele mudou ou nunca foi treinado"""
+        registro = self.dados["videos"].get(os.path.abspath(video))
+        if registro is None:
+            return None
+        identidade = Progresso._identidade(video, fps)
+        if any(registro.get(campo) != valor for campo, valor in identidade.items()):
+            return None
+        return registro
+
+    def registrar(self, video, fps, amostra, feitos, concluido=False, otimizador=None, aleatorio=None):
+        registro = Progresso._identidade(video, fps)
+        registro.update({"amostra": amostra, "feitos": feitos, "concluido": concluido})
+        self.dados["videos"][os.path.abspath(video)] = registro
+        if otimizador is not None:
+            self.dados["otimizador"] = otimizador
+        if aleatorio is not None:
+            self.dados["aleatorio"] = aleatorio
+        self.dados["atualizado"] = time.time()
+        gravarAtomico(self._arquivo, lambda a: a.write(yaml.safe_dump(self.dados).encode()))
+
+def estadoAleatorio():
+    """Estado dos geradores do `random` e do numpy, em tipos do yaml"""
+    versao, interno, gauss = random.getstate()
+    nome, chaves, posicao, temGauss, gaussiana = numpy.random.get_state()
+    return {"random": [versao, list(interno), gauss],
+            "numpy": [nome, chaves.tolist(), int(posicao), int(temGauss), float(gaussiana)]}
+
+def restaurarAleatorio(estado):
+    """Volta os geradores ao estado de `estadoAleatorio`"""
+    versao, interno, gauss = estado["random"]
+    random.setstate((versao, tuple(interno), gauss))
+    nome, chaves, posicao, temGauss, gaussiana = estado["numpy"]
+    numpy.random.set_state((nome, numpy.array(chaves, numpy.uint32), posicao, temGauss, gaussiana))
@@ -0,0 +1,101 @@
+"""
+protocolo.py
+
+Protocolo binário de frames entre o servidor do emulador
+(`lua/server.lua` ou `servidor.py`) e o `Jogo`.
+
+Cada frame vai pelo socket como um cabeçalho de 17 bytes seguido dos
+pixels, sem passar por arquivo nem por PNG:
+
+    magia    4 bytes  "MMFB"
+    seq      uint32   número do frame, crescente
+    largura  uint16
+    altura   uint16
+    formato  uint8    FORMATO_ARGB (gd.screenshot do fceux) ou FORMATO_BGR
+    tamanho  uint32   quantidade de bytes de pixels que seguem
+
+Os inteiros são big-endian. No sentido contrário nada muda: o cliente
+responde cada frame com uma linha JSON com o comando do joypad.
+
+No transporte "memoria" os pixels ficam no anel de `anel.py` e pelo
+socket vai só um aviso de 4 bytes com o `seq` do frame escrito.
+"""
+
+import struct
+import numpy
+
+MAGIA = b"MMFB"
+CABECALHO = struct.Struct("!4sIHHBI")
+FORMATO_ARGB = 0
+FORMATO_BGR = 1
+CANAIS = {FORMATO_ARGB: 4, FORMATO_BGR: 3}
+AVISO = struct.Struct("!I")
+
+def receberExato(conexao, destino):
+    """Preenche o memoryview `destino` com bytes do socket"""
+    recebidos = 0
+    while recebidos < len(destino):
+        n = conexao.recv_into(destino[recebidos:])
+        if n == 0:
+            raise ConnectionResetError("Conexão fechada no meio de um frame")
+        recebidos += n
+
+def receberAviso(conexao):
+    """Recebe o aviso de frame novo do transporte "memoria" e retorna o seq"""
+    aviso = bytearray(AVISO.size)
+    receberExato(conexao, memoryview(aviso))
+    return AVISO.unpack(aviso)[0]
+
+def paraBGR(pixels, largura, altura, formato):
+    """Array altura x largura x 3 (BGR) a partir dos pixels recebidos"""
+    imagem = numpy.frombuffer(pixels, numpy.uint8).reshape(altura, largura, CANAIS[formato])
+    if formato == FORMATO_ARGB:
+        # A R G B -> B G R
+        return numpy.ascontiguousarray(imagem[:, :, 3:0:-1])
+    return imagem.copy()
+
+def enviarFrame(conexao, seq, frame, formato=FORMATO_BGR):
+    """Envia um frame BGR no formato do protocolo"""
+    altura, largura = frame.shape[:2]
+    if formato == FORMATO_ARGB:
+        pixels = numpy.zeros((altura, largura, 4), numpy.uint8)
+        pixels[:, :, 3:0:-1] = frame
+    else:
+        pixels = numpy.ascontiguousarray(frame, numpy.uint8)
+    conexao.sendall(CABECALHO.pack(MAGIA, seq, largura, altura, formato, pixels.nbytes))
+    conexao.sendall(pixels.tobytes())
+
+class ReceptorFrames:
+    """Lê os frames do protocolo binário de um socket. Os bytes dos
+    pixels são recebidos em um buffer reaproveitado entre os frames.
+    `perdidos` conta os saltos na numeração dos frames."""
+
+    def __init__(self, conexao):
+        self.conexao = conexao
+        self.sequencia = -1
+        self.perdidos = 0
+        self._cabecalho = bytearray(CABECALHO.size)
+        self._pixels = bytearray()
+
+    def receber(self, converter=True):
+        """Recebe o próximo frame e o retorna em BGR. Com `converter`
+        falso o frame é só consumido do socket e retorna None."""
+        receberExato(self.conexao, memoryview(self._cabecalho))
+        magia, seq, largura, altura, formato, tamanho = CABECALHO.unpack(self._cabecalho)
+
+        if magia != MAGIA or not formato in CANAIS:
+            raise ValueError("Cabeçalho de frame inválido")
+        if tamanho != largura * altura * CANAIS[formato]:
+            raise ValueError("Tamanho do frame {} não bate com {}x{}".format(tamanho, largura, altura))
+
+        if len(self._pixels) != tamanho:
+            self._pixels = bytearray(tamanho)
+        receberExato(self.conexao, memoryview(self._pixels))
+
+        if self.sequencia >= 0 and seq > self.sequencia + 1:
+            self.perdidos += seq - self.sequencia - 1
+        self.sequencia = seq
+
+        if not converter:
+            return None
+        return paraBGR(self._pixels, largura, altura, formato)
@@ -0,0 +1,165 @@
+"""
+rotulagem.py
+
+Classificação dos frames de um video em vários processos.
+O video é dividido em segmentos de frames contíguos e cada processo
+decodifica e classifica um segmento ao mesmo tempo que os outros.
+Cada processo tem o seu próprio `cv2.VideoCapture` e banco de sprites,
+e escreve os frames pré-processados e os rótulos direto em memória
+compartilhada, sem passar listas python pelo pickle.
+"""
+
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import cv2
+import numpy
+
+from . import visao, perfil
+from .comuns import preprocessar
+from .video import LeitorAmostrado
+from .cache import TrechoRotulos
+
+TAMANHO_FRAME = 2016
+
+# Estado de cada processo, criado uma vez pelo inicializador do pool
+_banco = None
+_tabela = None
+_progresso = None
+
+def _iniciarProcesso(sprites, log, progresso):
+    global _banco, _tabela, _progresso
+    # cada processo já é uma unidade de paralelismo
+    cv2.setNumThreads(1)
+    _banco = visao.BancoSprites(sprites)
+    _tabela = visao.TabelaTransicoes.doLog(log, _banco)
+    _progresso = progresso
+
+def _rotularSegmento(tarefa):
+    """Classifica um segmento do video e escreve o resultado a partir de
+    `deslocamento` nos arrays compartilhados.
+    `inicio` e `historico` são contados em frames amostrados.
+    O segmento começa `historico` frames antes de `inicio`,
+    para que as janelas de `time_steps` que cruzam o começo do segmento
+    tenham os frames anteriores. Os rótulos já presentes em `trecho`
+    (um `cache.TrechoRotulos`) não são recalculados.
+    Retorna quantos frames de histórico e quantos frames ao todo foram
+    escritos, o trecho com os rótulos novos e o perfil do segmento."""
+    video, inicio, historico, quantidade, fps, segmento, deslocamento, \
+        nomeFrames, nomeRotulos, total, trecho = tarefa
+
+    perfil.reiniciar()
+    memFrames = SharedMemory(name=nomeFrames)
+    memRotulos = SharedMemory(name=nomeRotulos)
+    frames = numpy.ndarray((total, TAMANHO_FRAME), numpy.uint8, buffer=memFrames.buf)
+    rotulos = numpy.ndarray((total,), numpy.uint8, buffer=memRotulos.buf)
+
+    historico = min(historico, inicio)
+    quantidade += historico
+
+    leitor = LeitorAmostrado(video, fps)
+    leitor.buscar(inicio - historico)
+    vis = visao.MegaMan(_banco, _tabela)
+    anterior = None
+    feitos = 0
+
+    # o frame i recebe o rótulo do frame i+1, por isso é lido um frame a mais
+    while feitos < quantidade:
+        amostra = leitor.amostra
+        frame = leitor.ler()
+        if frame is None:
+            break
+
+        frame = cv2.resize(frame, (256, 240))[:-16,:]
+        rotulo = trecho.rotular(vis, amostra, frame)
+        with perfil.medir("preprocessamento"):
+            frame = preprocessar(frame)
+        perfil.contar("frames_rotulados")
+
+        if not anterior is None:
+            frames[deslocamento+feitos] = anterior
+            rotulos[deslocamento+feitos] = rotulo
+            feitos += 1
+            _progresso[segmento] = feitos
+
+        anterior = frame
+
+    leitor.fechar()
+    del frames, rotulos
+    memFrames.close()
+    memRotulos.close()
+    return historico, feitos, trecho, perfil.atual
+
+class RotuladorProcessos:
+    """Pool de processos de classificação. Cada processo classifica um
+    segmento do video por vez; os resultados voltam na ordem do video."""
+
+    def __init__(self, sprites, processos, log):
+        self.processos = processos
+        # o processo principal já importou o tensorflow e carregou o
+        # modelo, que não sobrevivem a um fork; os processos só precisam
+        # da visão e do opencv
+        contexto = get_context("spawn")
+        self._progresso = contexto.Array("i", processos, lock=False)
+        self._pool = contexto.Pool(processos, _iniciarProcesso,
+            (sprites, log, self._progresso))
+
+    def rotular(self, video, inicios, quantidade, fps, historico=0, cache=None):
+        """Classifica ao mesmo tempo um segmento de `quantidade` frames
+        amostrados a `fps` para cada amostra de início em `inicios`
+        (no máximo `processos` segmentos).
+        Retorna, para cada segmento, os frames (N x 2016) e rótulos (N)
+        como arrays uint8 e a quantidade de frames de histórico no começo.
+        Com um `cache.CacheRotulos`, os rótulos conhecidos são reaproveitados
+        e os novos são mesclados nele."""
+        total = len(inicios) * (quantidade + historico)
+        memFrames = SharedMemory(create=True, size=total*TAMANHO_FRAME)
+        memRotulos = SharedMemory(create=True, size=total)
+
+        try:
+            tarefas = []
+            for segmento, inicio in enumerate(inicios):
+                self._progresso[segmento] = 0
+                # o segmento lê do histórico até um frame depois do fim
+                comeco = max(0, inicio - historico)
+                if cache is None:
+                    trecho = TrechoRotulos(comeco, *TrechoRotulos.vazio(inicio + quantidade + 1 - comeco))
+                else:
+                    trecho = cache.trecho(comeco, inicio + quantidade + 1)
+                tarefas.append((video, inicio, historico, quantidade, fps, segmento,
+                    segmento*(quantidade + historico), memFrames.name, memRotulos.name, total, trecho))
+
+            resultado = self._pool.map_async(_rotularSegmento, tarefas)
+            while not resultado.ready():
+                self._exibirProgresso(len(inicios), quantidade + historico)
+                resultado.wait(0.5)
+            self._exibirProgresso(len(inicios), quantidade + historico)
+            print("")
+
+            frames = numpy.ndarray((total, TAMANHO_FRAME), numpy.uint8, buffer=memFrames.buf)
+            rotulos = numpy.ndarray((total,), numpy.uint8, buffer=memRotulos.buf)
+
+            segmentos = []
+            for tarefa, (prefixo, feitos, trecho, medidas) in zip(tarefas, resultado.get()):
+                perfil.atual.mesclar(medidas)
+                if cache is not None:
+                    cache.mesclar(trecho)
+                parte = slice(tarefa[6], tarefa[6]+feitos)
+                segmentos.append((frames[parte].copy(), rotulos[parte].copy(), prefixo))
+            del frames, rotulos
+            return segmentos
+        finally:
+            memFrames.close()
+            memFrames.unlink()
+            memRotulos.close()
+            memRotulos.unlink()
+
+    def _exibirProgresso(self, segmentos, total):
+        partes = []
+        for segmento in range(segmentos):
+            progresso = int(100 * self._progresso[segmento] / total)
+            partes.append("S{}: {:3}%".format(segmento+1, progresso))
+        print("\r" + " | ".join(partes), end="")
+
+    def fechar(self):
+        self._pool.close()
+        self._pool.join()
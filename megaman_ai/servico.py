@@ -0,0 +1,220 @@
+"""
+servico.py
+
+Serviço local que mantém os modelos de `modelos/` carregados e atende
+pedidos por um socket Unix. Com ele o modo jogar (`--servico`) e as
+avaliações não importam o tensorflow nem pagam o `load_model` a cada
+execução: os pesos chegam prontos para o motor numpy de `inferencia.py`
+ou as janelas são enviadas para o `predict` do modelo já carregado.
+
+Uso:
+    python3 -m megaman_ai.servico [nomes...]
+        Atende em /tmp/megamanAI.modelos.sock. Os modelos em `nomes` são
+        carregados no início e os outros no primeiro pedido. Um modelo
+        cujo `.h5` mudou (por um treinamento) é carregado de novo.
+
+Protocolo (inteiros big-endian). Pedido: "MMSV", operação (uint8),
+tamanho do nome (uint16) e tamanho dos dados (uint32), seguidos do nome
+do modelo e dos dados. Resposta: status (uint8, 0 = ok) e tamanho
+(uint32), seguidos dos dados ou da mensagem de erro.
+
+    PESOS   sem dados; responde um artefato float32 com as camadas do
+            modelo (veja `inferencia.salvarArtefato`)
+    PREVER  janelas em `.npy` (janelas x time_steps x 2016, em 0..1);
+            responde as probabilidades em `.npy`
+"""
+
+from sys import argv
+from threading import Lock
+import io
+import os
+import socket
+import socketserver
+import struct
+import time
+import numpy
+
+from .comuns import sttinf
+from .inferencia import (camadasDoKeras, salvarArtefato, carregarArtefato,
+    MotorInferencia, PreditorKeras)
+from .protocolo import receberExato
+
+CAMINHO = "/tmp/megamanAI.modelos.sock"
+MAGIA = b"MMSV"
+PEDIDO = struct.Struct("!4sBHI")
+RESPOSTA = struct.Struct("!BI")
+PESOS = 0
+PREVER = 1
+OK = 0
+ERRO = 1
+
+def _receber(conexao, tamanho):
+    dados = bytearray(tamanho)
+    receberExato(conexao, memoryview(dados))
+    return dados
+
+def _paraNpy(array):
+    arquivo = io.BytesIO()
+    numpy.save(arquivo, array, allow_pickle=False)
+    return arquivo.getvalue()
+
+def _deNpy(dados):
+    return numpy.load(io.BytesIO(dados), allow_pickle=False)
+
+class _Atendimento(socketserver.BaseRequestHandler):
+    """Atende os pedidos de um cliente até ele desconectar"""
+
+    def handle(self):
+        cabecalho = bytearray(PEDIDO.size)
+        while True:
+            try:
+                receberExato(self.request, memoryview(cabecalho))
+                magia, operacao, tamanhoNome, tamanho = PEDIDO.unpack(cabecalho)
+                if magia != MAGIA:
+                    return
+                nome = _receber(self.request, tamanhoNome).decode()
+                dados = _receber(self.request, tamanho)
+            except ConnectionResetError:
+                return
+
+            try:
+                if operacao == PESOS:
+                    resposta = self.server.pesos(nome)
+                elif operacao == PREVER:
+                    resposta = _paraNpy(self.server.prever(nome, _deNpy(dados)))
+                else:
+                    raise ValueError("Operação {} desconhecida".format(operacao))
+                status = OK
+            except Exception as erro:
+                resposta = "{}: {}".format(type(erro).__name__, erro).encode()
+                status = ERRO
+            self.request.sendall(RESPOSTA.pack(status, len(resposta)) + resposta)
+
+class ServicoModelos(socketserver.ThreadingUnixStreamServer):
+    """Servidor com os modelos carregados, uma thread por cliente. Os
+    pedidos de um mesmo modelo são atendidos um de cada vez."""
+
+    daemon_threads = True
+
+    def __init__(self, caminho=CAMINHO, pasta="modelos"):
+        if os.path.exists(caminho):
+            # só o socket de um serviço que não existe mais é removido
+            teste = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                teste.connect(caminho)
+            except ConnectionRefusedError:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+            else:
+                raise RuntimeError("Já existe um serviço em {}".format(caminho))
+            finally:
+                teste.close()
+        self.pasta = pasta
+        # nome -> (modelo, data de modificação do .h5, trava)
+        self._modelos = {}
+        self._pesos = {}
+        self._carregando = Lock()
+        super().__init__(caminho, _Atendimento)
+        os.chmod(caminho, 0o600)
+
+    def modelo(self, nome):
+        """Modelo carregado e a trava dele, carregando se necessário"""
+        if len(nome) == 0 or "/" in nome or "\\" in nome or ".." in nome:
+            raise ValueError("Nome de modelo inválido: {!r}".format(nome))
+        caminho = os.path.join(self.pasta, nome + ".h5")
+        modificacao = os.path.getmtime(caminho)
+        with self._carregando:
+            if not nome in self._modelos or self._modelos[nome][1] != modificacao:
+                import keras
+                inicio = time.perf_counter()
+                self._modelos[nome] = (keras.models.load_model(caminho), modificacao, Lock())
+                self._pesos.pop(nome, None)
+                print("[{}] {} carregado em {:.1f} s".format(sttinf, caminho, time.perf_counter() - inicio))
+        modelo, _, trava = self._modelos[nome]
+        return modelo, trava
+
+    def pesos(self, nome):
+        """Artefato float32 do modelo, gerado uma vez por carga"""
+        modelo, trava = self.modelo(nome)
+        with trava:
+            if not nome in self._pesos:
+                arquivo = io.BytesIO()
+                salvarArtefato(camadasDoKeras(modelo), arquivo, "float32", {"nome": nome})
+                self._pesos[nome] = arquivo.getvalue()
+            return self._pesos[nome]
+
+    def prever(self, nome, janelas):
+        modelo, trava = self.modelo(nome)
+        with trava:
+            return numpy.asarray(modelo.predict_on_batch(janelas), numpy.float32)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+class ClienteModelos:
+    """Conexão com o serviço. Levanta `FileNotFoundError` ou
+    `ConnectionRefusedError` se o serviço não estiver em execução e
+    `RuntimeError` com a mensagem do serviço se um pedido falhar."""
+
+    def __init__(self, caminho=CAMINHO):
+        self._conexao = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._conexao.connect(caminho)
+        self._cabecalho = bytearray(RESPOSTA.size)
+
+    def _pedir(self, operacao, nome, dados=b""):
+        nome = nome.encode()
+        self._conexao.sendall(PEDIDO.pack(MAGIA, operacao, len(nome), len(dados)) + nome)
+        self._conexao.sendall(dados)
+        receberExato(self._conexao, memoryview(self._cabecalho))
+        status, tamanho = RESPOSTA.unpack(self._cabecalho)
+        resposta = _receber(self._conexao, tamanho)
+        if status != OK:
+            raise RuntimeError(resposta.decode())
+        return resposta
+
+    def camadas(self, nome):
+        """Camadas do modelo para o `MotorInferencia`"""
+        return carregarArtefato(io.BytesIO(self._pedir(PESOS, nome)))
+
+    def prever(self, nome, janelas):
+        return _deNpy(self._pedir(PREVER, nome, _paraNpy(numpy.asarray(janelas, numpy.float32))))
+
+    def fechar(self):
+        self._conexao.close()
+
+class ModeloRemoto:
+    """Modelo do serviço com o `predict` do keras, para o `PreditorKeras`"""
+
+    def __init__(self, cliente, nome):
+        self.cliente = cliente
+        self.nome = nome
+
+    def predict(self, janelas):
+        return self.cliente.prever(self.nome, janelas)
+
+def preditorDoServico(nome, time_steps, modo="janela", instancias=None, caminho=CAMINHO):
+    """Preditor do modo jogar com o modelo `nome` do serviço. Com `modo`
+    "keras" cada decisão é um pedido ao serviço; nos outros os pesos são
+    pedidos uma vez e a rede roda aqui, em numpy."""
+    cliente = ClienteModelos(caminho)
+    if modo == "keras":
+        return PreditorKeras(ModeloRemoto(cliente, nome), time_steps, instancias)
+    camadas = cliente.camadas(nome)
+    cliente.fechar()
+    return MotorInferencia(camadas, time_steps, modo, instancias)
+
+if __name__ == "__main__":
+    os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+    servico = ServicoModelos()
+    for nome in argv[1:]:
+        servico.modelo(nome)
+    print("[{}] Serviço de modelos em {}".format(sttinf, CAMINHO))
+    try:
+        servico.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servico.server_close()
@@ -0,0 +1,135 @@
+"""
+servidor.py
+
+Substituto em python do `lua/server.lua`, para testar o `Jogo` e o
+protocolo sem o emulador. Segue o mesmo roteiro do script lua: a cada
+frame envia a tela (pelo protocolo binário ou pelo arquivo e "Pronto")
+e espera a linha JSON com o comando antes de avançar.
+
+Uso:
+    python3 -m megaman_ai.servidor [fonte] [porta] [transporte]
+        Atende um cliente com os frames de `fonte`: um video, uma pasta
+        de imagens ou um número de frames sintéticos (padrão 10000).
+        O transporte é "binario" (padrão), "memoria" ou "arquivo". Com
+        "memoria" usa o anel em /dev/shm criado pelo cliente, ou cria um
+        se não existir.
+"""
+
+from sys import argv
+from itertools import islice
+import json
+import os
+import socket
+import cv2
+import numpy
+
+from . import protocolo
+from . import anel
+from .anel import AnelFrames
+from .comuns import sttinf
+
+def framesSinteticos(quantidade, altura=240, largura=256):
+    """Frames BGR de ruído deslocado a cada frame, no tamanho da tela do NES"""
+    base = numpy.random.RandomState(0).randint(0, 256, (altura, largura, 3)).astype(numpy.uint8)
+    for i in range(quantidade):
+        yield numpy.roll(base, i, axis=1)
+
+def framesDeVideo(caminho):
+    """Frames de um video gravado, no tamanho da tela do NES"""
+    captura = cv2.VideoCapture(caminho)
+    while True:
+        ok, frame = captura.read()
+        if not ok:
+            break
+        yield cv2.resize(frame, (256, 240))
+    captura.release()
+
+def framesDePasta(pasta):
+    """Imagens de uma pasta, em ordem alfabética, no tamanho da tela do NES"""
+    for nome in sorted(os.listdir(pasta)):
+        frame = cv2.imread(os.path.join(pasta, nome))
+        if frame is not None:
+            yield cv2.resize(frame, (256, 240))
+
+def abrirFonte(fonte, quantidade=None, carregar=False):
+    """Frames de um video, de uma pasta de imagens ou, se `fonte` é um
+    número, de `fonte` frames sintéticos. Com `carregar` os frames são
+    lidos para a memória antes, para não medir a decodificação."""
+    if os.path.isdir(fonte):
+        frames = framesDePasta(fonte)
+    elif os.path.isfile(fonte):
+        frames = framesDeVideo(fonte)
+    else:
+        frames = framesSinteticos(int(fonte))
+    if quantidade is not None:
+        frames = islice(frames, quantidade)
+    return list(frames) if carregar else frames
+
+class ServidorSimulado:
+    """Servidor de um único cliente. `frames` é qualquer iterável de
+    frames BGR; o atendimento termina quando eles acabam ou quando o
+    cliente desconecta. Com `porta` 0 o sistema escolhe uma porta livre."""
+
+    def __init__(self, frames, porta=4321, transporte="binario",
+            formato=protocolo.FORMATO_ARGB, caminhoFrame="/tmp/.megamanAI.screen",
+            caminhoAnel=None):
+        self.frames = frames
+        self.transporte = transporte
+        self.formato = formato
+        self.caminhoFrame = caminhoFrame
+        self._anel = None
+        self.comandos = 0
+        self.ultimoComando = None
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(("127.0.0.1", int(porta)))
+        self._socket.listen(1)
+        self.porta = self._socket.getsockname()[1]
+        self.caminhoAnel = caminhoAnel or anel.caminho(self.porta)
+
+    def _enviar(self, cliente, seq, frame):
+        if self.transporte == "binario":
+            protocolo.enviarFrame(cliente, seq, frame, self.formato)
+        elif self.transporte == "memoria":
+            self._anel.escrever(seq, frame, self.formato)
+            cliente.sendall(protocolo.AVISO.pack(seq))
+        else:
+            cv2.imwrite(self.caminhoFrame, frame)
+            cliente.sendall(b"Pronto")
+
+    def atender(self):
+        cliente, _ = self._socket.accept()
+        if self.transporte == "memoria":
+            # como o emulador, abre o anel que o cliente criou
+            if os.path.isfile(self.caminhoAnel):
+                self._anel = AnelFrames(self.caminhoAnel)
+            else:
+                self._anel = AnelFrames.criar(self.caminhoAnel)
+        cliente.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        linhas = cliente.makefile("rb")
+        try:
+            for seq, frame in enumerate(self.frames):
+                self._enviar(cliente, seq, frame)
+                # espera o comando relativo ao frame enviado
+                linha = linhas.readline()
+                if not linha:
+                    break
+                self.ultimoComando = json.loads(linha)
+                self.comandos += 1
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            linhas.close()
+            cliente.close()
+            if self._anel is not None:
+                self._anel.fechar()
+            self._socket.close()
+
+if __name__ == "__main__":
+    fonte = argv[1] if len(argv) > 1 else "10000"
+    porta = int(argv[2]) if len(argv) > 2 else 4321
+    transporte = argv[3] if len(argv) > 3 else "binario"
+    servidor = ServidorSimulado(abrirFonte(fonte), porta, transporte)
+    print("[{}] Servidor simulado aguardando na porta {}".format(sttinf, servidor.porta))
+    servidor.atender()
+    print("[{}] {} comandos recebidos".format(sttinf, servidor.comandos))
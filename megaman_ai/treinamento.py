@@ -11,20 +11,69 @@ import numpy
 import yaml
 import os
 import time
+import queue
+import random
 from datetime import datetime
-from threading import RLock, Thread, active_count
-from tensorflow.keras.preprocessing.sequence import TimeseriesGenerator
+from threading import Event, RLock, Thread, active_count
+import tensorflow as tf
 
-from . import inteligencia, visao
-from .comuns import sttinf, sttwrn, mm_resize
+from . import inteligencia, visao, rotulagem, perfil
+from .video import LeitorAmostrado
+from .cache import CacheRotulos, LIMIAR
+from .armazem import Armazem
+from .paralelo import TreinadorParalelo
+from .duplicatas import IndiceDuplicatas, pesosJanelas
+from .progresso import Progresso, estadoAleatorio, restaurarAleatorio
+from .comuns import sttinf, sttwrn, preprocessar
+
+def montarJanelas(frames, rotulos, time_steps, batch_size, embaralhar=True,
+        tamanhoEmbaralhamento=10000, semente=None, pesos=None):
+    """Monta o `tf.data.Dataset` de janelas de um batch de frames.
+    Os frames ficam em um único buffer uint8 e cada janela é montada
+    dentro do grafo pelos índices dos seus frames, já normalizada
+    para float32. Gera as mesmas janelas e rótulos do antigo
+    TimeseriesGenerator: a janela j são os frames [j, j+time_steps)
+    e o seu rótulo é o do frame j+time_steps. Com a mesma `semente` o
+    embaralhamento é o mesmo em todos os processos.
+    `pesos` (um por janela, de `duplicatas.pesosJanelas`) remove as
+    janelas com peso 0; os outros pesos vão para o fit como peso de
+    cada amostra."""
+    indices = numpy.arange(max(0, len(frames) - time_steps))
+    ponderar = False
+    if pesos is not None:
+        pesos = numpy.asarray(pesos, numpy.float32)
+        indices = indices[pesos > 0]
+        ponderar = bool((pesos[indices] < 1).any())
+        pesos = tf.constant(pesos)
+    frames = tf.constant(numpy.ascontiguousarray(frames, numpy.uint8))
+    rotulos = tf.constant(numpy.asarray(rotulos, numpy.int32))
+    passos = tf.range(time_steps, dtype=tf.int64)
+
+    def montar(indices):
+        janelas = tf.cast(tf.gather(frames, indices[:, None] + passos), tf.float32) / 255.0
+        if ponderar:
+            return janelas, tf.gather(rotulos, indices + time_steps), tf.gather(pesos, indices)
+        return janelas, tf.gather(rotulos, indices + time_steps)
+
+    dados = tf.data.Dataset.from_tensor_slices(indices)
+    if embaralhar:
+        dados = dados.shuffle(max(1, min(len(indices), tamanhoEmbaralhamento)), seed=semente,
+            reshuffle_each_iteration=True)
+    dados = dados.batch(batch_size)
+    dados = dados.map(montar, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dados.prefetch(tf.data.experimental.AUTOTUNE)
 
 class Treinamento:
     """Armazena informações sobre uma instancia de treinamento
     incluindo estatísticas sobre o andamento do treinamento."""
 
+    # janelas mantidas no buffer de embaralhamento do tf.data
+    tamanhoEmbaralhamento = 10000
+
     def __init__(self, videos, sprites, **kwargs):
         self.videos = videos
-        self.visao = visao.MegaMan(sprites)
+        self.banco = visao.BancoSprites(sprites)
+        self.visao = visao.MegaMan(self.banco)
         self.epochs = kwargs.get("epochs", 50)
         self.batch_size = kwargs.get("batch_size", 100)
         self.frames = kwargs.get("frames", 1000)
@@ -34,26 +83,87 @@ class Treinamento:
         self.nthreads = kwargs.get("nthreads", 1)
         self.time_steps = kwargs.get("time_steps", 10)
         self.fps = kwargs.get("fps", 30)
+        self.processos = kwargs.get("processos", 0)
+        self.pastaCache = kwargs.get("cache", "cache")
+        self.sobrepor = kwargs.get("sobrepor", False)
+        self.profundidade = kwargs.get("profundidade", 1)
+        pastaArmazem = kwargs.get("armazem", "")
+        self.armazem = Armazem(pastaArmazem) if len(pastaArmazem) > 0 else None
+        self.retomar = kwargs.get("retomar", False)
+        # processos de treinamento com paralelismo de dados; 0 treina aqui
+        self.trabalhadores = kwargs.get("trabalhadores", 0)
+        self._paralelo = None
+        # índice de janelas quase repetidas, compartilhado entre os videos
+        arquivoDuplicatas = kwargs.get("duplicatas", "")
+        self.duplicatas = None
+        if len(arquivoDuplicatas) > 0:
+            self.duplicatas = IndiceDuplicatas(arquivoDuplicatas,
+                kwargs.get("limiar_duplicatas", 3), self.time_steps)
+        self.pesoDuplicatas = kwargs.get("peso_duplicatas", 0.0)
+        self.progresso = Progresso(self.nome)
+        self._iniciarSemente(kwargs.get("semente", 0))
         self._frameAnterior = None, -1
         self._data_set = [],[]
+        # a ordem de busca dos templates aprende com os rótulos já registrados
+        self.tabela = visao.TabelaTransicoes.doLog("logs/{}.log".format(self.nome), self.banco)
         self._log = open("logs/{}.log".format(self.nome), "a")
         self._iterativo = False # Parametrizar
         self._lock_video = RLock()
         self._frames_thread = int(self.frames/self.nthreads)
+        self._rotulador = None
 
     def iniciar(self):
         """Inicia o treinamento em todos os videos"""
         
         self._exibirInfoInicioTreino()
 
+        # pool de processos de classificação, compartilhado entre os videos
+        if self.processos > 0:
+            self._rotulador = rotulagem.RotuladorProcessos(
+                self.sprites, self.processos, "logs/{}.log".format(self.nome))
+
+        # os trabalhadores carregam o modelo de modelos/ e o gravam lá
+        if self.trabalhadores > 0:
+            print("[{}] Iniciando {} trabalhadores de treinamento".format(sttinf, self.trabalhadores))
+            self._paralelo = TreinadorParalelo("modelos/{}.h5".format(self.nome), self.trabalhadores,
+                self.time_steps, self.batch_size, self.epochs, self.suffle, self.tamanhoEmbaralhamento)
+
         for video in self.videos:
 
             # Abre o video
-            self._video = cv2.VideoCapture(video)
+            self._video = LeitorAmostrado(video, self.fps)
+            self._caminhoVideo = video
+            self._posicao = 0
+            self.feitos = 0
+
+            # continua do ponto salvo no manifesto
+            registro = self.progresso.consultar(video, self.fps) if self.retomar else None
+            if registro is not None:
+                if registro["concluido"]:
+                    print("[{}] Video {} já foi treinado.".format(sttwrn, video))
+                    continue
+                self._posicao = registro["amostra"]
+                self.feitos = registro["feitos"]
+                self._video.buscar(self._posicao)
+                print("[{}] Retomando {} da amostra {}".format(sttinf, video, self._posicao))
+
+            # rótulos já conhecidos deste video, se o cache estiver ativo
+            self._cache = None
+            if len(self.pastaCache) > 0:
+                self._cache = CacheRotulos(video, self.banco, self.fps, self._video.total,
+                    self.pastaCache, self.tabela)
+
+            # frames já pré-processados deste video, se o armazém estiver ativo
+            if self.armazem is not None:
+                self._chaveArmazem = self.armazem.chave(video, self.fps, self.banco, self.tabela)
 
             # Exibe algumas informações antes do inicio do treinamento
             self._exibirInfosInicioVideo(video)
 
+            self._consumido = self._posicao
+            self._interrompido = False
+            self.janelasVideo = 0
+            self.repetidasVideo = 0
             try:
                 # Chama a função de treinamento para o video atual
                 self._treinar()
@@ -62,14 +172,57 @@ class Treinamento:
             # Para salvar o progresso do video
             except KeyboardInterrupt:
                 print(" "*150, end="\r")
+                self._interrompido = True
+                # as janelas do batch interrompido não foram treinadas
+                if self.duplicatas is not None:
+                    self.duplicatas.descartar()
                 
 
             # Exibe informações no fim do treinamento
             self._exibirInfosFimVideo(video)
+
+            if self._cache is not None:
+                self._cache.salvar()
             
             # Salva modelo
-            inteligencia.salvar()
+            otimizador = self._salvar()
+            self.progresso.registrar(video, self.fps, self._consumido, self.feitos,
+                concluido=not self._interrompido, otimizador=otimizador,
+                aleatorio=self._aleatorio if self._interrompido else estadoAleatorio())
+
+        if self._rotulador is not None:
+            self._rotulador.fechar()
+        if self._paralelo is not None:
+            self._paralelo.fechar()
+
+    def _salvar(self):
+        """Salva o modelo e retorna o estado do otimizador para o manifesto"""
+        if self.duplicatas is not None:
+            self.duplicatas.salvar()
+        if self._paralelo is not None:
+            return self._paralelo.salvar()
+        inteligencia.salvar()
+        return inteligencia.estadoOtimizador()
         
+    def _iniciarSemente(self, semente):
+        """Fixa a semente de todos os geradores aleatórios. Ao retomar,
+        usa a semente salva no manifesto e volta o `random` e o numpy ao
+        estado do fim do último lote treinado, que decide o embaralhamento
+        dos lotes seguintes; sem semente, sorteia uma. A aleatoriedade
+        interna do tensorflow (inicialização, dropout) não é restaurada."""
+        if self.retomar and self.progresso.semente is not None:
+            semente = self.progresso.semente
+        elif semente == 0:
+            semente = random.randrange(1, 2**31)
+        self.progresso.semente = semente
+        random.seed(semente)
+        numpy.random.seed(semente)
+        tf.random.set_seed(semente)
+        if self.retomar and self.progresso.aleatorio is not None:
+            restaurarAleatorio(self.progresso.aleatorio)
+        # estado do último ponto de onde o treinamento pode ser retomado
+        self._aleatorio = estadoAleatorio()
+
     def _exibirInfosFimVideo(self, video):
         """Exibe algumas informações antes do treinamento com o video"""
         print("[{}] Fim de treinamento com o vídeo {}. Feitos: {}/{}".format(
@@ -77,6 +230,9 @@ class Treinamento:
                 video, 
                 self.feitos, 
                 self.framesTotal))
+        if self.duplicatas is not None and self.janelasVideo > 0:
+            print("[{}] Janelas quase repetidas no vídeo: {}/{} ({:.1f}%)".format(sttinf,
+                self.repetidasVideo, self.janelasVideo, 100 * self.repetidasVideo / self.janelasVideo))
 
     def _exibirInfosInicioVideo(self, video):
         """Exibe algumas informações depois do treinamento com o video"""
@@ -122,30 +278,28 @@ class Treinamento:
                 worker.join()
         threads.clear()
         
-        self._data_set = [[],[]]
+        frames, rotulos = [],[]
         for recipiente in frame_set:
-            self._data_set[0].extend(recipiente[0])
-            self._data_set[1].extend(recipiente[1])
+            frames.extend(recipiente[0])
+            rotulos.extend(recipiente[1])
         
         print("[{}] Todas as Threads Finalizadas! Iniciando Treinamento.".format(sttwrn))
+        return frames, rotulos
     
     def _classificar(self, recipiente, numero):
         frameAnterior = (None, -1)
-        vis = visao.MegaMan(self.sprites)
+        vis = visao.MegaMan(self.banco, self.tabela)
         porcentagem = 0
         parte_100 = int(self._frames_thread * 0.1)
-        taxa_coleta = int(30/self.frames)
         
         print("[{}] Thread {} iniciada.".format(sttinf, numero))
 
         while len(recipiente[0]) < self._frames_thread:
             self._lock_video.acquire()
             
-            # Descarte do frames
-            for _ in range(taxa_coleta-1):
-                self._video.read()
-            
-            frame = self._video.read()[1]
+            # Os frames descartados não são decodificados
+            amostra = self._video.amostra
+            frame = self._video.ler()
             
             self._lock_video.release()
             
@@ -154,18 +308,25 @@ class Treinamento:
 
             frame = cv2.resize(frame, (256, 240))[:-16,:]
             
-            # atualizar o estado do objeto megaman usando o frame
-            vis.atualizar(vis.transformar(frame), 20)
+            # atualizar o estado do objeto megaman usando o frame,
+            # a não ser que o rótulo já esteja no cache
+            if self._cache is not None:
+                rotulo = self._cache.rotular(vis, amostra, frame)
+            else:
+                vis.atualizar(vis.transformar(frame), LIMIAR)
+                rotulo = vis.rotulo
             
-            frame = mm_resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+            with perfil.medir("preprocessamento"):
+                frame = preprocessar(frame)
+            perfil.contar("frames_rotulados")
             
             if not frameAnterior[0] is None:
                 # coloca no dataset
-                recipiente[0].append(frameAnterior[0].flatten())
-                recipiente[1].append(vis.rotulo)
+                recipiente[0].append(frameAnterior[0])
+                recipiente[1].append(rotulo)
                 
             # atualiza o frame anterior
-            frameAnterior = (frame, vis.rotulo)
+            frameAnterior = (frame, rotulo)
 
             if self.nthreads > 1:
                 if len(recipiente[0]) % parte_100 == 0:
@@ -174,54 +335,223 @@ class Treinamento:
             else:
                 self._exibirInfoTreinamento(self.frames, len(recipiente[0]))
         
-        print("[{}] Fim classificação Thread {}.".format(sttinf, numero))
+        print("[{}] Fim classificação Thread {}. Buscas: {} Rastreio: {} Templates/frame: {:.1f}".format(
+            sttinf, numero, vis.caminhos, vis.rastreador.estatisticas(),
+            vis.avaliacoes / max(1, sum(vis.caminhos.values()))))
         
     def _treinar(self):
         """Executa o treinamento em um video"""
-        self.framesTotal = int(self._video.get(cv2.CAP_PROP_FRAME_COUNT)/int(30/self.fps))
-        self.feitos = 0
+        self.framesTotal = self._video.total
+
+        if self._rotulador is not None:
+            lotes = self._lotesSegmentos()
+        else:
+            lotes = self._lotesThreads()
+
+        # classifica o próximo lote enquanto o atual é treinado
+        if self.sobrepor:
+            lotes = self._produzirEmParalelo(lotes)
+
+        try:
+            for frames, rotulos, prefixo, proxima in lotes:
+                novos = len(frames) - prefixo
+                if novos <= 0:
+                    continue
+
+                self._data_set = frames, rotulos
+                self._fitRNN()
+                self.feitos += novos
+
+                print("[{}] Fim do treinamento do batch. {}% Completo".format(sttwrn, int((self.feitos/self.framesTotal)*100)))
+
+                # salva o modelo e depois o manifesto, para poder retomar daqui
+                self._consumido = proxima
+                if self.duplicatas is not None:
+                    self.duplicatas.confirmar()
+                otimizador = self._salvar()
+                self._aleatorio = estadoAleatorio()
+                self.progresso.registrar(self._caminhoVideo, self.fps, proxima, self.feitos,
+                    otimizador=otimizador, aleatorio=self._aleatorio)
+
+                # limpa o batch
+                self._data_set = [],[]
+        finally:
+            # com --sobrepor, espera a thread produtora parar de ler o
+            # video antes que `iniciar` passe para o próximo
+            lotes.close()
+
+    def _produzirEmParalelo(self, lotes):
+        """Consome o gerador `lotes` em uma thread produtora, guardando até
+        `profundidade` lotes prontos em uma fila. Quando a fila está cheia
+        a produtora espera, então a memória fica limitada. Quando este
+        gerador é fechado (fim do video ou interrupção), a produtora para
+        depois do lote em andamento e só então ele retorna."""
+        fila = queue.Queue(maxsize=self.profundidade)
+        fim = object()
+        parar = Event()
+
+        def colocar(item):
+            """Põe o item na fila, desistindo se a produção for parada"""
+            while not parar.is_set():
+                try:
+                    fila.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produzir():
+            try:
+                for lote in lotes:
+                    if not colocar(lote):
+                        break
+            except Exception as erro:
+                colocar(erro)
+            finally:
+                lotes.close()
+            colocar(fim)
+
+        produtora = Thread(target=produzir, daemon=True)
+        produtora.start()
+
+        try:
+            while True:
+                lote = fila.get()
+                if lote is fim:
+                    return
+                if isinstance(lote, Exception):
+                    raise lote
+                yield lote
+        finally:
+            parar.set()
+            produtora.join()
+
+    def _lotesThreads(self):
+        """Gera os lotes classificados pelas threads, um por vez, junto
+        com a amostra onde o próximo lote começa"""
 
         # Lê o video até o fim
         while True:
             
-            if not ((self.framesTotal - self.feitos) >= self.frames):
+            if not ((self.framesTotal - self._video.amostra) >= self.frames):
                 print("[{}] Não tem frames suficientes para completar o batch!".format(sttinf))
                 break
             
-            self._iniciarClassificacao()
+            inicio = self._video.amostra
+            if self.armazem is not None and self.armazem.contem(self._chaveArmazem, inicio, inicio+self.frames):
+                # o leitor pula as amostras lidas do armazém, como se tivesse lido
+                frames, rotulos = self.armazem.ler(self._chaveArmazem, inicio, inicio+self.frames)
+                self._video.buscar(inicio + self.frames + 1)
+            else:
+                frames, rotulos = self._iniciarClassificacao()
+                if self._cache is not None:
+                    self._cache.salvar()
+                # com várias threads os frames não ficam em ordem de amostra
+                if self.armazem is not None and self.nthreads == 1 and len(frames) > 0:
+                    self.armazem.adicionar(self._chaveArmazem, inicio,
+                        numpy.array(frames), numpy.array(rotulos))
 
-            if len(self._data_set[0]) > 0:
-                self._fitRNN()
-                self.feitos += len(self._data_set[0])
-                
-                print("[{}] Fim do treinamento do batch. {}% Completo".format(sttwrn, int((self.feitos/self.framesTotal)*100)))
+            # fim do video antes do esperado
+            if len(frames) == 0:
+                break
 
-                # limpa o batch
-                self._data_set[0].clear()
-                self._data_set[1].clear()
+            yield frames, rotulos, 0, self._video.amostra
         
+    def _lotesSegmentos(self):
+        """Gera os lotes classificados em segmentos pelo pool de processos.
+        Cada processo decodifica um segmento de `frames` frames ao mesmo
+        tempo que os outros. Cada segmento começa com os `time_steps`
+        frames anteriores a ele, usados só como histórico: assim nenhuma
+        janela que cruza a fronteira entre segmentos é perdida ou repetida."""
+        while True:
+            restantes = (self.framesTotal - self._posicao) // self.frames
+            if restantes == 0:
+                print("[{}] Não tem frames suficientes para completar o batch!".format(sttinf))
+                break
+
+            quantidade = min(self.processos, restantes)
+            inicios = [self._posicao + i*self.frames for i in range(quantidade)]
+            segmentos = self._lerSegmentos(inicios)
+            if segmentos is None:
+                print("[{}] Classificando {} segmentos".format(sttinf, quantidade))
+                segmentos = self._rotulador.rotular(self._caminhoVideo, inicios,
+                    self.frames, self.fps, self.time_steps, self._cache)
+                if self._cache is not None:
+                    self._cache.salvar()
+                if self.armazem is not None:
+                    for inicio, (frames, rotulos, prefixo) in zip(inicios, segmentos):
+                        self.armazem.adicionar(self._chaveArmazem, inicio, frames[prefixo:], rotulos[prefixo:])
+            self._posicao += quantidade*self.frames
+            for inicio, segmento in zip(inicios, segmentos):
+                yield segmento + (inicio + self.frames,)
+
+            # fim do video antes do esperado
+            if any(len(frames) - prefixo < self.frames for frames, _, prefixo in segmentos):
+                break
+
+    def _lerSegmentos(self, inicios):
+        """Lê os segmentos direto do armazém, com o mesmo histórico que a
+        classificação teria. Retorna None se algum não estiver lá."""
+        if self.armazem is None:
+            return None
+        segmentos = []
+        for inicio in inicios:
+            comeco = max(0, inicio - self.time_steps)
+            if not self.armazem.contem(self._chaveArmazem, comeco, inicio + self.frames):
+                return None
+            frames, rotulos = self.armazem.ler(self._chaveArmazem, comeco, inicio + self.frames)
+            segmentos.append((frames, rotulos, inicio - comeco))
+        print("[{}] {} segmentos lidos do armazém".format(sttinf, len(segmentos)))
+        return segmentos
+
     def _atualizarLog(self, historico):
         info = Info(
-            acc = list(map(float, historico.history['accuracy'])), 
-            loss = list(map(float, historico.history['loss'])),
-            rotulos = self._data_set[1],
+            acc = list(map(float, historico['accuracy'])), 
+            loss = list(map(float, historico['loss'])),
+            rotulos = list(map(int, self._data_set[1])),
             tam_batch = len(self._data_set[0]))
         
         self._log.write(str(info))
 
+    def _pesosJanelas(self):
+        """Pesos das janelas do batch atual segundo o índice de
+        duplicatas, ou None sem o índice"""
+        if self.duplicatas is None:
+            return None
+        with perfil.medir("duplicatas"):
+            pesos = pesosJanelas(self.duplicatas, self._data_set[0], self._data_set[1],
+                self.time_steps, self.pesoDuplicatas)
+        repetidas = int((pesos < 1).sum())
+        self.janelasVideo += len(pesos)
+        self.repetidasVideo += repetidas
+        perfil.contar("janelas_repetidas", repetidas)
+        print("[{}] Janelas quase repetidas: {}/{} ({:.1f}%) {}".format(sttinf, repetidas, len(pesos),
+            100 * repetidas / max(1, len(pesos)),
+            "removidas" if self.pesoDuplicatas == 0 else "com peso {}".format(self.pesoDuplicatas)))
+        return pesos
+
     def _fitRNN(self):
+        pesos = self._pesosJanelas()
+        quantidade = max(0, len(self._data_set[0]) - self.time_steps) if pesos is None else int((pesos > 0).sum())
         treinar = True
         while treinar:
-            gerador = TimeseriesGenerator(
-                numpy.array(self._data_set[0])/255.0, 
-                numpy.array(self._data_set[1]), 
-                length=self.time_steps,
-                batch_size=self.batch_size)
-            historico = inteligencia.modelo.fit_generator(
-                gerador,
-                epochs=self.epochs,
-                shuffle=self.suffle,
-                verbose=1)
+            # o embaralhamento vem do `random`, cujo estado vai para o
+            # manifesto, para que um treinamento retomado o repita
+            semente = random.randrange(2**31)
+            if self._paralelo is not None:
+                # cada trabalhador monta as janelas com a mesma semente
+                with perfil.medir("fit"):
+                    historico, _ = self._paralelo.treinar(*self._data_set,
+                        semente=semente, pesos=pesos)
+            else:
+                with perfil.medir("janelas"):
+                    janelas = self._janelas(pesos, semente)
+                with perfil.medir("fit"):
+                    historico = inteligencia.modelo.fit(
+                        janelas,
+                        epochs=self.epochs,
+                        verbose=1).history
+            perfil.contar("janelas_treinadas", quantidade * self.epochs)
             self._atualizarLog(historico)
 
             if self._iterativo:
@@ -232,6 +562,11 @@ class Treinamento:
             else:
                 treinar = False
         
+    def _janelas(self, pesos=None, semente=None):
+        """Monta o `tf.data.Dataset` de janelas do batch atual"""
+        return montarJanelas(self._data_set[0], self._data_set[1], self.time_steps,
+            self.batch_size, self.suffle, self.tamanhoEmbaralhamento, semente, pesos)
+
     def _exibirInfoTreinamento(self, total, feitos):
         """Print de informações sobre o andamento do treinamento"""
         progresso = int((feitos/total)*100)
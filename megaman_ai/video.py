@@ -0,0 +1,45 @@
+"""
+video.py
+
+Leitura de videos com subamostragem de frames.
+"""
+
+import cv2
+
+from .perfil import cronometrado
+
+class LeitorAmostrado:
+    """Lê um video entregando um frame a cada `taxa` frames, para
+    simular `fps` frames por segundo.
+    A taxa é calculada a partir do fps real do video. Os frames
+    descartados só passam por `grab()`, sem serem convertidos para BGR."""
+
+    def __init__(self, caminho, fps):
+        self.caminho = caminho
+        self.captura = cv2.VideoCapture(caminho)
+        # alguns containers não informam o fps; assume o do NES gravado
+        self.fpsOrigem = self.captura.get(cv2.CAP_PROP_FPS) or 30
+        self.taxa = max(1, int(round(self.fpsOrigem / fps)))
+        self.total = int(self.captura.get(cv2.CAP_PROP_FRAME_COUNT)) // self.taxa
+        # índice da próxima amostra entregue por `ler`
+        self.amostra = 0
+
+    def buscar(self, amostra):
+        """Posiciona o leitor na `amostra`-ésima amostra do video"""
+        self.captura.set(cv2.CAP_PROP_POS_FRAMES, amostra * self.taxa)
+        self.amostra = amostra
+
+    @cronometrado("decodificacao")
+    def ler(self):
+        """Retorna a próxima amostra ou None no fim do video"""
+        for _ in range(self.taxa-1):
+            if not self.captura.grab():
+                return None
+        ok, frame = self.captura.read()
+        if not ok:
+            return None
+        self.amostra += 1
+        return frame
+
+    def fechar(self):
+        self.captura.release()
@@ -1,93 +1,464 @@
 import cv2
 import numpy
 import os
+import yaml
+from collections import namedtuple
+
+from .perfil import cronometrado
+
+# Um template pronto para o casamento: sprite e máscara já binarizados
+# e espelhados para a direção indicada.
+Modelo = namedtuple("Modelo", ["estado", "direcao", "sprite", "mascara"])
+
+class MotorOpenCV:
+    """Casamento com `cv2.matchTemplate` (TM_SQDIFF com máscara)"""
+
+    def __init__(self, modelos):
+        self.modelos = modelos
+
+    def preparar(self, imagem):
+        return imagem
+
+    def casar(self, imagem, i):
+        """Retorna a menor pontuação do modelo `i` na imagem e sua posição"""
+        modelo = self.modelos[i]
+        encontrado = cv2.matchTemplate(imagem, modelo.sprite, cv2.TM_SQDIFF, None, modelo.mascara)
+        status = cv2.minMaxLoc(encontrado)
+        return status[0], status[2]
+
+class MotorCorrelacao:
+    """Casamento por correlação, que aproveita a binarização dos frames
+    e sprites (0/255).
+    Nesse caso o TM_SQDIFF com máscara é o número de pixels divergentes
+    dentro da máscara vezes 255². Com o frame I, o sprite T e a máscara
+    M em 0/1, esse número é soma(M·I) - 2·soma(M·T·I) + soma(M·T): a
+    correlação do frame com o kernel M - 2·M·T mais uma constante. Cada
+    template vira uma única correlação sem máscara (TM_CCORR), bem mais
+    barata que o TM_SQDIFF com máscara. As contagens são arredondadas
+    para os inteiros exatos, então entre posições empatadas fica sempre
+    a primeira."""
+
+    def __init__(self, modelos):
+        self.kernels = []
+        for modelo in modelos:
+            mascara = modelo.mascara > 0
+            sprite = (modelo.sprite > 0) & mascara
+            kernel = mascara.astype(numpy.float32) - 2*sprite.astype(numpy.float32)
+            self.kernels.append((kernel, float(sprite.sum())))
+
+    def preparar(self, imagem):
+        return (imagem > 0).astype(numpy.float32)
+
+    def casar(self, preparada, i):
+        """Retorna a menor pontuação do modelo `i` na imagem e sua posição"""
+        kernel, constante = self.kernels[i]
+        contagem = cv2.matchTemplate(preparada, kernel, cv2.TM_CCORR)
+        contagem += constante
+        numpy.rint(contagem, out=contagem)
+        status = cv2.minMaxLoc(contagem)
+        return status[0] * 255.0**2, status[2]
+
+MOTORES = {"opencv": MotorOpenCV, "correlacao": MotorCorrelacao}
+
+class BancoSprites:
+    """Conjunto de sprites e máscaras carregados uma única vez.
+    Guarda todos os templates nas duas direções como arrays contíguos
+    e somente leitura, para que várias instâncias de `MegaMan` (uma por
+    thread de classificação) compartilhem o mesmo banco.
+    Também guarda uma cópia reduzida (`escala`) de cada template, usada
+    na busca grosseira quando o megaman é perdido.
+    O motor de casamento ("opencv" ou "correlacao") vem da chave `motor` e a
+    reaquisição grosseira-para-fina pode ser desligada pela chave
+    `reaquisicao`."""
+
+    escala = 0.5
 
-class MegaMan:
-    sprites = {}
-    classes = []
-    frame   = False
-    estado  = None
-    direcao = 0
-    posicao = None
-    sobra   = 20
-    rotulo  = -1
-    
     def __init__(self, sprites):
+        self.nomeMotor = sprites.get("motor") or "opencv"
+        self.reaquisicao = bool(sprites.get("reaquisicao", True))
         pastaSprite = sprites["sprites"]
         pastaMascara = sprites["mascaras"]
         extencao = sprites["extencao"]
         estados = sprites["estados"]
 
+        self.estados = list(estados.keys())
+        self.modelos = []
+        self.reduzidos = []
+        self.classes = []
+
         # abre os sprites e máscaras
         for estado in estados:
-            novoEstado = {"sprites": [], "mascaras": []}
             for arquivo in estados[estado]['sprites']:
                 sprite = cv2.imread("{}/{}.{}".format(pastaSprite, arquivo, extencao), 1)
-                novoEstado["sprites"].append(MegaMan.transformar(sprite))
+                sprite = MegaMan.transformar(sprite)
                 mascara = cv2.imread("{}/{}.{}".format(pastaMascara, arquivo, extencao), 0)
-                novoEstado["mascaras"].append(mascara)
-            self.sprites[estado] = novoEstado
-        
+
+                for direcao in ['r', 'l']:
+                    if direcao == 'l':
+                        self.modelos.append(Modelo(estado, direcao,
+                            BancoSprites._congelar(cv2.flip(sprite, 1)),
+                            BancoSprites._congelar(cv2.flip(mascara, 1))))
+                    else:
+                        self.modelos.append(Modelo(estado, direcao,
+                            BancoSprites._congelar(sprite),
+                            BancoSprites._congelar(mascara)))
+
+        # templates reduzidos para a busca grosseira (mesma ordem de `modelos`)
+        for modelo in self.modelos:
+            self.reduzidos.append(modelo._replace(
+                sprite=BancoSprites._congelar(self.reduzir(modelo.sprite)),
+                mascara=BancoSprites._congelar(self.reduzir(modelo.mascara))))
+
+        # motor de casamento escolhido para os templates normais e reduzidos
+        self.motor = MOTORES[self.nomeMotor](self.modelos)
+        self.motorReduzido = MOTORES[self.nomeMotor](self.reduzidos)
+
+        # maior template, usado para dimensionar as regiões de refinamento
+        self.altura = max(m.sprite.shape[0] for m in self.modelos)
+        self.largura = max(m.sprite.shape[1] for m in self.modelos)
+
         # rótulos
-        for classe in self.sprites.keys():
+        for classe in self.estados:
             self.classes.append(classe+'-l')
             self.classes.append(classe+'-r')
 
-    def janela(self, imagem):
-        if self.posicao != None:
-            x, y = self.posicao
-            descy = y + 31 + self.sobra
-            descx = x + 25 + self.sobra
-            if y > self.sobra and x > self.sobra and \
-                    descy < imagem.shape[0] and descx < imagem.shape[1]:
-                return imagem[y-self.sobra:descy, x-self.sobra:descx]
-            else:
-                self.posicao = None
+    def reduzir(self, imagem):
+        """Reduz uma imagem binarizada mantendo os valores 0/255"""
+        return cv2.resize(imagem, None, fx=self.escala, fy=self.escala,
+            interpolation=cv2.INTER_NEAREST)
+
+    @staticmethod
+    def _congelar(imagem):
+        imagem = numpy.ascontiguousarray(imagem)
+        imagem.setflags(write=False)
         return imagem
 
+class TabelaTransicoes:
+    """Frequência das transições entre rótulos, aprendida de dados já
+    rotulados. Dado o rótulo anterior, ordena os templates do banco
+    do mais para o menos provável, para que `MegaMan` encontre o
+    casamento certo nas primeiras avaliações."""
+
+    def __init__(self, banco):
+        self.banco = banco
+        n = len(banco.classes)
+        # suavização de laplace: transições nunca vistas continuam possíveis
+        self.contagem = numpy.ones((n, n))
+        self._ordens = {}
+        self._classes = [banco.classes.index(m.estado+"-"+m.direcao) for m in banco.modelos]
+
+    def aprender(self, rotulos):
+        """Conta as transições de uma sequência de rótulos"""
+        for anterior, atual in zip(rotulos[:-1], rotulos[1:]):
+            self.contagem[int(anterior), int(atual)] += 1
+        self._ordens.clear()
+
+    def ordem(self, rotulo):
+        """Índices dos modelos do banco ordenados pela probabilidade
+        da sua classe depois de `rotulo`. Sem rótulo anterior a ordem
+        é a do banco."""
+        if rotulo < 0:
+            return range(len(self.banco.modelos))
+        if not rotulo in self._ordens:
+            linha = self.contagem[rotulo]
+            self._ordens[rotulo] = sorted(range(len(self._classes)),
+                key=lambda i: -linha[self._classes[i]])
+        return self._ordens[rotulo]
+
+    @staticmethod
+    def doLog(caminho, banco):
+        """Cria a tabela a partir dos rótulos de um arquivo de log do
+        treinamento. Se o log não existir a tabela fica uniforme."""
+        tabela = TabelaTransicoes(banco)
+        if os.path.isfile(caminho):
+            log = yaml.safe_load(open(caminho, "r").read()) or {}
+            for info in log.values():
+                tabela.aprender(info["rotulos"])
+        return tabela
+
+class Rastreador:
+    """Prevê a posição do megaman no próximo frame com um modelo de
+    velocidade constante e adapta o tamanho da janela de busca.
+    A janela começa em `minimo` pixels de sobra e volta a encolher a
+    cada acerto. Se o megaman não está nela, a busca é repetida uma
+    única vez no mesmo frame, com a janela `maximo`. `erros` conta os
+    frames em que a janela prevista falhou e `perdas` os frames em que
+    o megaman foi perdido."""
+
+    minimo = 6
+    suavizacao = 0.5
+
+    def __init__(self, maximo):
+        self.maximo = maximo
+        self.posicao = None
+        self.velocidade = (0.0, 0.0)
+        self.sobra = self.minimo
+        self.acertos = 0
+        self.erros = 0
+        self.perdas = 0
+        self.area = 0
+
+    def iniciar(self, posicao):
+        self.posicao = posicao
+        self.velocidade = (0.0, 0.0)
+        self.sobra = self.minimo
+
+    def prever(self):
+        return (int(round(self.posicao[0] + self.velocidade[0])),
+                int(round(self.posicao[1] + self.velocidade[1])))
+
+    def sobras(self):
+        """Tamanhos de janela a tentar em um frame: o atual e o máximo"""
+        if self.sobra < self.maximo:
+            return (self.sobra, self.maximo)
+        return (self.maximo,)
+
+    def mover(self, posicao):
+        """Atualiza a posição e a velocidade estimada"""
+        a = self.suavizacao
+        vx = posicao[0] - self.posicao[0]
+        vy = posicao[1] - self.posicao[1]
+        self.velocidade = (a*vx + (1-a)*self.velocidade[0],
+                           a*vy + (1-a)*self.velocidade[1])
+        self.posicao = posicao
+
+    def acertou(self, posicao, sobra):
+        self.mover(posicao)
+        self.sobra = max(self.minimo, sobra // 2)
+        self.acertos += 1
+        self.area += sobra
+
+    def errou(self):
+        self.erros += 1
+
+    def perder(self):
+        if self.posicao is not None:
+            self.perdas += 1
+        self.esquecer()
+
+    def esquecer(self):
+        self.posicao = None
+        self.velocidade = (0.0, 0.0)
+        self.sobra = self.minimo
+
+    def estatisticas(self):
+        return {
+            "acertos": self.acertos,
+            "erros": self.erros,
+            "perdas": self.perdas,
+            "sobra_media": self.area / self.acertos if self.acertos else 0}
+
+class MegaMan:
+    classes = []
+    frame   = False
+    estado  = None
+    direcao = 0
+    posicao = None
+    sobra   = 20
+    rotulo  = -1
+    caminho = None
+    # reaquisição grosseira-para-fina quando o megaman é perdido; quando
+    # o refinamento não é conclusivo a busca completa decide, então os
+    # rótulos são os mesmos da busca completa
+    reaquisicao = True
+    candidatos  = 3
+    margem      = 4
+    # diferença mínima de pontuação para aceitar um casamento antes
+    # de avaliar todos os templates
+    folga       = 10
+    
+    def __init__(self, sprites, tabela=None):
+        # aceita um banco já carregado para evitar reabrir os sprites
+        if isinstance(sprites, BancoSprites):
+            self.banco = sprites
+        else:
+            self.banco = BancoSprites(sprites)
+        self.classes = self.banco.classes
+        self.reaquisicao = self.banco.reaquisicao
+        # informações sobre a última chamada de `atualizar` e
+        # contagem de frames por caminho de busca
+        self.relatorio = {}
+        self.caminhos = {}
+        self.rastreador = Rastreador(self.sobra)
+        self.tabela = tabela
+        self.avaliacoes = 0
+
+    def janela(self, imagem, sobra):
+        """Recorta a região de `sobra` pixels em volta da posição prevista
+        pelo rastreador. Retorna o recorte e a origem dele na imagem."""
+        x, y = self.rastreador.prever()
+        x0 = min(max(0, x - sobra), imagem.shape[1] - self.banco.largura)
+        y0 = min(max(0, y - sobra), imagem.shape[0] - self.banco.altura)
+        x1 = min(imagem.shape[1], x + self.banco.largura + sobra)
+        y1 = min(imagem.shape[0], y + self.banco.altura + sobra)
+        return imagem[y0:y1, x0:x1], (x0, y0)
+
+    @cronometrado("rotulagem")
     def atualizar(self, imagem, threashold):
-        melhor  = 100
+        self.relatorio = {}
+        melhor = 100
+
+        if self.posicao != None:
+            # tenta a janela prevista e, se o casamento piorar, a maior
+            self.caminho = "rastreado"
+            sobras = self.rastreador.sobras()
+            for sobra in sobras:
+                janela, origem = self.janela(imagem, sobra)
+                melhor, estado, direcao, posicao = self._buscar(janela, aceitar=threashold)
+                if melhor <= threashold:
+                    posicao = (origem[0]+posicao[0], origem[1]+posicao[1])
+                    self.rastreador.acertou(posicao, sobra)
+                    break
+                if sobra == sobras[0]:
+                    self.rastreador.errou()
+        else:
+            resultado = self._reaquirir(imagem, threashold) if self.reaquisicao else None
+            if resultado is not None:
+                melhor, estado, direcao, posicao = resultado
+                self.caminho = "reaquisicao"
+            else:
+                melhor, estado, direcao, posicao = self._buscar(imagem, aceitar=threashold)
+                self.caminho = "completo"
+
+        if melhor <= threashold:
+            self.estado = estado+"-"+direcao
+            self.rotulo = self.classes.index(self.estado)
+            if self.posicao == None:
+                self.rastreador.iniciar(posicao)
+            self.posicao = posicao
+        else:
+            self.estado = None
+            self.rotulo = 0
+            self.posicao = None
+            self.rastreador.perder()
+
+        self.relatorio["caminho"] = self.caminho
+        self.relatorio["qualidade"] = melhor
+        self.caminhos[self.caminho] = self.caminhos.get(self.caminho, 0) + 1
+        return melhor
+
+    def restaurar(self, rotulo, posicao):
+        """Deixa a instância como depois de `atualizar` em um frame cujo
+        rótulo e posição já são conhecidos (vindos do cache), para que o
+        próximo frame classificado parta do mesmo rastreamento. Não conta
+        nas estatísticas de busca."""
+        if posicao is None:
+            self.estado = None
+            self.rotulo = 0
+            self.posicao = None
+            self.rastreador.esquecer()
+            return
+        self.estado = self.classes[rotulo]
+        self.rotulo = rotulo
+        if self.posicao is None:
+            self.rastreador.iniciar(posicao)
+        else:
+            self.rastreador.mover(posicao)
+        self.posicao = posicao
+
+    def _buscar(self, imagem, melhor=100, aceitar=None):
+        """Casa os modelos do banco na imagem e retorna o melhor resultado
+        (pontuação, estado, direção, posição).
+        Com `aceitar` e uma tabela de transições, os modelos são avaliados
+        na ordem mais provável e a busca para assim que um casamento fica
+        abaixo de `aceitar` com `folga` para o melhor de outra classe já
+        avaliado; sem nenhum concorrente avaliado ela continua. Em caso de
+        dúvida todos são avaliados. Entre os modelos avaliados, empates
+        são decididos pela ordem do banco."""
         estado  = None
         posicao = None
         direcao = ""
-        janela = self.janela(imagem)
-
-        for _estado in self.sprites:
-            todos = self.sprites[_estado]["sprites"]
-
-            for i in range(len(todos)):
-                
-                _sprite = self.sprites[_estado]["sprites"][i]
-                _mask   = self.sprites[_estado]["mascaras"][i]
-            
-                for _direcao in ['r', 'l']:
-                    if _direcao == 'l':
-
-                        _sprite = cv2.flip(_sprite, 1)
-                        _mask   = cv2.flip(_mask, 1)
-
-                    encontrado  = cv2.matchTemplate(janela, _sprite, cv2.TM_SQDIFF, None, _mask)
-                    status      = cv2.minMaxLoc(encontrado)
-
-                    if status[0] < melhor:
-                        melhor  = status[0]
-                        estado  = _estado
-                        direcao = _direcao
-                        posicao = status[2]
+        indice  = -1
+        segundo = float("inf")
+
+        modelos = self.banco.modelos
+        if aceitar is None or self.tabela is None:
+            ordem = range(len(modelos))
         else:
-            if melhor <= threashold:
-                self.estado = estado+"-"+direcao
-                self.rotulo = self.classes.index(self.estado)
-                if self.posicao == None:
-                    self.posicao = posicao
-                else:
-                    self.posicao = (self.posicao[0]-self.sobra+posicao[0], self.posicao[1]-self.sobra+posicao[1]) 
-            else:
-                self.estado = None
-                self.rotulo = 0
-                self.posicao = None
-        return melhor
+            ordem = self.tabela.ordem(self.rotulo)
+
+        preparada = self.banco.motor.preparar(imagem)
+        for i in ordem:
+            modelo = modelos[i]
+            pontuacao, local = self.banco.motor.casar(preparada, i)
+            self.avaliacoes += 1
+            outro = modelo.estado != estado or modelo.direcao != direcao
+
+            if (pontuacao, i) < (melhor, indice):
+                if outro and estado is not None:
+                    segundo = melhor
+                melhor  = pontuacao
+                indice  = i
+                estado  = modelo.estado
+                direcao = modelo.direcao
+                posicao = local
+            elif outro:
+                segundo = min(segundo, pontuacao)
+
+            if aceitar is not None and self.tabela is not None and \
+                    melhor <= aceitar - self.folga and segundo != float("inf") and \
+                    segundo - melhor > self.folga:
+                break
+
+        return melhor, estado, direcao, posicao
+
+    def _reaquirir(self, imagem, aceitar):
+        """Busca grosseira-para-fina usada quando o megaman foi perdido.
+        Procura em uma versão reduzida do frame, e só então refina em
+        resolução cheia ao redor dos `candidatos` melhores locais.
+        O refinamento só é aceito com `folga` abaixo de `aceitar`; sem
+        isso retorna None e a busca completa decide."""
+        escala = self.banco.escala
+        reduzida = self.banco.reduzir(imagem)
+
+        # busca grosseira: melhor local de cada template reduzido
+        grosseiros = []
+        preparada = self.banco.motorReduzido.preparar(reduzida)
+        for i in range(len(self.banco.reduzidos)):
+            grosseiros.append(self.banco.motorReduzido.casar(preparada, i))
+        grosseiros.sort(key=lambda g: g[0])
+
+        # escolhe os k melhores locais distintos
+        locais = []
+        for _, (x, y) in grosseiros:
+            local = (int(x/escala), int(y/escala))
+            if all(abs(local[0]-l[0]) > self.margem or abs(local[1]-l[1]) > self.margem for l in locais):
+                locais.append(local)
+            if len(locais) == self.candidatos:
+                break
+
+        # refinamento em resolução cheia ao redor de cada candidato
+        melhor, estado, direcao, posicao = 100, None, "", None
+        for x, y in locais:
+            x0 = max(0, x - self.margem)
+            y0 = max(0, y - self.margem)
+            x1 = min(imagem.shape[1], x + self.banco.largura + self.margem)
+            y1 = min(imagem.shape[0], y + self.banco.altura + self.margem)
+            if x1 - x0 < self.banco.largura or y1 - y0 < self.banco.altura:
+                continue
+            resultado = self._buscar(imagem[y0:y1, x0:x1], melhor)
+            if resultado[1] is not None:
+                melhor, estado, direcao, posicao = resultado
+                posicao = (x0+posicao[0], y0+posicao[1])
+
+        self.relatorio["candidatos"] = len(locais)
+        if estado is None or melhor > aceitar - self.folga:
+            return None
+        return melhor, estado, direcao, posicao
     
+    @staticmethod
+    def divergencias(frames, referencia, candidata, threashold=20):
+        """Passa os mesmos frames (já transformados) pelas duas instâncias
+        e retorna os índices dos frames em que os rótulos divergem.
+        Usado para conferir a busca ordenada contra a exaustiva."""
+        diferentes = []
+        for i, frame in enumerate(frames):
+            referencia.atualizar(frame, threashold)
+            candidata.atualizar(frame, threashold)
+            if referencia.estado != candidata.estado:
+                diferentes.append(i)
+        return diferentes
+
     def desenhar_infos(self, frame, progresso, qualidade):
         try:
             tl = (self.posicao[0], self.posicao[1])
@@ -0,0 +1,63 @@
+import os
+import numpy
+import pytest
+import yaml
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def lerSprites(motor="opencv"):
+    """Configuração do megaman.yaml com as pastas relativas à raiz"""
+    sprites = yaml.safe_load(open(os.path.join(RAIZ, "megaman.yaml")).read())
+    sprites["sprites"] = os.path.join(RAIZ, sprites["sprites"])
+    sprites["mascaras"] = os.path.join(RAIZ, sprites["mascaras"])
+    sprites["motor"] = motor
+    return sprites
+
+def gerarCena(banco, quantidade, semente=0, ausencia=0.1):
+    """Sequência de frames binarizados (224 x 256), como os que chegam a
+    `MegaMan.atualizar`: plataformas e ruído ao fundo e um template do
+    banco colado em uma posição que se move, trocando de estado a cada
+    poucos frames e às vezes sumindo (troca de tela, morte).
+    Retorna os frames e o índice do modelo colado (-1 se ausente)."""
+    aleatorio = numpy.random.default_rng(semente)
+    fundo = numpy.zeros((224, 256), numpy.uint8)
+    for _ in range(12):
+        x, y = aleatorio.integers(0, 240), aleatorio.integers(100, 220)
+        fundo[y:y+aleatorio.integers(2, 8), x:x+aleatorio.integers(8, 48)] = 255
+
+    frames, indices = [], []
+    x, y = 100.0, 120.0
+    vx, vy = 2.0, 0.0
+    modelo = 0
+    ausente = False
+    for i in range(quantidade):
+        if i % 8 == 0:
+            modelo = int(aleatorio.integers(len(banco.modelos)))
+            ausente = aleatorio.random() < ausencia
+            vx, vy = aleatorio.uniform(-4, 4), aleatorio.uniform(-3, 3)
+            if aleatorio.random() < 0.2:
+                # salto grande, como depois de uma troca de tela
+                x, y = aleatorio.uniform(10, 220), aleatorio.uniform(10, 180)
+
+        frame = fundo.copy()
+        ruido = aleatorio.random((224, 256)) < 0.002
+        frame[ruido] = 255
+        sprite, mascara = banco.modelos[modelo].sprite, banco.modelos[modelo].mascara
+        h, w = sprite.shape
+        x = min(max(0.0, x + vx), 256 - w)
+        y = min(max(0.0, y + vy), 224 - h)
+        if not ausente:
+            regiao = frame[int(y):int(y)+h, int(x):int(x)+w]
+            regiao[mascara > 0] = sprite[mascara > 0]
+        frames.append(frame)
+        indices.append(-1 if ausente else modelo)
+    return frames, indices
+
+@pytest.fixture(scope="session")
+def banco():
+    visao = pytest.importorskip("megaman_ai.visao")
+    return visao.BancoSprites(lerSprites())
+
+@pytest.fixture(scope="session")
+def cena(banco):
+    return gerarCena(banco, 160)
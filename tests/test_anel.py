@@ -0,0 +1,55 @@
+from multiprocessing import get_context
+import numpy
+import pytest
+
+from megaman_ai.anel import AnelFrames
+from megaman_ai.protocolo import FORMATO_ARGB, FORMATO_BGR
+
+def tela(seq):
+    """Frame BGR conhecido pelos dois lados a partir do número"""
+    return numpy.random.default_rng(seq).integers(0, 256, (240, 256, 3), dtype=numpy.uint8)
+
+def emulador(caminho, formato, rodadas, escreva, escrito):
+    """Processo que faz o papel do emulador: a cada pedido escreve a
+    próxima leva de frames no anel e avisa"""
+    anel = AnelFrames(caminho)
+    seq = 0
+    for quantidade in rodadas:
+        escreva.wait()
+        escreva.clear()
+        for _ in range(quantidade):
+            anel.escrever(seq, tela(seq), formato)
+            seq += 1
+        escrito.set()
+    anel.fechar()
+
+@pytest.mark.parametrize("formato", [FORMATO_BGR, FORMATO_ARGB])
+def test_anel_com_produtor_em_outro_processo(tmp_path, formato):
+    caminho = str(tmp_path / "anel")
+    anel = AnelFrames.criar(caminho, slots=4)
+    contexto = get_context("spawn")
+    escreva, escrito = contexto.Event(), contexto.Event()
+    rodadas = [1, 3, 10, 1]
+    produtor = contexto.Process(target=emulador, args=(caminho, formato, rodadas, escreva, escrito))
+    produtor.start()
+
+    try:
+        assert anel.maisRecente() is None
+        enviados = 0
+        for quantidade in rodadas:
+            escrito.clear()
+            escreva.set()
+            assert escrito.wait(30)
+            enviados += quantidade
+            seq, imagem = anel.maisRecente()
+            assert seq == enviados - 1
+            assert imagem.shape == (240, 256, 3)
+            assert (imagem == tela(seq)).all()
+            # sem frame novo não há o que ler
+            assert anel.maisRecente() is None
+        # todos os frames entre duas leituras foram pulados
+        assert anel.pulados == enviados - len(rodadas)
+    finally:
+        produtor.join(30)
+        anel.fechar(remover=True)
+    assert produtor.exitcode == 0
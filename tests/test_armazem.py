@@ -0,0 +1,35 @@
+import numpy
+import pytest
+
+pytest.importorskip("cv2")
+armazem = pytest.importorskip("megaman_ai.armazem")
+visao = pytest.importorskip("megaman_ai.visao")
+
+def amostras(inicio, fim):
+    frames = numpy.zeros((fim - inicio, armazem.TAMANHO_FRAME), numpy.uint8)
+    frames[:, 0] = numpy.arange(inicio, fim) % 256
+    frames[:, 1] = numpy.arange(inicio, fim) // 256
+    return frames, (numpy.arange(inicio, fim) % 20).astype(numpy.uint8)
+
+def test_intervalos_sobrepostos_nao_se_repetem(tmp_path):
+    guardado = armazem.Armazem(str(tmp_path))
+    for inicio, fim in ((0, 10), (20, 30), (5, 25), (28, 40), (0, 40)):
+        guardado.adicionar("video", inicio, *amostras(inicio, fim))
+
+    assert sum(guardado.indice["shards"]) == 40
+    registros = guardado.indice["videos"]["video"]
+    cobertos = [i for r in registros for i in range(r["inicio"], r["inicio"] + r["quantidade"])]
+    assert sorted(cobertos) == list(range(40))
+
+    frames, rotulos = guardado.ler("video", 0, 40)
+    esperados, rotulosEsperados = amostras(0, 40)
+    assert (frames == esperados).all()
+    assert (rotulos == rotulosEsperados).all()
+
+def test_chave_depende_da_busca(tmp_path, banco):
+    video = tmp_path / "video.mp4"
+    video.write_bytes(b"megaman")
+    guardado = armazem.Armazem(str(tmp_path / "armazem"))
+    chaves = {guardado.chave(str(video), 30, banco), guardado.chave(str(video), 15, banco),
+        guardado.chave(str(video), 30, banco, visao.TabelaTransicoes(banco))}
+    assert len(chaves) == 3
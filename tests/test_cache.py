@@ -0,0 +1,37 @@
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+visao = pytest.importorskip("megaman_ai.visao")
+cache = pytest.importorskip("megaman_ai.cache")
+
+def test_trecho_do_cache_mantem_o_rastreamento(banco, cena):
+    frames, _ = cena
+    frames = [cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR) for frame in frames[:64]]
+
+    # referência sem cache, guardando o estado depois de cada frame
+    completo = cache.TrechoRotulos(0, *cache.TrechoRotulos.vazio(len(frames)))
+    vis = visao.MegaMan(banco)
+    estados = []
+    for amostra, frame in enumerate(frames):
+        completo.rotular(vis, amostra, frame)
+        estados.append((vis.rotulo, vis.posicao, vis.rastreador.posicao))
+
+    # mesmo video com as amostras 16-40 já no cache
+    parcial = cache.TrechoRotulos(0, *cache.TrechoRotulos.vazio(len(frames)))
+    parcial.rotulos[16:40] = completo.rotulos[16:40]
+    parcial.posicoes[16:40] = completo.posicoes[16:40]
+    vis = visao.MegaMan(banco)
+    for amostra, frame in enumerate(frames):
+        parcial.rotular(vis, amostra, frame)
+        assert (vis.rotulo, vis.posicao, vis.rastreador.posicao) == estados[amostra]
+    assert parcial.acertos == 24
+    assert (parcial.rotulos == completo.rotulos).all()
+
+def test_chave_depende_da_busca(banco, cena):
+    _, indices = cena
+    tabela = visao.TabelaTransicoes(banco)
+    classes = [banco.classes.index(m.estado+"-"+m.direcao) for m in banco.modelos]
+    tabela.aprender([classes[i] for i in indices if i >= 0])
+    chaves = {cache.hashBanco(banco), cache.hashBanco(banco, limiar=10),
+        cache.hashBanco(banco, tabela), cache.hashBanco(banco, visao.TabelaTransicoes(banco))}
+    assert len(chaves) == 4
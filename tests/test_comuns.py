@@ -0,0 +1,45 @@
+import numpy
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+
+from megaman_ai.comuns import mm_resize, preprocessar, preprocessarLote
+
+def referencia(frame):
+    """O pré-processamento original: recorte, cinza e `mm_resize`"""
+    frame = frame[:224]
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return mm_resize(frame).flatten()
+
+def pilha(quantidade, altura, cor, semente=0):
+    aleatorio = numpy.random.default_rng(semente)
+    forma = (quantidade, altura, 256, 3) if cor else (quantidade, altura, 256)
+    frames = aleatorio.integers(0, 256, forma, dtype=numpy.uint8)
+    # regiões lisas e valores perto do corte dos pixels escuros
+    frames[:, :40] = 0
+    frames[:, 40:80] = 255
+    frames[:, 80:120] = aleatorio.integers(30, 50, frames[:, 80:120].shape, dtype=numpy.uint8)
+    return frames
+
+@pytest.mark.parametrize("altura", [240, 224])
+@pytest.mark.parametrize("cor", [True, False])
+@pytest.mark.parametrize("quantidade", [1, 4, 5, 33])
+def test_lote_igual_a_referencia(altura, cor, quantidade):
+    frames = pilha(quantidade, altura, cor, semente=quantidade)
+    esperado = numpy.array([referencia(frame) for frame in frames])
+    lote = preprocessarLote(frames)
+    assert lote.shape == (quantidade, 2016)
+    assert lote.dtype == numpy.uint8
+    assert (lote == esperado).all()
+
+@pytest.mark.parametrize("cor", [True, False])
+def test_um_frame_igual_a_referencia(cor):
+    for frame in pilha(8, 240, cor):
+        assert (preprocessar(frame) == referencia(frame)).all()
+
+def test_frames_da_cena(cena):
+    frames, _ = cena
+    coloridos = numpy.array([cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR) for frame in frames[:40]])
+    esperado = numpy.array([referencia(frame) for frame in coloridos])
+    assert (preprocessarLote(coloridos) == esperado).all()
@@ -0,0 +1,97 @@
+import numpy
+import pytest
+
+from conftest import gerarCena
+from megaman_ai.comuns import preprocessarLote
+from megaman_ai.duplicatas import hashPerceptual, distancia, IndiceDuplicatas, pesosJanelas
+
+LIMIAR = 3
+
+@pytest.fixture(scope="module")
+def frames(banco):
+    cena, _ = gerarCena(banco, 300, semente=3)
+    return preprocessarLote(numpy.array(cena))
+
+def test_hash_de_um_lote_grande(frames):
+    hashes = hashPerceptual(frames)
+    assert hashes.dtype == numpy.uint64 and hashes.shape == (300,)
+    # o lote dá o mesmo hash que cada frame sozinho
+    sozinhos = numpy.concatenate([hashPerceptual(frame[numpy.newaxis]) for frame in frames[::37]])
+    assert (hashes[::37] == sozinhos).all()
+    assert len(numpy.unique(hashes)) > 1
+
+def test_frames_iguais_e_quase_iguais_ficam_perto(frames):
+    aleatorio = numpy.random.default_rng(0)
+    quase = frames.copy()
+    # alguns pixels mudam um pouco, como a compressão do video
+    for frame in quase:
+        posicoes = aleatorio.choice(frame.size, 20, replace=False)
+        frame[posicoes] = numpy.clip(frame[posicoes].astype(int) + aleatorio.integers(-3, 4, 20), 0, 255)
+    hashes = hashPerceptual(frames)
+    assert (distancia(hashes, hashPerceptual(frames.copy())) == 0).all()
+    assert (distancia(hashes, hashPerceptual(quase)) <= LIMIAR).all()
+
+def test_janelas_repetidas(frames):
+    rotulos = numpy.zeros(len(frames), numpy.uint8)
+    indice = IndiceDuplicatas(limiar=LIMIAR, time_steps=10)
+    pesos = pesosJanelas(indice, frames, rotulos, 10)
+    assert pesos.shape == (290,) and pesos[0] == 1
+    # o mesmo trecho de novo só tem janelas repetidas, menos a primeira
+    # de cada rótulo
+    repetidas = pesosJanelas(indice, frames, rotulos, 10)
+    assert repetidas[0] == 1 and (repetidas[1:] == 0).all()
+
+def test_so_grava_janelas_confirmadas(frames, tmp_path):
+    rotulos = numpy.zeros(len(frames), numpy.uint8)
+    caminho = str(tmp_path / "duplicatas.npz")
+    indice = IndiceDuplicatas(caminho, LIMIAR, 10)
+    pesosJanelas(indice, frames[:150], rotulos[:150], 10)
+    indice.confirmar()
+    confirmadas = indice.quantidade
+
+    # batch interrompido antes do fit: as janelas dele não são gravadas
+    pesosJanelas(indice, frames[150:], rotulos[150:], 10)
+    assert indice.pendentes > 0
+    indice.salvar()
+    assert IndiceDuplicatas(caminho, LIMIAR, 10).quantidade == confirmadas
+    indice.descartar()
+
+    # ao retomar, o mesmo batch ainda tem janelas novas
+    retomado = IndiceDuplicatas(caminho, LIMIAR, 10)
+    pesos = pesosJanelas(retomado, frames[150:], rotulos[150:], 10)
+    assert (pesosJanelas(indice, frames[150:], rotulos[150:], 10) == pesos).all()
+    assert (pesos[1:] == 1).any()
+
+def test_janela_com_o_meio_diferente_nao_e_repetida(frames):
+    hashes = hashPerceptual(frames)
+    indice = IndiceDuplicatas(limiar=LIMIAR, time_steps=10)
+    janela = hashes[:10].copy()
+    indice.adicionar(janela, 1)
+    assert indice.repetida(janela, 1)
+
+    # começa e termina nos mesmos frames, mas passa por outro lugar
+    distantes = numpy.flatnonzero(distancia(hashes, janela[5]) > LIMIAR)
+    assert len(distantes) > 0
+    volta = janela.copy()
+    volta[5] = hashes[distantes[0]]
+    assert not indice.repetida(volta, 1)
+
+    # o mesmo pelo `pesosJanelas`: a volta é uma janela nova
+    lote = frames[:11].copy()
+    indice = IndiceDuplicatas(limiar=LIMIAR, time_steps=10)
+    pesosJanelas(indice, lote, numpy.zeros(11, numpy.uint8), 10)
+    pesosJanelas(indice, lote, numpy.zeros(11, numpy.uint8), 10)
+    assert indice.pendentes == 1
+    lote[5] = frames[distantes[0]]
+    pesosJanelas(indice, lote, numpy.zeros(11, numpy.uint8), 10)
+    assert indice.pendentes == 2
+
+def test_indice_guarda_time_steps(frames, tmp_path):
+    caminho = str(tmp_path / "duplicatas.npz")
+    indice = IndiceDuplicatas(caminho, LIMIAR, 10)
+    pesosJanelas(indice, frames[:50], numpy.zeros(50, numpy.uint8), 10)
+    indice.confirmar()
+    indice.salvar()
+    assert IndiceDuplicatas(caminho).time_steps == 10
+    with pytest.raises(ValueError):
+        IndiceDuplicatas(caminho, LIMIAR, 15)
@@ -0,0 +1,56 @@
+import os
+import numpy
+import pytest
+
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+keras = pytest.importorskip("keras")
+
+from megaman_ai.inferencia import MotorInferencia, JanelaDeslizante
+
+TIME_STEPS = 5
+
+@pytest.fixture(scope="module")
+def modelo():
+    """Rede pequena com a mesma estrutura de `nova.py`"""
+    keras.utils.set_random_seed(7)
+    return keras.Sequential([
+        keras.Input((TIME_STEPS, 2016)),
+        keras.layers.LSTM(16, return_sequences=True),
+        keras.layers.Dropout(0.1),
+        keras.layers.LSTM(8),
+        keras.layers.Dropout(0.1),
+        keras.layers.Dense(12),
+        keras.layers.Dense(20, activation="softmax"),
+    ])
+
+@pytest.fixture(scope="module")
+def frames():
+    return numpy.random.default_rng(0).integers(0, 256, (12, 2016), dtype=numpy.uint8)
+
+def test_janela_igual_ao_predict(modelo, frames):
+    motor = MotorInferencia.doKeras(modelo, TIME_STEPS, "janela")
+    janela = JanelaDeslizante(TIME_STEPS, 2016)
+    for frame in frames:
+        janela.acrescentar(frame / 255.0)
+        referencia = numpy.asarray(modelo.predict_on_batch(janela.janela()[numpy.newaxis]))[0]
+        numpy.testing.assert_allclose(motor.passo(frame), referencia, atol=1e-5)
+
+def test_estado_igual_ao_predict_do_historico(modelo, frames):
+    # o motor "estado" vê o histórico inteiro: é o predict da sequência
+    # de todos os frames desde o começo
+    motor = MotorInferencia.doKeras(modelo, TIME_STEPS, "estado")
+    for i, frame in enumerate(frames):
+        historico = (frames[:i+1] / 255.0).astype(numpy.float32)[numpy.newaxis]
+        referencia = numpy.asarray(modelo(historico, training=False))[0]
+        numpy.testing.assert_allclose(motor.passo(frame), referencia, atol=1e-5)
+
+def test_instancias_iguais_a_uma_de_cada_vez(modelo, frames):
+    # 4 passos de 3 jogos
+    passos = frames.reshape(4, 3, 2016)
+    for modo in ("janela", "estado"):
+        lote = MotorInferencia.doKeras(modelo, TIME_STEPS, modo, instancias=3)
+        sozinhos = [MotorInferencia.doKeras(modelo, TIME_STEPS, modo) for _ in range(3)]
+        for passo in passos:
+            saidas = lote.passo(passo)
+            for jogo, motor in enumerate(sozinhos):
+                numpy.testing.assert_allclose(saidas[jogo], motor.passo(passo[jogo]), atol=1e-6)
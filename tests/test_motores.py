@@ -0,0 +1,38 @@
+import numpy
+import pytest
+
+visao = pytest.importorskip("megaman_ai.visao")
+cv2 = pytest.importorskip("cv2")
+
+from conftest import lerSprites, gerarCena
+
+@pytest.fixture(scope="module")
+def correlacao():
+    return visao.BancoSprites(lerSprites("correlacao"))
+
+def regioes(frame):
+    """Frame inteiro e janelas de rastreamento de tamanhos diferentes"""
+    return [frame, frame[90:160, 90:162], frame[110:152, 110:154], frame[:36, :40]]
+
+def test_correlacao_tem_o_argmin_do_opencv(correlacao):
+    frames, _ = gerarCena(correlacao, 24, semente=3)
+    opencv = visao.MotorOpenCV(correlacao.modelos)
+    for frame in frames[::8]:
+        for regiao in regioes(frame):
+            preparada = correlacao.motor.preparar(regiao)
+            for i, modelo in enumerate(correlacao.modelos):
+                mapa = cv2.matchTemplate(regiao, modelo.sprite, cv2.TM_SQDIFF, None, modelo.mascara)
+                contagens = numpy.rint(mapa / 255**2)
+                _, local = opencv.casar(regiao, i)
+                pontuacao, posicao = correlacao.motor.casar(preparada, i)
+                # a mesma contagem mínima de pixels divergentes; entre
+                # empates exatos o opencv, que soma em ponto flutuante,
+                # pode escolher outra posição
+                assert pontuacao == contagens.min() * 255**2
+                assert contagens[posicao[1], posicao[0]] == contagens.min()
+                if (contagens == contagens.min()).sum() == 1:
+                    assert posicao == local
+
+def test_correlacao_rotula_como_opencv(banco, correlacao, cena):
+    frames, _ = cena
+    assert visao.MegaMan.divergencias(frames[:48], visao.MegaMan(banco), visao.MegaMan(correlacao)) == []
@@ -0,0 +1,20 @@
+import random
+import numpy
+
+from megaman_ai.progresso import Progresso, estadoAleatorio, restaurarAleatorio
+
+def test_estado_aleatorio_volta_do_manifesto(tmp_path):
+    video = tmp_path / "video.mp4"
+    video.write_bytes(b"megaman")
+    random.seed(3)
+    numpy.random.seed(4)
+    numpy.random.normal()
+
+    progresso = Progresso("modelo", str(tmp_path) + "/")
+    progresso.registrar(str(video), 30, 100, 99, aleatorio=estadoAleatorio())
+    esperado = [random.random(), numpy.random.normal(), numpy.random.rand()]
+
+    random.seed(9)
+    numpy.random.seed(9)
+    restaurarAleatorio(Progresso("modelo", str(tmp_path) + "/").aleatorio)
+    assert [random.random(), numpy.random.normal(), numpy.random.rand()] == esperado
@@ -0,0 +1,38 @@
+import os
+import socket
+import pytest
+
+from megaman_ai.servico import ServicoModelos
+
+@pytest.fixture
+def caminho(tmp_path):
+    return str(tmp_path / "servico.sock")
+
+def test_nao_toma_o_socket_de_um_servico_ativo(caminho):
+    ativo = ServicoModelos(caminho)
+    try:
+        with pytest.raises(RuntimeError):
+            ServicoModelos(caminho)
+        assert os.path.exists(caminho)
+        cliente = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        cliente.connect(caminho)
+        cliente.close()
+    finally:
+        ativo.server_close()
+
+def test_remove_socket_abandonado(caminho):
+    abandonado = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    abandonado.bind(caminho)
+    abandonado.close()
+    assert os.path.exists(caminho)
+    servico = ServicoModelos(caminho)
+    servico.server_close()
+
+@pytest.mark.parametrize("nome", ["", "../modelo", "outra/modelo", "/tmp/modelo", "..\\modelo"])
+def test_rejeita_nome_fora_da_pasta(caminho, tmp_path, nome):
+    servico = ServicoModelos(caminho, str(tmp_path))
+    try:
+        with pytest.raises(ValueError):
+            servico.modelo(nome)
+    finally:
+        servico.server_close()
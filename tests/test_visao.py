@@ -0,0 +1,91 @@
+import pytest
+
+from conftest import lerSprites, gerarCena
+
+visao = pytest.importorskip("megaman_ai.visao")
+
+LIMIAR = 20
+
+def rotuloExaustivo(vis, frame):
+    """Estado e posição da busca exaustiva, ou None abaixo do limiar"""
+    melhor, estado, direcao, posicao = vis._buscar(frame)
+    if melhor > LIMIAR:
+        return None
+    return estado + "-" + direcao, posicao
+
+def test_perdido_usa_busca_completa(banco, cena):
+    frames, _ = cena
+    vis = visao.MegaMan(banco)
+    vis.reaquisicao = False
+    referencia = visao.MegaMan(banco)
+    for frame in frames[:24]:
+        vis.posicao = None
+        vis.atualizar(frame, LIMIAR)
+        esperado = rotuloExaustivo(referencia, frame)
+        assert vis.caminho == "completo"
+        assert vis.estado == (esperado[0] if esperado else None)
+
+def test_reaquisicao_igual_a_busca_completa(banco, cena):
+    frames, _ = cena
+    vis = visao.MegaMan(banco)
+    assert vis.reaquisicao
+    referencia = visao.MegaMan(banco)
+    referencia.reaquisicao = False
+    for frame in frames[:48]:
+        vis.posicao = referencia.posicao = None
+        vis.atualizar(frame, LIMIAR)
+        referencia.atualizar(frame, LIMIAR)
+        assert (vis.estado, vis.posicao) == (referencia.estado, referencia.posicao)
+    # os frames sem o megaman e os inconclusivos vão para a busca completa
+    assert vis.caminhos["reaquisicao"] > 0 and vis.caminhos["completo"] > 0
+
+def test_rastreador_tenta_no_maximo_duas_janelas(banco, cena):
+    frames, indices = cena
+    inicio = next(i for i, m in enumerate(indices) if m >= 0)
+    vis = visao.MegaMan(banco)
+    vis.atualizar(frames[inicio], LIMIAR)
+    assert vis.posicao is not None
+
+    # frame sem o megaman: uma janela prevista, uma maior e nada mais
+    vazio = frames[inicio] * 0
+    vis.avaliacoes = 0
+    vis.atualizar(vazio, LIMIAR)
+    assert vis.posicao is None
+    assert vis.avaliacoes <= 2 * len(banco.modelos)
+    assert vis.rastreador.estatisticas()["erros"] == 1
+    assert vis.rastreador.estatisticas()["perdas"] == 1
+
+def tabelaDaCena(banco, indices):
+    tabela = visao.TabelaTransicoes(banco)
+    classes = [banco.classes.index(m.estado+"-"+m.direcao) for m in banco.modelos]
+    tabela.aprender([classes[i] for i in indices if i >= 0])
+    return tabela
+
+def test_busca_ordenada_igual_a_exaustiva(banco, cena):
+    frames, indices = cena
+    exaustiva = visao.MegaMan(banco)
+    ordenada = visao.MegaMan(banco, tabelaDaCena(banco, indices))
+    assert visao.MegaMan.divergencias(frames[:48], exaustiva, ordenada, LIMIAR) == []
+    assert ordenada.avaliacoes < exaustiva.avaliacoes
+
+def test_busca_ordenada_nao_para_sem_concorrente():
+    # o mesmo sprite em dois estados: empate exato entre as classes
+    sprites = lerSprites()
+    sprites["estados"] = {"a": {"sprites": ["1"]}, "b": {"sprites": ["1"]}, "c": {"sprites": ["4"]}}
+    banco = visao.BancoSprites(sprites)
+    frame, _ = gerarCena(banco, 1, ausencia=0)
+    frame = frame[0] * 0
+    sprite, mascara = banco.modelos[0].sprite, banco.modelos[0].mascara
+    regiao = frame[100:100+sprite.shape[0], 80:80+sprite.shape[1]]
+    regiao[mascara > 0] = sprite[mascara > 0]
+
+    tabela = visao.TabelaTransicoes(banco)
+    b = banco.classes.index("b-r")
+    tabela.aprender([b] * 50)
+    vis = visao.MegaMan(banco, tabela)
+    vis.rotulo = b
+
+    exaustivo = visao.MegaMan(banco)._buscar(frame)
+    ordenado = vis._buscar(frame, aceitar=LIMIAR)
+    assert ordenado[1:] == exaustivo[1:] == ("a", "r", (80, 100))
+    assert vis.avaliacoes > 1